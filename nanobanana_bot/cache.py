@@ -1,13 +1,24 @@
-from typing import Optional, Any
+from typing import Optional, Any, Callable
 
+import asyncio
+import inspect
 import json
+import logging
 import redis.asyncio as redis
 
 
+_logger = logging.getLogger("nanobanana.cache")
+
+
 class Cache:
     def __init__(self, redis_url: str):
         self._client = redis.from_url(redis_url, encoding="utf-8", decode_responses=True)
 
+    @property
+    def client(self) -> redis.Redis:
+        """Shared Redis connection pool for other Redis-backed components."""
+        return self._client
+
     # --- Balance helpers (legacy) ---
     async def get_balance(self, user_id: int) -> int:
         value = await self._client.get(f"nbalance:{user_id}")
@@ -63,5 +74,102 @@ class Cache:
         except Exception:
             return None
 
+    # --- Reference image dedup (Telegram file_unique_id / avatar path -> R2 URL) ---
+    async def get_many(self, keys: list[str]) -> dict[str, str]:
+        """MGET in one round trip; returns only the keys that exist."""
+        if not keys:
+            return {}
+        values = await self._client.mget(keys)
+        return {k: v for k, v in zip(keys, values) if v}
+
+    async def set_many(self, mapping: dict[str, str], ttl_seconds: int) -> None:
+        if not mapping:
+            return
+        async with self._client.pipeline(transaction=False) as pipe:
+            for key, value in mapping.items():
+                pipe.set(key, value, ex=int(ttl_seconds))
+            await pipe.execute()
+
+    # --- Idempotency ---
+    async def claim_once(self, key: str, ttl_seconds: int = 24 * 3600) -> bool:
+        """
+        SET NX EX in one round trip: True for the first caller, False if the key is already claimed.
+        """
+        return bool(await self._client.set(key, "1", nx=True, ex=int(ttl_seconds)))
+
+    async def release_claim(self, key: str) -> None:
+        """Drop a claim so that a redelivery can be processed again (e.g. after a failure)."""
+        await self._client.delete(key)
+
+    # --- Hedged generations: provider whose task won ---
+    async def set_hedge_winner(self, gen_id: int, provider: str, ttl_seconds: int = 24 * 3600) -> None:
+        await self._client.set(f"nhedge:{gen_id}", provider, ex=int(ttl_seconds))
+
+    async def get_hedge_winner(self, gen_id: int) -> Optional[str]:
+        """Provider that owns generation gen_id, or None if it was not hedged."""
+        return await self._client.get(f"nhedge:{gen_id}")
+
+    # --- Generation context (what callbacks need to deliver without Supabase reads) ---
+    async def set_generation_context(self, gen_id: int, context: dict, ttl_seconds: int = 24 * 3600) -> None:
+        """
+        Stores a flat per-generation context (user_id, lang, tokens, model, ...) as one hash:
+        ngenctx:{gen_id}. None values are skipped.
+        """
+        mapping = {k: str(v) for k, v in context.items() if v is not None}
+        if not mapping:
+            return
+        key = f"ngenctx:{gen_id}"
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, int(ttl_seconds))
+            await pipe.execute()
+
+    async def get_generation_context(self, gen_id: int) -> dict[str, str]:
+        """HGETALL in one round trip; empty dict on a miss."""
+        return await self._client.hgetall(f"ngenctx:{gen_id}")
+
+    # --- Pub/Sub (cross-replica notifications) ---
+    async def publish(self, channel: str, message: str) -> None:
+        await self._client.publish(channel, message)
+
+    async def listen(
+        self,
+        channel: str,
+        handler: Callable[[str], Any],
+        on_subscribe: Optional[Callable[[], Any]] = None,
+        reconnect_delay: float = 1.0,
+    ) -> None:
+        """
+        Runs until cancelled: calls handler(message) for every message on channel.
+
+        on_subscribe is called after each (re)subscription, so the caller can drop state
+        that may have gone stale while the connection was down.
+        """
+        while True:
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(channel)
+                if on_subscribe is not None:
+                    on_subscribe()
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    try:
+                        result = handler(msg.get("data"))
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception:
+                        _logger.warning("Pub/sub handler failed on %s", channel, exc_info=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _logger.warning("Pub/sub connection to %s lost, resubscribing", channel, exc_info=True)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(reconnect_delay)
+
     async def close(self) -> None:
         await self._client.close()
\ No newline at end of file
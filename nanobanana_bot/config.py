@@ -20,10 +20,46 @@ class Settings:
     tribute_api_key: Optional[str] = None
     tribute_product_map: dict[int, str] = field(default_factory=dict)  # tokens -> product_id (string or numeric)
     request_timeout_seconds: int = 60
+    # Shared outbound HTTP pool (KIE, Piapi, Telegram file downloads)
+    http_pool_limit: int = 100
+    http_pool_limit_per_host: int = 20
+    # FSM state lifetime in Redis
+    fsm_state_ttl_seconds: int = 24 * 3600
+    # Token ledger: batching of callback refunds and balance snapshot period (0 = off)
+    ledger_batch_size: int = 50
+    ledger_batch_delay_ms: int = 50
+    balance_snapshot_interval_seconds: int = 3600
+    # How long a provider callback (provider, task, status) is remembered for deduplication
+    callback_dedup_ttl_seconds: int = 24 * 3600
+    # Upper bound for a cached app_config value; changes normally arrive via Redis pub/sub
+    app_config_cache_ttl_seconds: int = 60
+    # Pro hedging: start the backup provider when the primary is slower than this
+    # percentile of its recent createTask latency (0 = off), capped by the max delay
+    pro_hedge_percentile: int = 0
+    pro_hedge_max_delay_ms: int = 8000
+    # Durable Redis job queue: worker slots per process (0 = do not run a worker here)
+    # and how long a claimed job may run before it is handed to another worker
+    job_worker_concurrency: int = 4
+    job_visibility_timeout_seconds: int = 300
+    # Status poller for tasks whose callback is lost: status requests per second per provider,
+    # and how long a task is polled before it is left to the stale-generation cleanup
+    task_poll_kie_rps: float = 2.0
+    task_poll_piapi_rps: float = 1.0
+    task_poll_max_age_seconds: int = 1800
+    # Stale-generation reaper: sweep period (0 = off). Generations pending longer than
+    # TASK_POLL_MAX_AGE_SECONDS are checked with the provider; after the expire threshold
+    # they are failed and refunded.
+    reaper_interval_seconds: int = 300
+    reaper_expire_after_seconds: int = 3 * 3600
     # Webhook/Server settings
     webhook_url: Optional[str] = None
     webhook_path: str = "/webhook"
     webhook_secret_token: Optional[str] = None
+    # "inline" - process update inside the webhook request; "queue" - ack at once, process in workers
+    update_ingest_mode: str = "inline"
+    # Queue mode: max updates in handlers at once (updates of one user always run in order)
+    update_workers: int = 64
+    update_queue_size: int = 1000
 
 
 def load_settings() -> Settings:
@@ -71,6 +107,23 @@ def load_settings() -> Settings:
         except Exception:
             tribute_product_map = {}
     request_timeout_seconds = int(os.getenv("REQUEST_TIMEOUT_SECONDS", "60"))
+    http_pool_limit = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+    http_pool_limit_per_host = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+    fsm_state_ttl_seconds = int(os.getenv("FSM_STATE_TTL_SECONDS", str(24 * 3600)))
+    ledger_batch_size = int(os.getenv("LEDGER_BATCH_SIZE", "50"))
+    ledger_batch_delay_ms = int(os.getenv("LEDGER_BATCH_DELAY_MS", "50"))
+    balance_snapshot_interval_seconds = int(os.getenv("BALANCE_SNAPSHOT_INTERVAL_SECONDS", "3600"))
+    callback_dedup_ttl_seconds = int(os.getenv("CALLBACK_DEDUP_TTL_SECONDS", str(24 * 3600)))
+    app_config_cache_ttl_seconds = int(os.getenv("APP_CONFIG_CACHE_TTL_SECONDS", "60"))
+    pro_hedge_percentile = int(os.getenv("PRO_HEDGE_PERCENTILE", "0"))
+    pro_hedge_max_delay_ms = int(os.getenv("PRO_HEDGE_MAX_DELAY_MS", "8000"))
+    job_worker_concurrency = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+    job_visibility_timeout_seconds = int(os.getenv("JOB_VISIBILITY_TIMEOUT_SECONDS", "300"))
+    task_poll_kie_rps = float(os.getenv("TASK_POLL_KIE_RPS", "2"))
+    task_poll_piapi_rps = float(os.getenv("TASK_POLL_PIAPI_RPS", "1"))
+    task_poll_max_age_seconds = int(os.getenv("TASK_POLL_MAX_AGE_SECONDS", "1800"))
+    reaper_interval_seconds = int(os.getenv("REAPER_INTERVAL_SECONDS", "300"))
+    reaper_expire_after_seconds = int(os.getenv("REAPER_EXPIRE_AFTER_SECONDS", str(3 * 3600)))
     # Webhook
     # Санитизация URL и пути вебхука: убираем пробелы, запятые и конечные слеши
     webhook_url_raw = os.getenv("WEBHOOK_URL")
@@ -85,6 +138,11 @@ def load_settings() -> Settings:
         webhook_path = "/" + webhook_path
     webhook_path = webhook_path.rstrip(" ,")
     webhook_secret_token = os.getenv("WEBHOOK_SECRET_TOKEN")
+    update_ingest_mode = (os.getenv("UPDATE_INGEST_MODE", "inline") or "inline").strip().lower()
+    if update_ingest_mode not in {"inline", "queue"}:
+        update_ingest_mode = "inline"
+    update_workers = int(os.getenv("UPDATE_WORKERS", "64"))
+    update_queue_size = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
 
     if not bot_token:
         raise RuntimeError("BOT_TOKEN is required")
@@ -102,7 +160,27 @@ def load_settings() -> Settings:
         tribute_api_key=tribute_api_key,
         tribute_product_map=tribute_product_map,
         request_timeout_seconds=request_timeout_seconds,
+        http_pool_limit=http_pool_limit,
+        http_pool_limit_per_host=http_pool_limit_per_host,
+        fsm_state_ttl_seconds=fsm_state_ttl_seconds,
+        ledger_batch_size=ledger_batch_size,
+        ledger_batch_delay_ms=ledger_batch_delay_ms,
+        balance_snapshot_interval_seconds=balance_snapshot_interval_seconds,
+        callback_dedup_ttl_seconds=callback_dedup_ttl_seconds,
+        app_config_cache_ttl_seconds=app_config_cache_ttl_seconds,
+        pro_hedge_percentile=pro_hedge_percentile,
+        pro_hedge_max_delay_ms=pro_hedge_max_delay_ms,
+        job_worker_concurrency=job_worker_concurrency,
+        job_visibility_timeout_seconds=job_visibility_timeout_seconds,
+        task_poll_kie_rps=task_poll_kie_rps,
+        task_poll_piapi_rps=task_poll_piapi_rps,
+        task_poll_max_age_seconds=task_poll_max_age_seconds,
+        reaper_interval_seconds=reaper_interval_seconds,
+        reaper_expire_after_seconds=reaper_expire_after_seconds,
         webhook_url=webhook_url,
         webhook_path=webhook_path,
         webhook_secret_token=webhook_secret_token,
+        update_ingest_mode=update_ingest_mode,
+        update_workers=update_workers,
+        update_queue_size=update_queue_size,
     )
\ No newline at end of file
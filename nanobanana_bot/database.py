@@ -1,16 +1,44 @@
-from typing import Any, Dict, Optional, List
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, List, Union
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timezone
 from uuid import uuid4
 import mimetypes
+import time
 
 from supabase import AsyncClient, acreate_client
 
 
+# Request-scoped memo of users rows: user_id -> row (None = no such user).
+# Active only inside Database.user_scope(), i.e. while one update is processed.
+_user_rows: ContextVar[Optional[Dict[int, Optional[Dict[str, Any]]]]] = ContextVar(
+    "nanobanana_user_rows", default=None
+)
+
+
+class LedgerEntryError(RuntimeError):
+    """One entry of apply_ledger_batch failed in the database; the other entries were applied."""
+
+
+def generation_ledger_key(generation_id: int, kind: str) -> str:
+    """Idempotency key of a generation's token movement ("debit"/"refund") in token_ledger."""
+    return f"gen:{int(generation_id)}:{kind}"
+
+
 class Database:
     def __init__(self, supabase_url: str, supabase_key: str):
         self._url = supabase_url
         self._key = supabase_key
         self.client: Optional[AsyncClient] = None
+        # (user_id, bot_source) pairs already upserted by this process
+        self._known_subscriptions: set[tuple[int, str]] = set()
+        # (storage path, expires_in) -> (signed URL, reuse until monotonic time)
+        self._signed_urls: Dict[tuple[str, int], tuple[str, float]] = {}
+        # app_config key -> (value, valid until monotonic time). The TTL is only a safety
+        # net: set_app_config notifies other replicas, which drop the key immediately.
+        self.app_config_ttl_seconds: float = 60.0
+        self._app_config: Dict[str, tuple[Optional[str], float]] = {}
+        self._app_config_notifier: Optional[Callable[[str], Awaitable[None]]] = None
 
     async def init(self) -> None:
         """Initialize async Supabase client. Must be called once during app startup."""
@@ -24,6 +52,32 @@ class Database:
             raise RuntimeError("Supabase client is not initialized. Call Database.init() first.")
         return client
 
+    @contextmanager
+    def user_scope(self) -> Iterator[None]:
+        """
+        Memoize users rows for the duration of one update.
+
+        Inside the scope get_user/get_token_balance/get_user_language share a single
+        row fetch per user, and writes through this class update the memo.
+        """
+        token = _user_rows.set({})
+        try:
+            yield
+        finally:
+            _user_rows.reset(token)
+
+    @staticmethod
+    def _memo_update(user_id: int, fields: Dict[str, Any]) -> None:
+        memo = _user_rows.get()
+        if memo is None:
+            return
+        row = memo.get(int(user_id))
+        if row is not None:
+            row.update(fields)
+        elif int(user_id) in memo:
+            # Row did not exist and was just created by an upsert: we only know these fields
+            memo.pop(int(user_id), None)
+
     async def get_or_create_user(
         self,
         user_id: int,
@@ -33,15 +87,9 @@ class Database:
         language_code: Optional[str],
     ) -> Dict[str, Any]:
         # Existing user by primary key user_id
-        existing = await (
-            self._client.table("users")
-            .select("*")
-            .eq("user_id", user_id)
-            .limit(1)
-            .execute()
-        )
-        if existing.data:
-            return existing.data[0]
+        existing = await self.get_user(user_id)
+        if existing:
+            return existing
 
         created = await (
             self._client.table("users")
@@ -57,34 +105,149 @@ class Database:
             )
             .execute()
         )
-        return created.data[0]
+        row = created.data[0]
+        memo = _user_rows.get()
+        if memo is not None:
+            memo[int(user_id)] = row
+        return row
 
     async def get_token_balance(self, user_id: int) -> int:
+        """
+        Current balance for display and pre-checks. Inside user_scope() it is served
+        from the memoized row; money movements go through adjust_balance().
+        """
+        if _user_rows.get() is not None:
+            user = await self.get_user(user_id)
+            return int((user or {}).get("balance") or 0)
         res = await self._client.table("users").select("balance").eq("user_id", user_id).limit(1).execute()
         if res.data:
-            return int(res.data[0].get("balance", 0))
+            balance = int(res.data[0].get("balance", 0))
+            self._memo_update(user_id, {"balance": balance})
+            return balance
         return 0
 
     async def set_token_balance(self, user_id: int, balance: int) -> None:
         # upsert by user_id
         await self._client.table("users").upsert({"user_id": user_id, "balance": int(balance)}).execute()
+        self._memo_update(user_id, {"balance": int(balance)})
+
+    async def adjust_balance(
+        self,
+        user_id: int,
+        delta: int,
+        reason: str,
+        idempotency_key: str,
+        generation_id: Optional[int] = None,
+    ) -> Optional[int]:
+        """
+        Atomically apply delta to the balance and write a token_ledger row (RPC adjust_balance).
+
+        Returns the balance after the call, or None if a debit would make it negative.
+        Repeating an idempotency_key does not move tokens again and returns the current balance.
+        """
+        res = await self._client.rpc(
+            "adjust_balance",
+            {
+                "p_user_id": int(user_id),
+                "p_delta": int(delta),
+                "p_reason": str(reason),
+                "p_idempotency_key": str(idempotency_key),
+                "p_generation_id": int(generation_id) if generation_id is not None else None,
+            },
+        ).execute()
+        data = getattr(res, "data", None) or {}
+        if isinstance(data, list):
+            data = data[0] if data else {}
+        if not data.get("ok"):
+            return None
+        balance = int(data.get("balance") or 0)
+        self._memo_update(user_id, {"balance": balance})
+        return balance
+
+    async def apply_ledger_batch(self, entries: List[Dict[str, Any]]) -> List[Union[int, None, LedgerEntryError]]:
+        """
+        Apply many ledger entries in one RPC (apply_ledger_batch).
+
+        Each entry: user_id, delta, reason, idempotency_key and optional generation_id.
+        Returns per-entry results in input order: the balance, None where a debit was
+        rejected, or a LedgerEntryError where the entry itself failed (the rest still apply).
+        """
+        if not entries:
+            return []
+        payload = [
+            {
+                "user_id": int(e["user_id"]),
+                "delta": int(e["delta"]),
+                "reason": str(e["reason"]),
+                "idempotency_key": str(e["idempotency_key"]),
+                "generation_id": int(e["generation_id"]) if e.get("generation_id") is not None else None,
+            }
+            for e in entries
+        ]
+        res = await self._client.rpc("apply_ledger_batch", {"p_entries": payload}).execute()
+        results = getattr(res, "data", None) or []
+        balances: List[Union[int, None, LedgerEntryError]] = []
+        for entry, result in zip(payload, results):
+            if result and result.get("ok"):
+                balance = int(result.get("balance") or 0)
+                self._memo_update(entry["user_id"], {"balance": balance})
+                balances.append(balance)
+            elif result and result.get("error"):
+                balances.append(LedgerEntryError(f"{entry['idempotency_key']}: {result['error']}"))
+            else:
+                balances.append(None)
+        return balances
+
+    async def snapshot_balances(self) -> int:
+        """Refresh balance_snapshots for users with new ledger entries; returns the number refreshed."""
+        res = await self._client.rpc("snapshot_balances", {}).execute()
+        data = getattr(res, "data", None)
+        try:
+            return int(data or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    async def get_ledger_history(
+        self, user_id: int, limit: int = 10, before_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Newest-first ledger entries of a user (keyset pagination by id, index user_id+id)."""
+        query = (
+            self._client.table("token_ledger")
+            .select("id,delta,balance_after,reason,generation_id,created_at")
+            .eq("user_id", int(user_id))
+        )
+        if before_id is not None:
+            query = query.lt("id", int(before_id))
+        res = await query.order("id", desc=True).limit(int(limit)).execute()
+        return getattr(res, "data", []) or []
 
     async def set_language_code(self, user_id: int, language_code: str) -> None:
         # update language for existing user
         await self._client.table("users").update({"language_code": language_code}).eq("user_id", user_id).execute()
+        self._memo_update(user_id, {"language_code": language_code})
 
     async def set_ref(self, user_id: int, ref: str) -> None:
         await self._client.table("users").update({"ref": str(ref)}).eq("user_id", int(user_id)).execute()
+        self._memo_update(user_id, {"ref": str(ref)})
 
     async def upsert_user_ref(self, user_id: int, ref: str) -> None:
         await self._client.table("users").upsert({"user_id": int(user_id), "ref": str(ref)}).execute()
+        self._memo_update(user_id, {"ref": str(ref)})
 
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Users row; a copy, so callers cannot change the memoized row."""
+        memo = _user_rows.get()
+        if memo is not None and int(user_id) in memo:
+            row = memo[int(user_id)]
+            return dict(row) if row is not None else None
         res = await (
             self._client.table("users").select("*").eq("user_id", user_id).limit(1).execute()
         )
         rows = getattr(res, "data", []) or []
-        return rows[0] if rows else None
+        row = rows[0] if rows else None
+        if memo is not None:
+            memo[int(user_id)] = row
+        return dict(row) if row is not None else None
 
     async def create_generation(
         self,
@@ -108,18 +271,48 @@ class Database:
         created = await self._client.table("generations").insert(data).execute()
         return created.data[0]
 
-    async def mark_generation_completed(self, generation_id: int, media_url: str) -> None:
+    async def mark_generation_completed(self, generation_id: int, media_url: str) -> bool:
+        """
+        Completes a pending generation. False if the row is no longer pending (already
+        completed by a redelivery, or failed and refunded by the reaper).
+        """
         completed_at = datetime.now(timezone.utc).isoformat()
+        res = await (
+            self._client.table("generations")
+            .update({"status": "completed", "image_url": media_url, "completed_at": completed_at})
+            .eq("id", generation_id)
+            .eq("status", "pending")
+            .execute()
+        )
+        return bool(getattr(res, "data", None))
+
+    async def update_generation_image_url(self, generation_id: int, image_url: str) -> None:
+        """Replaces the provider's (expiring) result URL, e.g. with its R2 mirror."""
         await self._client.table("generations").update(
-            {"status": "completed", "image_url": media_url, "completed_at": completed_at}
+            {"image_url": image_url}
         ).eq("id", generation_id).execute()
 
-    async def mark_generation_failed(self, generation_id: int, error_message: str) -> None:
-        completed_at = datetime.now(timezone.utc).isoformat()
+    async def set_generation_file_id(self, generation_id: int, file_id: str) -> None:
+        """Telegram file_id of the delivered result document (re-sends skip the upload)."""
         await self._client.table("generations").update(
-            {"status": "failed", "error_message": error_message, "completed_at": completed_at}
+            {"tg_file_id": file_id}
         ).eq("id", generation_id).execute()
 
+    async def mark_generation_failed(self, generation_id: int, error_message: str) -> bool:
+        """
+        Fails a pending generation. False if the row is no longer pending (already completed,
+        or failed and refunded by another callback or the reaper).
+        """
+        completed_at = datetime.now(timezone.utc).isoformat()
+        res = await (
+            self._client.table("generations")
+            .update({"status": "failed", "error_message": error_message, "completed_at": completed_at})
+            .eq("id", generation_id)
+            .eq("status", "pending")
+            .execute()
+        )
+        return bool(getattr(res, "data", None))
+
     async def update_generation_input_images(self, generation_id: int, input_images: List[str]) -> None:
         await self._client.table("generations").update(
             {"input_images": input_images}
@@ -140,10 +333,17 @@ class Database:
         return rows[0] if rows else None
 
     async def ensure_bot_subscription(self, user_id: int, bot_source: str) -> None:
+        # Upsert is idempotent; skip the round trip once this process has done it
+        pair = (int(user_id), str(bot_source))
+        if pair in self._known_subscriptions:
+            return
         await self._client.table("bot_subscriptions").upsert(
             {"user_id": int(user_id), "bot_source": str(bot_source)},
             on_conflict="user_id,bot_source",
         ).execute()
+        if len(self._known_subscriptions) >= 100_000:
+            self._known_subscriptions.clear()
+        self._known_subscriptions.add(pair)
 
     async def has_bot_subscription(self, user_id: int, bot_source: str) -> bool:
         res = await (
@@ -286,17 +486,61 @@ class Database:
 
     async def create_signed_url(self, file_path: str, expires_in: int = 300) -> str:
         # Create a temporary signed URL for private bucket access
+        signed = await self.create_signed_urls([file_path], expires_in)
+        return signed.get(file_path, "")
+
+    async def create_signed_urls(self, file_paths: List[str], expires_in: int = 300) -> Dict[str, str]:
+        """
+        Signed URLs for several storage paths: cached ones are reused, the rest are signed
+        with a single multi-path call. A cached URL is reused only during the first half of
+        its lifetime, so callers always get at least expires_in/2 seconds of validity.
+        Returns path -> URL for the paths that could be signed.
+        """
+        now = time.monotonic()
+        result: Dict[str, str] = {}
+        missing: List[str] = []
+        for path in dict.fromkeys(file_paths):
+            cached = self._signed_urls.get((path, expires_in))
+            if cached is not None and cached[1] > now:
+                result[path] = cached[0]
+            else:
+                missing.append(path)
+        if not missing:
+            return result
         try:
-            signed = await self._client.storage.from_("photo_reference").create_signed_url(file_path, expires_in)
-            # Supabase Python client returns dict with signedURL or fullURL depending on version
-            if isinstance(signed, dict):
-                return signed.get("signedURL") or signed.get("signed_url") or signed.get("fullURL") or signed.get("publicURL") or ""
-            return str(signed)
+            signed = await self._client.storage.from_("photo_reference").create_signed_urls(missing, expires_in)
         except Exception:
-            return ""
+            return result
+        reuse_until = now + expires_in / 2
+        if len(self._signed_urls) >= 10_000:
+            self._signed_urls.clear()
+        for item in signed or []:
+            if not isinstance(item, dict) or item.get("error"):
+                continue
+            # Supabase Python client returns signedURL or signedUrl depending on version
+            url = item.get("signedURL") or item.get("signedUrl") or item.get("signed_url") or ""
+            path = item.get("path")
+            if url and path:
+                result[path] = url
+                self._signed_urls[(path, expires_in)] = (url, reuse_until)
+        return result
+
+    def set_app_config_notifier(self, notifier: Optional[Callable[[str], Awaitable[None]]]) -> None:
+        """Coroutine called with the key after set_app_config (e.g. a Redis publish to other replicas)."""
+        self._app_config_notifier = notifier
+
+    def invalidate_app_config(self, key: Optional[str] = None) -> None:
+        """Drop one cached app_config key, or all of them when key is None."""
+        if key is None:
+            self._app_config.clear()
+        else:
+            self._app_config.pop(key, None)
 
     async def get_app_config(self, key: str) -> Optional[str]:
-        """Get config value from app_config table."""
+        """Get config value from app_config table (cached in-process for app_config_ttl_seconds)."""
+        cached = self._app_config.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
         try:
             res = await (
                 self._client.table("app_config")
@@ -305,19 +549,26 @@ class Database:
                 .limit(1)
                 .execute()
             )
-            rows = getattr(res, "data", []) or []
-            if rows:
-                return rows[0].get("value")
         except Exception:
-            pass
-        return None
+            return None
+        rows = getattr(res, "data", []) or []
+        value = rows[0].get("value") if rows else None
+        self._app_config[key] = (value, time.monotonic() + self.app_config_ttl_seconds)
+        return value
 
     async def set_app_config(self, key: str, value: str) -> None:
-        """Set config value in app_config table."""
+        """Set config value in app_config table and notify other replicas."""
         await self._client.table("app_config").upsert(
             {"key": key, "value": value},
             on_conflict="key"
         ).execute()
+        self._app_config[key] = (value, time.monotonic() + self.app_config_ttl_seconds)
+        if self._app_config_notifier is not None:
+            try:
+                await self._app_config_notifier(key)
+            except Exception:
+                # Other replicas fall back to the TTL
+                pass
 
     async def update_generation_provider(self, generation_id: int, provider: str) -> None:
         """Update api_provider field for generation."""
@@ -325,8 +576,64 @@ class Database:
             {"api_provider": provider}
         ).eq("id", generation_id).execute()
 
+    async def update_generation_task(self, generation_id: int, provider: str, task_id: Optional[str]) -> None:
+        """Store the provider and its task id in one update (task id is used to reconcile lost callbacks)."""
+        data: Dict[str, Any] = {"api_provider": provider}
+        if task_id:
+            data["provider_task_id"] = str(task_id)
+        await self._client.table("generations").update(data).eq("id", generation_id).execute()
+
+    async def list_pending_provider_tasks(self, created_after: datetime, limit: int = 1000) -> List[Dict[str, Any]]:
+        """
+        Pending generations with a provider task id created after created_after, newest first:
+        id, api_provider, provider_task_id, created_at. Older ones are left to the reaper.
+        """
+        res = await (
+            self._client.table("generations")
+            .select("id, api_provider, provider_task_id, created_at")
+            .eq("status", "pending")
+            .not_.is_("provider_task_id", "null")
+            .gt("created_at", created_after.isoformat())
+            .order("id", desc=True)
+            .limit(int(limit))
+            .execute()
+        )
+        return getattr(res, "data", []) or []
+
+    async def list_stale_generations(
+        self, created_before: datetime, after_id: int = 0, limit: int = 200
+    ) -> List[Dict[str, Any]]:
+        """One keyset page (id > after_id) of generations still pending since before created_before."""
+        res = await (
+            self._client.table("generations")
+            .select("id, user_id, api_provider, provider_task_id, created_at")
+            .eq("status", "pending")
+            .lt("created_at", created_before.isoformat())
+            .gt("id", int(after_id))
+            .order("id")
+            .limit(int(limit))
+            .execute()
+        )
+        return getattr(res, "data", []) or []
+
+    async def expire_generations(self, generation_ids: List[int], error_message: str) -> List[Dict[str, Any]]:
+        """
+        Fail still-pending generations and refund their debits in one RPC (expire_generations).
+        Returns [{generation_id, user_id, refunded, balance}] for the rows actually finalized.
+        """
+        if not generation_ids:
+            return []
+        res = await self._client.rpc(
+            "expire_generations",
+            {"p_ids": [int(i) for i in generation_ids], "p_error": str(error_message)},
+        ).execute()
+        return getattr(res, "data", None) or []
+
     async def get_user_language(self, user_id: int) -> str:
         """Get user language code, defaults to 'ru'."""
+        if _user_rows.get() is not None:
+            user = await self.get_user(user_id)
+            return (user or {}).get("language_code") or "ru"
         try:
             res = await self._client.table("users").select("language_code").eq("user_id", int(user_id)).limit(1).execute()
             rows = getattr(res, "data", []) or []
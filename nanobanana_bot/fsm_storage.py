@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Mapping, Optional, Tuple
+
+import json
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from .cache import Cache
+
+
+# Поля одного Redis-хеша на ключ FSM: состояние и данные вместе
+_STATE_FIELD = "s"
+_DATA_FIELD = "d"
+
+# Per-update memo: StorageKey -> {"s": state, "d": data}; a missing field means "not known yet".
+# Active only inside RedisFSMStorage.scope().
+_update_cache: ContextVar[Optional[Dict[StorageKey, Dict[str, Any]]]] = ContextVar(
+    "nanobanana_fsm_update_cache", default=None
+)
+
+
+# KEYS: FSM hash. ARGV: encoded data, default ttl, then (state or group, ttl) pairs.
+# Writes the data and applies the TTL of the stored state in one round trip (see ttl_for);
+# returns the stored state.
+SET_DATA_SCRIPT = """
+redis.call('HSET', KEYS[1], 'd', ARGV[1])
+local state = redis.call('HGET', KEYS[1], 's')
+local ttl = tonumber(ARGV[2])
+if state then
+  local group = string.match(state, '^([^:]*)')
+  local exact, by_group
+  for i = 3, #ARGV, 2 do
+    if ARGV[i] == state then exact = ARGV[i + 1] end
+    if ARGV[i] == group then by_group = ARGV[i + 1] end
+  end
+  ttl = tonumber(exact or by_group or ttl)
+end
+redis.call('EXPIRE', KEYS[1], ttl)
+return state
+"""
+
+
+def _encode(data: Mapping[str, Any]) -> str:
+    # Compact JSON: no whitespace, non-ASCII kept as is (prompts are often Cyrillic)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _decode(raw: Optional[str]) -> Dict[str, Any]:
+    if not raw:
+        return {}
+    try:
+        value = json.loads(raw)
+    except Exception:
+        return {}
+    return value if isinstance(value, dict) else {}
+
+
+class RedisFSMStorage(BaseStorage):
+    """
+    FSM storage on top of the shared Cache Redis connection.
+
+    State and data live in one hash per user/chat, so a read is a single
+    HMGET and a write is a single pipelined HSET+EXPIRE (no read-before-write;
+    set_data with an unknown state looks it up in the same Lua call).
+    The hash TTL follows the current state (see state_ttls). Inside scope()
+    (opened once per update by FSMScopeMiddleware) reads are memoized, so a
+    handler touching state several times pays one round trip for reads.
+    """
+
+    def __init__(
+        self,
+        cache: Cache,
+        state_ttls: Optional[Mapping[str, int]] = None,
+        default_ttl: int = 24 * 3600,
+        prefix: str = "nfsm",
+    ):
+        self._redis = cache.client
+        # Keys are state names or StatesGroup prefixes, e.g. "AvatarStates"
+        self._state_ttls: Dict[str, int] = dict(state_ttls or {})
+        self._default_ttl = int(default_ttl)
+        self._prefix = prefix
+        self._ttl_args = [str(v) for item in self._state_ttls.items() for v in item]
+        self._set_data = self._redis.register_script(SET_DATA_SCRIPT)
+
+    def _key(self, key: StorageKey) -> str:
+        parts = [self._prefix, str(key.bot_id), str(key.chat_id), str(key.user_id)]
+        if key.thread_id:
+            parts.append(str(key.thread_id))
+        if key.business_connection_id:
+            parts.append(str(key.business_connection_id))
+        if key.destiny != "default":
+            parts.append(key.destiny)
+        return ":".join(parts)
+
+    def ttl_for(self, state: Optional[str]) -> int:
+        if state:
+            if state in self._state_ttls:
+                return self._state_ttls[state]
+            group = state.split(":", 1)[0]
+            if group in self._state_ttls:
+                return self._state_ttls[group]
+        return self._default_ttl
+
+    @contextmanager
+    def scope(self) -> Iterator[None]:
+        """Memoize reads for the duration of one update."""
+        token = _update_cache.set({})
+        try:
+            yield
+        finally:
+            _update_cache.reset(token)
+
+    async def _load(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        memo = _update_cache.get()
+        entry = memo.get(key) if memo is not None else None
+        if entry is not None and _STATE_FIELD in entry and _DATA_FIELD in entry:
+            return entry[_STATE_FIELD], entry[_DATA_FIELD]
+        state, raw = await self._redis.hmget(self._key(key), [_STATE_FIELD, _DATA_FIELD])
+        loaded = {_STATE_FIELD: state or None, _DATA_FIELD: _decode(raw)}
+        if memo is not None:
+            # Values written earlier in this update win over what we just read
+            loaded.update(entry or {})
+            memo[key] = loaded
+        return loaded[_STATE_FIELD], loaded[_DATA_FIELD]
+
+    def _remember(self, key: StorageKey, field: str, value: Any) -> None:
+        memo = _update_cache.get()
+        if memo is not None:
+            memo.setdefault(key, {})[field] = value
+
+    def _known_state(self, key: StorageKey) -> Tuple[bool, Optional[str]]:
+        memo = _update_cache.get()
+        entry = memo.get(key) if memo is not None else None
+        if entry is not None and _STATE_FIELD in entry:
+            return True, entry[_STATE_FIELD]
+        return False, None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state_name = (state.state if isinstance(state, State) else state) or None
+        redis_key = self._key(key)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            if state_name is None:
+                # Redis removes the hash by itself once both fields are gone
+                pipe.hdel(redis_key, _STATE_FIELD)
+            else:
+                pipe.hset(redis_key, _STATE_FIELD, state_name)
+            pipe.expire(redis_key, self.ttl_for(state_name))
+            await pipe.execute()
+        self._remember(key, _STATE_FIELD, state_name)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        values = dict(data)
+        redis_key = self._key(key)
+        if not values:
+            await self._redis.hdel(redis_key, _DATA_FIELD)
+        else:
+            known, state = self._known_state(key)
+            if known:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    pipe.hset(redis_key, _DATA_FIELD, _encode(values))
+                    pipe.expire(redis_key, self.ttl_for(state))
+                    await pipe.execute()
+            else:
+                # Outside the per-update memo (e.g. background tasks): keep the state's own TTL
+                state = await self._set_data(
+                    keys=[redis_key],
+                    args=[_encode(values), self._default_ttl, *self._ttl_args],
+                )
+                self._remember(key, _STATE_FIELD, state or None)
+        self._remember(key, _DATA_FIELD, values)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key)
+        return dict(data)
+
+    async def close(self) -> None:
+        # Redis connection is owned by Cache and closed there
+        pass
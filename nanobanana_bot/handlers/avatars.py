@@ -87,20 +87,8 @@ async def avatar_receive_photo(message: Message, state: FSMContext) -> None:
     st = await state.get_data()
     lang = st.get("lang")
     
-    # Download photo to memory
-    f = await message.bot.get_file(photo.file_id)
-    file_bytes = io.BytesIO()
-    await message.bot.download_file(f.file_path, file_bytes)
-    file_bytes.seek(0)
-    
-    await state.update_data(file_bytes=file_bytes.read().hex()) # Store as hex string to be json serializable? Or just keep in memory for short time?
-    # Keeping bytes in FSM might be heavy if using Redis, but MemoryStorage is default.
-    # Safe way: store file_id temporarily and download at the end? 
-    # Actually, let's keep it simple: store file_id and download when saving to DB? 
-    # But `upload_avatar` needs bytes.
-    # Let's re-download at the end to be safe with storage limits, or just pass file_id to next step.
-    # wait, message.bot.download_file writes to stream.
-    
+    # Храним только file_id: байты скачиваются при сохранении аватара,
+    # чтобы не раздувать FSM-данные в Redis
     await state.update_data(photo_file_id=photo.file_id)
     await state.set_state(AvatarStates.waiting_name)
     await message.answer(t(lang, "avatars.enter_name"))
@@ -1,4 +1,4 @@
-from aiogram import Router, F, html
+from aiogram import Bot, Router, F, html
 from aiogram.filters import Command, StateFilter
 from aiogram.types import (
     Message,
@@ -16,9 +16,13 @@ from aiogram.fsm.context import FSMContext
 from aiogram.exceptions import TelegramBadRequest
 
 from ..utils.nanobanana import NanoBananaClient
-from ..database import Database
+from ..utils.provider_errors import TaskAccepted
+from ..database import Database, generation_ledger_key
+from ..middlewares.user_context import UserContext
 from ..utils.i18n import t, normalize_lang
-from ..utils.r2 import R2Client
+from ..utils.r2 import R2Client, SourceGone
+from ..utils.jobs import JobQueue, PermanentJobError
+from ..utils.delivery import ResultDelivery, result_filename
 from ..utils.telegram_draft import send_message_draft
 from ..cache import Cache
 import asyncio
@@ -34,15 +38,227 @@ _db: Database | None = None
 _cache: Cache | None = None
 _r2: R2Client | None = None
 _gen_service = None  # GenerationService for Pro fallback
+_jobs: JobQueue | None = None
+_delivery: ResultDelivery | None = None
 _logger = logging.getLogger("nanobanana.generate")
 
-def setup(client: NanoBananaClient, database: Database, cache: Cache | None = None, r2_client: R2Client | None = None, generation_service = None) -> None:
-    global _client, _db, _cache, _r2, _gen_service
+R2_UPLOAD_JOB = "r2_reference_upload"
+R2_MIRROR_JOB = "r2_output_mirror"
+
+
+def setup(client: NanoBananaClient, database: Database, cache: Cache | None = None, r2_client: R2Client | None = None, generation_service = None, jobs: JobQueue | None = None, delivery: ResultDelivery | None = None) -> None:
+    global _client, _db, _cache, _r2, _gen_service, _jobs, _delivery
     _client = client
     _db = database
     _cache = cache
     _r2 = r2_client
     _gen_service = generation_service
+    _jobs = jobs
+    _delivery = delivery
+    if jobs is not None:
+        jobs.register(R2_UPLOAD_JOB, _r2_upload_job)
+        jobs.register(R2_MIRROR_JOB, _r2_mirror_job)
+
+
+async def _reserve_tokens(user_id: int, gen_id: int, tokens: int) -> int | None:
+    """Атомарно списывает токены под генерацию до вызова провайдера. None — недостаточно токенов."""
+    assert _db is not None
+    return await _db.adjust_balance(
+        user_id, -int(tokens), "generation", generation_ledger_key(gen_id, "debit"), generation_id=gen_id
+    )
+
+
+async def _refund_tokens(user_id: int, gen_id: int, tokens: int) -> None:
+    """Возврат токенов за неудачную генерацию; повторный возврат по тому же gen_id не начисляет дважды."""
+    assert _db is not None
+    try:
+        balance = await _db.adjust_balance(
+            user_id, int(tokens), "refund", generation_ledger_key(gen_id, "refund"), generation_id=gen_id
+        )
+        _logger.info("Refunded %s tokens: user=%s gen_id=%s balance=%s", tokens, user_id, gen_id, balance)
+    except Exception as e:
+        _logger.warning("Failed to refund tokens user=%s gen_id=%s: %s", user_id, gen_id, e)
+
+
+async def _store_generation_context(gen_id: int, user_id: int, lang: str | None, tokens: int, **params) -> None:
+    """Контекст генерации в Redis (ngenctx:{id}): callback доставляет результат без чтений из Supabase."""
+    if _cache is None:
+        return
+    try:
+        await _cache.set_generation_context(
+            gen_id,
+            {"user_id": user_id, "lang": normalize_lang(lang) if lang else None, "tokens": tokens, **params},
+        )
+    except Exception:
+        _logger.debug("Failed to store generation context gen_id=%s", gen_id, exc_info=True)
+
+
+async def _send_result(callback: CallbackQuery, gen_id: int | None, image_url: str, caption: str, lang: str | None) -> None:
+    """Синхронный результат: документом через ResultDelivery (file_id сохраняется)."""
+    reply_markup = post_result_reply_keyboard(lang)
+    if _delivery is not None:
+        await _delivery.send(callback.message.bot, callback.message.chat.id, gen_id, image_url, caption=caption, reply_markup=reply_markup)
+        return
+    try:
+        file = URLInputFile(url=str(image_url), filename=result_filename(image_url))
+        await callback.message.answer_document(document=file, caption=caption, reply_markup=reply_markup)
+    except Exception as e:
+        _logger.warning("Failed to send document, falling back to photo: %s", e)
+        await callback.message.answer_photo(photo=image_url, caption=caption, reply_markup=reply_markup)
+
+
+async def _track_accepted_task(gen_id: int | None, e: TaskAccepted) -> None:
+    """Стандартный путь KIE: task id в БД и в поллер, чтобы потерянный callback был подобран."""
+    if gen_id is None or not e.task_id:
+        return
+    try:
+        await _db.update_generation_task(int(gen_id), e.provider, e.task_id)
+    except Exception:
+        _logger.debug("Failed to store provider task for generation %s", gen_id, exc_info=True)
+    if _gen_service is not None:
+        _gen_service.track_task(e.provider, e.task_id, int(gen_id))
+
+
+# Сколько референсов (get_file / R2 / подпись аватара) резолвится одновременно
+REFERENCE_CONCURRENCY = 6
+# Сколько живёт запись file_unique_id/путь аватара → R2 URL в Redis
+REFERENCE_DEDUP_TTL_SECONDS = 30 * 24 * 3600
+
+
+def _photo_ref_key(unique_id: str) -> str:
+    return f"nref:tg:{unique_id}"
+
+
+def _avatar_ref_key(path: str) -> str:
+    return f"nref:av:{path}"
+
+
+async def _resolve_photo(bot: Bot, file_id: str, sem: asyncio.Semaphore, upload: bool) -> tuple[str | None, bool]:
+    """Telegram file_id → URL. Returns (url, needs_background_upload); False means the URL is in R2."""
+    async with sem:
+        try:
+            f = await bot.get_file(file_id)
+        except Exception as e:
+            _logger.warning("Failed to fetch telegram file path for %s: %s", file_id, e)
+            return None, False
+        # Предупреждение: это публичный URL с токеном — используйте только если доверяете провайдеру
+        tg_file_url = f"https://api.telegram.org/file/bot{bot.token}/{f.file_path}"
+        if upload and _r2:
+            try:
+                r2_url = await _r2.upload_file_from_url(tg_file_url)
+                if r2_url:
+                    _logger.info("Sync R2 upload success: %s", r2_url)
+                    return r2_url, False
+            except Exception as e:
+                _logger.warning("Sync R2 upload failed, fallback to TG URL: %s", e)
+        return tg_file_url, True
+
+
+async def _resolve_avatar(path: str, signed: str | None, sem: asyncio.Semaphore) -> tuple[str | None, bool]:
+    """Подписанный URL аватара → URL для провайдера. Returns (url, is_r2_url); иначе это временная подписанная ссылка."""
+    if not signed:
+        _logger.warning("Failed to sign avatar url %s", path)
+        return None, False
+    if _r2:
+        async with sem:
+            try:
+                r2_avatar_url = await _r2.upload_file_from_url(signed)
+                if r2_avatar_url:
+                    _logger.info("Avatar R2 upload success: %s -> %s", path, r2_avatar_url)
+                    return r2_avatar_url, True
+            except Exception as e:
+                _logger.warning("Avatar R2 upload failed for %s, fallback to signed URL: %s", path, e)
+    return signed, False
+
+
+async def resolve_reference_urls(
+    bot: Bot,
+    photos: list[str],
+    avatar_paths: list[str],
+    upload_photos: bool = True,
+    photo_unique_ids: dict[str, str] | None = None,
+) -> tuple[list[str], list[str]]:
+    """
+    Resolves photos and avatars concurrently (bounded by REFERENCE_CONCURRENCY).
+
+    References already mirrored to R2 (by Telegram file_unique_id or avatar path) are
+    taken from the Redis dedup index with one MGET and are not downloaded again.
+    Returns (image_urls, telegram_urls_to_upload): image_urls keeps the input order
+    (photos first, then avatars) and skips references that failed to resolve;
+    telegram_urls_to_upload lists raw Telegram URLs left for the background R2 upload.
+    """
+    unique_ids = photo_unique_ids or {}
+    photo_keys = [_photo_ref_key(unique_ids[pid]) if unique_ids.get(pid) else None for pid in photos]
+    avatar_keys = [_avatar_ref_key(path) for path in avatar_paths]
+    known: dict[str, str] = {}
+    if _cache is not None and _r2 is not None:
+        try:
+            known = await _cache.get_many([k for k in photo_keys + avatar_keys if k])
+        except Exception:
+            _logger.debug("Reference dedup lookup failed", exc_info=True)
+
+    # Все аватары, которых нет в R2-индексе, подписываем одним запросом к Storage,
+    # параллельно с получением фото
+    to_sign = [path for path, key in zip(avatar_paths, avatar_keys) if key not in known]
+
+    async def sign_avatars() -> dict[str, str]:
+        if not to_sign:
+            return {}
+        assert _db is not None
+        try:
+            return await _db.create_signed_urls(to_sign)
+        except Exception as e:
+            _logger.warning("Failed to sign avatar urls: %s", e)
+            return {}
+
+    signing = asyncio.create_task(sign_avatars())
+    sem = asyncio.Semaphore(REFERENCE_CONCURRENCY)
+
+    async def photo(pid: str, key: str | None) -> tuple[str | None, bool]:
+        if key and key in known:
+            return known[key], False
+        return await _resolve_photo(bot, pid, sem, upload_photos)
+
+    async def avatar(path: str, key: str) -> tuple[str | None, bool]:
+        if key in known:
+            return known[key], False
+        signed = await signing
+        return await _resolve_avatar(path, signed.get(path), sem)
+
+    try:
+        photo_results, avatar_results = await asyncio.gather(
+            asyncio.gather(*(photo(pid, key) for pid, key in zip(photos, photo_keys))),
+            asyncio.gather(*(avatar(path, key) for path, key in zip(avatar_paths, avatar_keys))),
+        )
+    finally:
+        if not signing.done():
+            signing.cancel()
+
+    image_urls: list[str] = []
+    telegram_urls_to_upload: list[str] = []
+    fresh: dict[str, str] = {}
+    for key, (url, pending_upload) in zip(photo_keys, photo_results):
+        if not url:
+            continue
+        image_urls.append(url)
+        if pending_upload:
+            telegram_urls_to_upload.append(url)
+        elif key and key not in known:
+            fresh[key] = url
+    for key, (url, is_r2) in zip(avatar_keys, avatar_results):
+        if not url:
+            continue
+        image_urls.append(url)
+        if is_r2 and key not in known:
+            fresh[key] = url
+
+    if fresh and _cache is not None:
+        try:
+            await _cache.set_many(fresh, REFERENCE_DEDUP_TTL_SECONDS)
+        except Exception:
+            _logger.debug("Reference dedup store failed", exc_info=True)
+    return image_urls, telegram_urls_to_upload
+
 
 class GenerateStates(StatesGroup):
     choosing_type = State()
@@ -92,7 +308,7 @@ def trigger_filter(message: Message) -> bool:
     StateFilter("*"),
     trigger_filter
 )
-async def restart_generate_any_state(message: Message, state: FSMContext) -> None:
+async def restart_generate_any_state(message: Message, state: FSMContext, user_ctx: UserContext | None = None) -> None:
     text = (message.text or "").strip()
     _logger.info("restart_generate_any_state triggered by text='%s'", text)
 
@@ -102,30 +318,32 @@ async def restart_generate_any_state(message: Message, state: FSMContext) -> Non
 
     if text in {t("ru", "kb.nanobanana_pro"), t("en", "kb.nanobanana_pro")}:
         assert _db is not None
-        balance = await _db.get_token_balance(message.from_user.id)
-        user = await _db.get_user(message.from_user.id) or {}
-        lang = normalize_lang(user.get("language_code") or message.from_user.language_code)
+        if user_ctx is None:
+            user_ctx = UserContext(_db, message.from_user)
+        balance = await user_ctx.balance()
+        lang = await user_ctx.lang()
         if balance < 10:
             await message.answer(t(lang, "gen.not_enough_tokens", balance=balance, required=10))
             return
-        await start_generate(message, state)
+        await start_generate(message, state, user_ctx)
         await state.update_data(preferred_model="nano-banana-pro")
         return
 
     if text in {t("ru", "kb.nanobanana_2"), t("en", "kb.nanobanana_2")}:
         assert _db is not None
-        balance = await _db.get_token_balance(message.from_user.id)
-        user = await _db.get_user(message.from_user.id) or {}
-        lang = normalize_lang(user.get("language_code") or message.from_user.language_code)
+        if user_ctx is None:
+            user_ctx = UserContext(_db, message.from_user)
+        balance = await user_ctx.balance()
+        lang = await user_ctx.lang()
         if balance < 5:
             await message.answer(t(lang, "gen.not_enough_tokens", balance=balance, required=5))
             return
-        await start_generate(message, state)
+        await start_generate(message, state, user_ctx)
         await state.update_data(preferred_model="nano-banana-2")
         return
 
     # Если пользователь был в Pro/NB2-режиме и начинает новую генерацию там же, сохраняем режим
-    await start_generate(message, state)
+    await start_generate(message, state, user_ctx)
     if saved_preferred_model in ("nano-banana-pro", "nano-banana-2"):
         await state.update_data(preferred_model=saved_preferred_model)
 
@@ -304,36 +522,30 @@ def avatar_multi_pick_keyboard(avatars: list[dict], selected_ids: list[str], lan
 
 
 @router.message(Command("generate"))
-async def start_generate(message: Message, state: FSMContext) -> None:
+async def start_generate(message: Message, state: FSMContext, user_ctx: UserContext | None = None) -> None:
     assert _client is not None and _db is not None
+    if user_ctx is None:
+        user_ctx = UserContext(_db, message.from_user)
     try:
-        bot_me = await message.bot.get_me()
+        bot_me = await message.bot.me()
         bot_name = getattr(bot_me, "username", None)
         if bot_name:
             await _db.ensure_bot_subscription(int(message.from_user.id), bot_name)
-            try:
-                _exists = await _db.has_bot_subscription(int(message.from_user.id), bot_name)
-                if not _exists:
-                    await _db.ensure_bot_subscription(int(message.from_user.id), bot_name)
-            except Exception:
-                pass
     except Exception:
         pass
 
     # Проверка токенов в Supabase (баланс хранится только там)
-    balance = await _db.get_token_balance(message.from_user.id)
+    balance = await user_ctx.balance()
     _logger.info("/generate start user=%s balance=%s", message.from_user.id, balance)
     if balance < 3:
-        user = await _db.get_user(message.from_user.id) or {}
-        lang = normalize_lang(user.get("language_code") or message.from_user.language_code)
+        lang = await user_ctx.lang()
         await message.answer(t(lang, "gen.not_enough_tokens", balance=balance, required=3))
         _logger.warning("User %s has insufficient balance (need 3)", message.from_user.id)
         return
 
     await state.clear()
     await state.set_state(GenerateStates.choosing_type)
-    user = await _db.get_user(message.from_user.id) or {}
-    lang = normalize_lang(user.get("language_code") or message.from_user.language_code)
+    lang = await user_ctx.lang()
     await state.update_data(user_id=message.from_user.id, lang=lang)
     
     # 1. Сброс клавиатуры (убираем кнопку "Повторить")
@@ -686,10 +898,13 @@ async def photo_count_callbacks(callback: CallbackQuery, state: FSMContext) -> N
 async def receive_photo(message: Message, state: FSMContext) -> None:
     # Handle both compressed photos and document photos
     photo_id = None
+    unique_id = None
     if message.photo:
         photo_id = message.photo[-1].file_id
+        unique_id = message.photo[-1].file_unique_id
     elif message.document and message.document.mime_type and message.document.mime_type.startswith("image/"):
         photo_id = message.document.file_id
+        unique_id = message.document.file_unique_id
 
     if not photo_id:
         # Not a valid photo, let other handlers handle it
@@ -698,9 +913,13 @@ async def receive_photo(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     photos = list(data.get("photos", []))
     photos_needed = int(data.get("photos_needed", 1))
+    # file_id → file_unique_id: ключ дедупликации уже загруженных в R2 референсов
+    photo_unique_ids = dict(data.get("photo_unique_ids") or {})
 
     photos.append(photo_id)
-    await state.update_data(photos=photos)
+    if unique_id:
+        photo_unique_ids[photo_id] = unique_id
+    await state.update_data(photos=photos, photo_unique_ids=photo_unique_ids)
     _logger.info("User %s sent photo %s/%s file_id=%s", message.from_user.id, len(photos), photos_needed, photo_id)
 
     if len(photos) < photos_needed:
@@ -979,70 +1198,17 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
     else:
         db_model = "nanobanana"
     
-    # Конвертация Telegram photo file_id → доступный URL (для edit-модели и сохранения в БД)
-    image_urls = []
-    telegram_urls_to_upload: list[str] = []
-    if len(photos) > 0:
-        for pid in photos:
-            try:
-                f = await callback.message.bot.get_file(pid)
-                # Предупреждение: это публичный URL с токеном — используйте только если доверяете провайдеру
-                tg_file_url = f"https://api.telegram.org/file/bot{callback.message.bot.token}/{f.file_path}"
-                
-                r2_url = None
-                if _r2:
-                    try:
-                        r2_url = await _r2.upload_file_from_url(tg_file_url)
-                        if r2_url:
-                            _logger.info("Sync R2 upload success: %s", r2_url)
-                    except Exception as e:
-                        _logger.warning("Sync R2 upload failed, fallback to TG URL: %s", e)
-                
-                if r2_url:
-                    image_urls.append(r2_url)
-                else:
-                    image_urls.append(tg_file_url)
-                    telegram_urls_to_upload.append(tg_file_url)
-            except Exception as e:
-                _logger.warning("Failed to fetch telegram file path for %s: %s", pid, e)
-    
+    # Конвертация Telegram photo file_id / аватаров → доступные URL (параллельно, порядок сохраняется)
+    avatar_paths: list[str] = []
     if avatar_path:
-        try:
-            signed = await _db.create_signed_url(avatar_path)
-            if signed:
-                avatar_url = signed
-                if _r2:
-                    try:
-                        r2_avatar_url = await _r2.upload_file_from_url(signed)
-                        if r2_avatar_url:
-                            avatar_url = r2_avatar_url
-                            _logger.info("Avatar R2 upload success: %s -> %s", avatar_path, r2_avatar_url)
-                    except Exception as e:
-                        _logger.warning("Avatar R2 upload failed for %s, fallback to signed URL: %s", avatar_path, e)
-                image_urls.append(avatar_url)
-        except Exception as e:
-            _logger.warning("Failed to sign avatar url: %s", e)
+        avatar_paths.append(avatar_path)
+    for av in st.get("selected_avatars") or []:
+        if av.get("file_path"):
+            avatar_paths.append(av["file_path"])
+    image_urls, telegram_urls_to_upload = await resolve_reference_urls(
+        callback.message.bot, photos, avatar_paths, photo_unique_ids=st.get("photo_unique_ids")
+    )
     
-    if st.get("selected_avatars"):
-        for av in st.get("selected_avatars"):
-            path = av.get("file_path")
-            if path:
-                try:
-                    signed = await _db.create_signed_url(path)
-                    if signed:
-                        avatar_url = signed
-                        if _r2:
-                            try:
-                                r2_avatar_url = await _r2.upload_file_from_url(signed)
-                                if r2_avatar_url:
-                                    avatar_url = r2_avatar_url
-                                    _logger.info("Avatar R2 upload success: %s -> %s", path, r2_avatar_url)
-                            except Exception as e:
-                                _logger.warning("Avatar R2 upload failed for %s, fallback to signed URL: %s", path, e)
-                        image_urls.append(avatar_url)
-                except Exception as e:
-                     _logger.warning("Failed to sign avatar url %s: %s", path, e)
-
     count_avatars = len(st.get("selected_avatars") or [])
     if avatar_path: count_avatars = 1
     
@@ -1055,6 +1221,22 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
     )
     gen_id = generation.get("id")
     _logger.info("Generation created id=%s user=%s type=%s ratio=%s photos=%s model=%s", gen_id, user_id, gen_type, ratio, len(photos), db_model)
+
+    # Резервируем токены до вызова провайдера: при неудаче вернём их (refund)
+    new_balance = await _reserve_tokens(user_id, int(gen_id), required_tokens)
+    if new_balance is None:
+        await _db.mark_generation_failed(gen_id, "insufficient balance")
+        balance = await _db.get_token_balance(user_id)
+        await callback.message.edit_text(t(lang, "gen.not_enough_tokens", balance=balance, required=required_tokens))
+        await state.clear()
+        await callback.answer()
+        _logger.warning("User %s insufficient balance at debit (need %s)", user_id, required_tokens)
+        return
+    _logger.info("Debited %s tokens: user=%s gen_id=%s balance=%s", required_tokens, user_id, gen_id, new_balance)
+    await _store_generation_context(
+        int(gen_id), user_id, lang, required_tokens,
+        model=db_model, ratio=ratio, resolution=st.get("resolution"), gen_type=gen_type,
+    )
     if gen_id is not None:
         await send_message_draft(
             callback.message.bot,
@@ -1098,6 +1280,7 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
                     "google_search": st.get("google_search", False),
                     "max_images": selected_photo_count if isinstance(selected_photo_count, int) else 1,
                     "photos": photos,
+                    "photo_unique_ids": st.get("photo_unique_ids") or {},
                     "avatar_file_path": st.get("avatar_file_path"),
                     "selected_avatars": st.get("selected_avatars", []),
                     "image_size": image_size,
@@ -1111,7 +1294,7 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
         
         # Запускаем фоновую задачу загрузки в R2
         if _r2 and telegram_urls_to_upload:
-             asyncio.create_task(upload_to_r2_and_update_db(int(gen_id), list(telegram_urls_to_upload), _r2, _db))
+            await _schedule_r2_upload(int(gen_id), list(telegram_urls_to_upload))
 
         # Для NanoBanana Pro/NB2 используем GenerationService
         if model == "nano-banana-pro" and _gen_service is not None:
@@ -1140,17 +1323,13 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
             # Сохраним провайдера в БД
             if gen_id is not None:
                 try:
-                    await _db.update_generation_provider(gen_id, result.get("provider", "kie"))
+                    await _db.update_generation_task(gen_id, result.get("provider", "kie"), result.get("task_id"))
                 except Exception:
                     pass
             
             # GenerationService возвращает awaiting_callback=True для async flow
             if result.get("awaiting_callback"):
                 _logger.info("Async generation accepted via %s: user=%s gen_id=%s", result.get("provider"), user_id, gen_id)
-                current_balance = await _db.get_token_balance(user_id)
-                new_balance = max(0, int(current_balance) - required_tokens)
-                await _db.set_token_balance(user_id, new_balance)
-                _logger.info("Debited %s tokens (async): user=%s balance %s->%s", required_tokens, user_id, current_balance, new_balance)
                 if gen_id is not None:
                     await send_message_draft(
                         callback.message.bot,
@@ -1181,13 +1360,9 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
     except Exception as e:
         msg = str(e)
         # Особый случай: провайдер принял задачу и пришлёт результат через callback
-        if "awaiting callback" in msg:
+        if isinstance(e, TaskAccepted):
             _logger.info("Async generation accepted: user=%s gen_id=%s", user_id, gen_id)
-            # Списание 3 токенов сразу после принятия задачи
-            current_balance = await _db.get_token_balance(user_id)
-            new_balance = max(0, int(current_balance) - required_tokens)
-            await _db.set_token_balance(user_id, new_balance)
-            _logger.info("Debited %s tokens (async): user=%s balance %s->%s", required_tokens, user_id, current_balance, new_balance)
+            await _track_accepted_task(gen_id, e)
             if gen_id is not None:
                 await send_message_draft(
                     callback.message.bot,
@@ -1202,6 +1377,7 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
 
         if gen_id is not None:
             await _db.mark_generation_failed(gen_id, str(e))
+            await _refund_tokens(user_id, int(gen_id), required_tokens)
             await send_message_draft(
                 callback.message.bot,
                 user_id,
@@ -1239,14 +1415,10 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer()
         return
 
-    # Списание 3 токенов и сохранение в Supabase (синхронный случай)
-    current_balance = await _db.get_token_balance(user_id)
-    new_balance = max(0, int(current_balance) - required_tokens)
-    await _db.set_token_balance(user_id, new_balance)
-    _logger.info("Debited %s tokens (sync): user=%s balance %s->%s", required_tokens, user_id, current_balance, new_balance)
-
+    # Токены уже списаны при создании генерации (синхронный случай)
     if gen_id is not None:
         await _db.mark_generation_completed(gen_id, image_url)
+        await schedule_output_mirror(int(gen_id), image_url)
 
     if gen_id is not None:
         await send_message_draft(
@@ -1265,23 +1437,8 @@ async def confirm(callback: CallbackQuery, state: FSMContext) -> None:
         if gen_id is not None
         else t(lang, "gen.result_caption")
     )
-    # Отправим изображение как документ (URLInputFile) для сохранения качества
-    try:
-        from urllib.parse import urlparse
-        filename = "image"
-        try:
-            path = urlparse(str(image_url)).path
-            if path:
-                base = path.rsplit("/", 1)[-1]
-                if base:
-                    filename = base
-        except Exception:
-            pass
-        file = URLInputFile(url=str(image_url), filename=filename)
-        await callback.message.answer_document(document=file, caption=result_caption, reply_markup=post_result_reply_keyboard(lang))
-    except Exception as e:
-        _logger.warning("Failed to send document, falling back to photo: %s", e)
-        await callback.message.answer_photo(photo=image_url, caption=result_caption, reply_markup=post_result_reply_keyboard(lang))
+    # Отправим изображение как документ для сохранения качества
+    await _send_result(callback, gen_id, image_url, result_caption, lang)
     if gen_id is not None:
         try:
             await callback.message.answer(
@@ -1303,44 +1460,115 @@ async def start_generate_text_new(message: Message, state: FSMContext) -> None:
     await start_generate(message, state)
 
 
+async def _upload_references_to_r2(generation_id: int, telegram_urls: list[str], r2_client: R2Client, db: Database) -> int:
+    """
+    Uploads Telegram reference images to R2 and stores the R2 URLs on the generation.
+    Returns the number of Telegram URLs that could not be uploaded.
+    """
+    r2_urls = []
+    updated = False
+    failed = 0
+    # Re-upload only Telegram URLs, all of them in one concurrent batch
+    tg_urls = [url for url in telegram_urls if "api.telegram.org" in url]
+    uploaded = dict(zip(tg_urls, await r2_client.upload_many(tg_urls)))
+    for url in telegram_urls:
+        r2_url = uploaded.get(url)
+        if r2_url:
+            r2_urls.append(r2_url)
+            updated = True
+            _logger.info("Async R2 upload success: %s -> %s", url, r2_url)
+        else:
+            if url in uploaded:
+                failed += 1
+                _logger.warning("Async R2 upload failed for %s", url)
+            r2_urls.append(url) # Keep original if failed
+
+    if updated:
+        await db.update_generation_input_images(generation_id, r2_urls)
+        _logger.info("Updated generation %s with R2 URLs", generation_id)
+    return failed
+
+
 async def upload_to_r2_and_update_db(generation_id: int, telegram_urls: list[str], r2_client: R2Client, db: Database) -> None:
     """
     Background task to upload images to R2 and update the database.
     """
     try:
-        r2_urls = []
-        updated = False
-        for url in telegram_urls:
-            # Check if it's a Telegram URL (we only want to re-upload those)
-            if "api.telegram.org" in url:
-                r2_url = await r2_client.upload_file_from_url(url)
-                if r2_url:
-                    r2_urls.append(r2_url)
-                    updated = True
-                    _logger.info("Async R2 upload success: %s -> %s", url, r2_url)
-                else:
-                    r2_urls.append(url) # Keep original if failed
-                    _logger.warning("Async R2 upload failed for %s", url)
-            else:
-                r2_urls.append(url)
-        
-        if updated:
-            await db.update_generation_input_images(generation_id, r2_urls)
-            _logger.info("Updated generation %s with R2 URLs", generation_id)
-            
+        await _upload_references_to_r2(generation_id, telegram_urls, r2_client, db)
     except Exception as e:
         _logger.error("Error in async R2 upload task for gen %s: %s", generation_id, e)
 
 
+async def _r2_upload_job(payload: dict) -> None:
+    """Job: R2 re-upload of reference images; retried by the queue while any upload fails."""
+    assert _r2 is not None and _db is not None
+    failed = await _upload_references_to_r2(int(payload["generation_id"]), list(payload["urls"]), _r2, _db)
+    if failed:
+        raise RuntimeError(f"{failed} reference uploads to R2 failed")
+
+
+async def _schedule_r2_upload(gen_id: int, telegram_urls: list[str]) -> None:
+    """Durable job when the queue is available, otherwise a fire-and-forget task."""
+    if _jobs is not None:
+        try:
+            await _jobs.enqueue(R2_UPLOAD_JOB, {"generation_id": gen_id, "urls": telegram_urls}, job_id=f"r2:{gen_id}")
+            return
+        except Exception:
+            _logger.warning("Failed to enqueue R2 upload for gen %s, uploading in background", gen_id, exc_info=True)
+    asyncio.create_task(upload_to_r2_and_update_db(gen_id, telegram_urls, _r2, _db))
+
+
+async def _mirror_output_to_r2(generation_id: int, image_url: str) -> None:
+    """Копия результата в R2 (ключ по хэшу содержимого); image_url генерации → CDN URL."""
+    assert _r2 is not None and _db is not None
+    r2_url = await _r2.mirror_from_url(image_url)
+    if not r2_url:
+        raise RuntimeError(f"R2 mirror of generation {generation_id} output failed")
+    await _db.update_generation_image_url(generation_id, r2_url)
+    _logger.info("Mirrored output of generation %s to R2: %s", generation_id, r2_url)
+
+
+async def _r2_mirror_job(payload: dict) -> None:
+    """Job: output mirroring; retried by the queue while the provider URL is still reachable."""
+    try:
+        await _mirror_output_to_r2(int(payload["generation_id"]), str(payload["url"]))
+    except SourceGone as e:
+        raise PermanentJobError(f"output URL expired: {e}") from e
+
+
+async def schedule_output_mirror(gen_id: int, image_url: str) -> None:
+    """
+    Mirrors a completed generation's output to R2: provider URLs expire, history and
+    deep links should not. Durable job when the queue is available.
+    """
+    if _r2 is None or _db is None or not image_url or _r2.is_public_url(image_url):
+        return
+    if _jobs is not None:
+        try:
+            await _jobs.enqueue(R2_MIRROR_JOB, {"generation_id": gen_id, "url": image_url}, job_id=f"mirror:{gen_id}")
+            return
+        except Exception:
+            _logger.warning("Failed to enqueue output mirror for gen %s, mirroring in background", gen_id, exc_info=True)
+    asyncio.create_task(_mirror_output_background(gen_id, image_url))
+
+
+async def _mirror_output_background(gen_id: int, image_url: str) -> None:
+    try:
+        await _mirror_output_to_r2(gen_id, image_url)
+    except Exception as e:
+        _logger.error("Error in output mirror task for gen %s: %s", gen_id, e)
+
+
 
 
 # Повтор последнего запроса генерации (любой тип, включая фото) из кеша
 @router.message((F.text == t("ru", "kb.repeat_generation")) | (F.text == t("en", "kb.repeat_generation")))
-async def repeat_last_generation(message: Message, state: FSMContext) -> None:
+async def repeat_last_generation(message: Message, state: FSMContext, user_ctx: UserContext | None = None) -> None:
     assert _client is not None and _db is not None
-    user_id = int(message.from_user.id)
-    user = await _db.get_user(user_id) or {}
-    lang = normalize_lang(user.get("language_code") or message.from_user.language_code)
+    if user_ctx is None:
+        user_ctx = UserContext(_db, message.from_user)
+    user_id = user_ctx.user_id
+    lang = await user_ctx.lang()
     pass
     origin_gen_id: int | None = None
     payload: dict | None = None
@@ -1449,17 +1677,18 @@ async def confirm_repeat(callback: CallbackQuery, state: FSMContext) -> None:
             _logger.warning("Failed to fetch origin generation %s: %s", origin_gen_id, e)
 
     if photos and not r2_urls_reused:
-        for pid in photos:
-            try:
-                f = await callback.message.bot.get_file(pid)
-                # Получаем временную ссылку от Telegram
-                tg_file_url = f"https://api.telegram.org/file/bot{callback.message.bot.token}/{f.file_path}"
-                image_urls.append(tg_file_url)
-                telegram_urls_to_upload.append(tg_file_url)
-            except Exception as e:
-                _logger.warning("Failed to fetch telegram file path for %s: %s", pid, e)
+        # Получаем временные ссылки от Telegram параллельно; в R2 они уйдут фоновой задачей
+        image_urls, telegram_urls_to_upload = await resolve_reference_urls(
+            callback.message.bot,
+            photos,
+            [],
+            upload_photos=False,
+            photo_unique_ids=payload.get("photo_unique_ids"),
+        )
 
     # Создаем запись в БД
+    gen_id = None
+    reserved = False
     try:
         gen = await _db.create_generation(
             user_id=user_id,
@@ -1470,6 +1699,20 @@ async def confirm_repeat(callback: CallbackQuery, state: FSMContext) -> None:
         )
         gen_id = gen.get("id")
         _logger.info("Repeat generation created id=%s user=%s type=%s ratio=%s photos=%s", gen_id, user_id, gen_type, ratio_val, len(photos))
+        new_balance = await _reserve_tokens(user_id, int(gen_id), required_tokens)
+        if new_balance is None:
+            await _db.mark_generation_failed(gen_id, "insufficient balance")
+            balance = await _db.get_token_balance(user_id)
+            await callback.message.edit_text(t(lang, "gen.not_enough_tokens", balance=balance, required=required_tokens))
+            await state.clear()
+            await callback.answer()
+            return
+        reserved = True
+        _logger.info("Debited %s tokens (repeat): user=%s gen_id=%s balance=%s", required_tokens, user_id, gen_id, new_balance)
+        await _store_generation_context(
+            int(gen_id), user_id, lang, required_tokens,
+            model=db_model, ratio=ratio_val, resolution=payload.get("resolution"), gen_type=gen_type,
+        )
         if gen_id is not None:
             await send_message_draft(
                 callback.message.bot,
@@ -1499,7 +1742,7 @@ async def confirm_repeat(callback: CallbackQuery, state: FSMContext) -> None:
 
         # Запускаем фоновую задачу загрузки в R2
         if _r2 and telegram_urls_to_upload:
-             asyncio.create_task(upload_to_r2_and_update_db(int(gen_id), list(telegram_urls_to_upload), _r2, _db))
+            await _schedule_r2_upload(int(gen_id), list(telegram_urls_to_upload))
 
         # Для NanoBanana Pro/NB2 используем GenerationService
         if model == "nano-banana-pro" and _gen_service is not None:
@@ -1528,21 +1771,12 @@ async def confirm_repeat(callback: CallbackQuery, state: FSMContext) -> None:
             # Сохраним провайдера в БД
             if gen_id is not None:
                 try:
-                    await _db.update_generation_provider(gen_id, result.get("provider", "kie"))
+                    await _db.update_generation_task(gen_id, result.get("provider", "kie"), result.get("task_id"))
                 except Exception:
                     pass
             # GenerationService возвращает awaiting_callback=True для async flow
             if result.get("awaiting_callback"):
-                current_balance = await _db.get_token_balance(user_id)
-                new_balance = max(0, int(current_balance) - required_tokens)
-                await _db.set_token_balance(user_id, new_balance)
-                _logger.info(
-                    "Debited %s tokens (async repeat): user=%s balance %s->%s",
-                    required_tokens,
-                    user_id,
-                    current_balance,
-                    new_balance,
-                )
+                _logger.info("Async repeat accepted via %s: user=%s gen_id=%s", result.get("provider"), user_id, gen_id)
                 if gen_id is not None:
                     await send_message_draft(
                         callback.message.bot,
@@ -1570,11 +1804,9 @@ async def confirm_repeat(callback: CallbackQuery, state: FSMContext) -> None:
             )
     except Exception as e:
         msg = str(e)
-        if "awaiting callback" in msg:
-            current_balance = await _db.get_token_balance(user_id)
-            new_balance = max(0, int(current_balance) - required_tokens)
-            await _db.set_token_balance(user_id, new_balance)
-            _logger.info("Debited %s tokens (async repeat): user=%s balance %s->%s", required_tokens, user_id, current_balance, new_balance)
+        if isinstance(e, TaskAccepted):
+            _logger.info("Async repeat accepted: user=%s gen_id=%s", user_id, gen_id)
+            await _track_accepted_task(gen_id, e)
             if gen_id is not None:
                 await send_message_draft(
                     callback.message.bot,
@@ -1588,6 +1820,8 @@ async def confirm_repeat(callback: CallbackQuery, state: FSMContext) -> None:
             return
         if gen_id is not None:
             await _db.mark_generation_failed(gen_id, str(e))
+            if reserved:
+                await _refund_tokens(user_id, int(gen_id), required_tokens)
             await send_message_draft(
                 callback.message.bot,
                 user_id,
@@ -1599,12 +1833,9 @@ async def confirm_repeat(callback: CallbackQuery, state: FSMContext) -> None:
         await state.clear()
         await callback.answer()
         return
-    current_balance = await _db.get_token_balance(user_id)
-    new_balance = max(0, int(current_balance) - required_tokens)
-    await _db.set_token_balance(user_id, new_balance)
-    _logger.info("Debited %s tokens (sync repeat): user=%s balance %s->%s", required_tokens, user_id, current_balance, new_balance)
     if gen_id is not None:
         await _db.mark_generation_completed(gen_id, image_url)
+        await schedule_output_mirror(int(gen_id), image_url)
         await send_message_draft(
             callback.message.bot,
             user_id,
@@ -1621,22 +1852,7 @@ async def confirm_repeat(callback: CallbackQuery, state: FSMContext) -> None:
         if gen_id is not None
         else t(lang, "gen.result_caption")
     )
-    try:
-        from urllib.parse import urlparse
-        filename = "image"
-        try:
-            path = urlparse(str(image_url)).path
-            if path:
-                base = path.rsplit("/", 1)[-1]
-                if base:
-                    filename = base
-        except Exception:
-            pass
-        file = URLInputFile(url=str(image_url), filename=filename)
-        await callback.message.answer_document(document=file, caption=result_caption, reply_markup=post_result_reply_keyboard(lang))
-    except Exception as e_doc:
-        _logger.warning("Failed to send document, falling back to photo: %s", e_doc)
-        await callback.message.answer_photo(photo=image_url, caption=result_caption, reply_markup=post_result_reply_keyboard(lang))
+    await _send_result(callback, gen_id, image_url, result_caption, lang)
     if gen_id is not None:
         try:
             await callback.message.answer(
@@ -3,6 +3,7 @@ from aiogram.filters import Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 
 from ..database import Database
+from ..middlewares.user_context import UserContext
 from ..utils.i18n import t, normalize_lang
 
 
@@ -18,19 +19,51 @@ def setup(database: Database) -> None:
 
 from .start import get_main_keyboard
 
+
+async def _history_block(lang: str, user_id: int, limit: int = 5) -> str:
+    """Последние движения токенов из token_ledger (пусто, если истории нет или запрос не удался)."""
+    assert _db is not None
+    try:
+        entries = await _db.get_ledger_history(user_id, limit=limit)
+    except Exception:
+        return ""
+    if not entries:
+        return ""
+    lines = [t(lang, "profile.history_title")]
+    for e in entries:
+        delta = int(e.get("delta") or 0)
+        reason = str(e.get("reason") or "")
+        reason_key = f"ledger.reason.{reason}"
+        label = t(lang, reason_key)
+        lines.append(
+            t(
+                lang,
+                "profile.history_item",
+                sign="+" if delta > 0 else "−",
+                amount=abs(delta),
+                reason=reason if label == reason_key else label,
+                date=str(e.get("created_at") or "")[:10],
+            )
+        )
+    return "\n".join(lines) + "\n\n"
+
 @router.message(Command("profile"))
-async def profile(message: Message) -> None:
+async def profile(message: Message, user_ctx: UserContext | None = None) -> None:
     assert _db is not None
+    if user_ctx is None:
+        user_ctx = UserContext(_db, message.from_user)
 
-    user = await _db.get_or_create_user(
-        user_id=message.from_user.id,
-        username=message.from_user.username,
-        first_name=message.from_user.first_name,
-        last_name=message.from_user.last_name,
-        language_code=message.from_user.language_code,
-    )
+    user = await user_ctx.row()
+    if not user:
+        user = await _db.get_or_create_user(
+            user_id=message.from_user.id,
+            username=message.from_user.username,
+            first_name=message.from_user.first_name,
+            last_name=message.from_user.last_name,
+            language_code=message.from_user.language_code,
+        )
 
-    balance = await _db.get_token_balance(message.from_user.id)
+    balance = int(user.get("balance") or 0)
 
     username = user.get("username")
     first_name = user.get("first_name")
@@ -42,6 +75,7 @@ async def profile(message: Message) -> None:
 
     lang = normalize_lang(user.get("language_code") or message.from_user.language_code)
     keyboard = get_main_keyboard(lang)
+    history = await _history_block(lang, message.from_user.id)
 
     await message.answer(
         (
@@ -51,6 +85,7 @@ async def profile(message: Message) -> None:
             f"{t(lang, 'profile.id', id=message.from_user.id)}\n"
             f"{t(lang, 'profile.lang', lang_code=language_code or '—')}\n\n"
             f"{t(lang, 'profile.balance', balance=balance)}\n\n"
+            f"{history}"
             f"{t(lang, 'profile.actions')}"
         ),
         reply_markup=keyboard,
@@ -58,10 +93,10 @@ async def profile(message: Message) -> None:
 
 
 @router.message((F.text == t("ru", "kb.profile")) | (F.text == t("en", "kb.profile")))
-async def profile_text(message: Message) -> None:
-    await profile(message)
+async def profile_text(message: Message, user_ctx: UserContext | None = None) -> None:
+    await profile(message, user_ctx)
 
 # Дополнительный fallback, если текст кнопки отличается или содержит лишние символы/эмодзи
 @router.message(F.text.regexp(r"(?i)^\s*\/?\s*(Профиль|Profile).*$"))
-async def profile_text_fallback(message: Message) -> None:
-    await profile(message)
\ No newline at end of file
+async def profile_text_fallback(message: Message, user_ctx: UserContext | None = None) -> None:
+    await profile(message, user_ctx)
\ No newline at end of file
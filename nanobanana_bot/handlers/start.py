@@ -5,6 +5,7 @@ from aiogram.fsm.context import FSMContext
 import re
 
 from ..database import Database
+from ..middlewares.user_context import UserContext
 from ..utils.i18n import t, normalize_lang
 
 
@@ -49,8 +50,10 @@ def get_main_keyboard(lang: str) -> ReplyKeyboardMarkup:
 
 
 @router.message(CommandStart())
-async def start(message: Message, state: FSMContext) -> None:
+async def start(message: Message, state: FSMContext, user_ctx: UserContext | None = None) -> None:
     assert _db is not None
+    if user_ctx is None:
+        user_ctx = UserContext(_db, message.from_user)
     ref_value = None
     gen_id = None
     try:
@@ -62,7 +65,8 @@ async def start(message: Message, state: FSMContext) -> None:
     except Exception:
         ref_value = None
     try:
-        bot_me = await message.bot.get_me()
+        # Bot.me() caches getMe for the lifetime of the bot object
+        bot_me = await message.bot.me()
         bot_name = getattr(bot_me, "username", None)
         if bot_name:
             await _db.ensure_bot_subscription(int(message.from_user.id), bot_name)
@@ -86,31 +90,29 @@ async def start(message: Message, state: FSMContext) -> None:
                 tag = ref_part[4:].lstrip("@").strip()
                 safe = "".join(ch for ch in tag if ch.isalnum() or ch in {"_", "-"})
                 if safe:
-                    user = await _db.get_user(message.from_user.id)
-                    if not user:
+                    if not await user_ctx.exists():
                         await _db.upsert_user_ref(message.from_user.id, safe)
-                    elif not user.get("ref"):
+                    elif not await user_ctx.ref():
                         await _db.set_ref(message.from_user.id, safe)
     except Exception:
         pass
     # Если пользователя нет в базе — это первый запуск: автоматическая регистрация с языком пользователя (fallback to en)
-    existing = await _db.get_user(message.from_user.id)
+    existing = await user_ctx.row()
     if not existing:
         lang_code = message.from_user.language_code or "en"
         lang_code = "ru" if lang_code.lower().startswith("ru") else "en"
         
-        await _db.get_or_create_user(
+        existing = await _db.get_or_create_user(
             user_id=message.from_user.id,
             username=message.from_user.username,
             first_name=message.from_user.first_name,
             last_name=message.from_user.last_name,
             language_code=lang_code,
         )
-        existing = await _db.get_user(message.from_user.id) or {}
 
     # Иначе — обычное приветствие с уже выбранным языком
     lang = normalize_lang(existing.get("language_code") or message.from_user.language_code)
-    balance = await _db.get_token_balance(message.from_user.id)
+    balance = int(existing.get("balance") or 0)
 
     # Если передан gen_id, переходим к FSM генерации
     if gen_id is not None:
@@ -140,7 +142,15 @@ async def start(message: Message, state: FSMContext) -> None:
             }
             
             await state.update_data(**update_kwargs)
-            
+
+            # Результат исходной генерации: по сохранённому file_id, без повторной загрузки
+            file_id = generation_data.get("tg_file_id")
+            if file_id and generation_data.get("status") == "completed":
+                try:
+                    await message.answer_document(document=file_id)
+                except Exception:
+                    pass
+
             avatars = await _db.list_avatars(message.from_user.id)
             if avatars:
                 await state.set_state("GenerateStates:choosing_avatar")
@@ -213,6 +223,6 @@ async def set_lang(callback: CallbackQuery) -> None:
 
 # Обработка текстовой кнопки "Старт ⏮️" из ReplyKeyboard
 @router.message(F.text.casefold().in_({"старт ⏮️", "start ⏮️"}))
-async def start_button(message: Message) -> None:
+async def start_button(message: Message, state: FSMContext, user_ctx: UserContext | None = None) -> None:
     # Переиспользуем основной хэндлер /start
-    await start(message)
+    await start(message, state, user_ctx)
@@ -488,9 +488,9 @@ async def process_successful_payment(message: Message) -> None:
         return
 
     amount = int(sp.total_amount)
-    current = await db.get_token_balance(user_id)
-    new_balance = current + amount
-    await db.set_token_balance(user_id, new_balance)
+    new_balance = await db.adjust_balance(
+        user_id, amount, "topup_stars", f"stars:{sp.telegram_payment_charge_id}"
+    )
 
     user = await db.get_user(user_id) or {}
     lang = normalize_lang(user.get("language_code") or _message_lang_hint(message))
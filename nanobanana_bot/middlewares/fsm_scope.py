@@ -0,0 +1,23 @@
+from typing import Any, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from ..fsm_storage import RedisFSMStorage
+
+
+class FSMScopeMiddleware(BaseMiddleware):
+    """Opens a per-update read cache on RedisFSMStorage (register as update outer middleware)."""
+
+    def __init__(self, storage: RedisFSMStorage) -> None:
+        super().__init__()
+        self.storage = storage
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Any],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        with self.storage.scope():
+            return await handler(event, data)
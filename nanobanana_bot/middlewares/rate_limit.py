@@ -1,15 +1,154 @@
+import logging
 import time
-from typing import Any, Callable, Dict
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Mapping, Optional
 
 from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject
+from aiogram.types import TelegramObject, Message, CallbackQuery
+import redis.asyncio as redis
+
+
+@dataclass(frozen=True)
+class RouteBudget:
+    # Minimal average interval between events and how many may arrive back-to-back
+    interval_seconds: float
+    burst: int = 1
+    # How long an allow/deny decision from Redis may be reused locally (0 = always ask Redis)
+    local_ttl_seconds: float = 0.0
+
+
+DEFAULT_BUDGETS: Dict[str, RouteBudget] = {
+    # confirm:* spends tokens — strict and always checked in Redis
+    "confirm": RouteBudget(interval_seconds=3.0, burst=1),
+    # Menu navigation via inline buttons — looser, may be decided locally for a moment
+    "callback": RouteBudget(interval_seconds=0.5, burst=4, local_ttl_seconds=1.0),
+    "message": RouteBudget(interval_seconds=1.0, burst=1),
+}
+
+
+# GCRA: KEYS[1] - TAT key; ARGV[1] - interval ms, ARGV[2] - burst, ARGV[3] - events admitted
+# locally since the last sync (accounted before checking the current one).
+# Returns {allowed, retry_after_ms, tat_ms, now_ms}; time comes from Redis so replicas agree.
+GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local pending = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+tat = tat + pending * interval
+local allow_at = tat - (burst - 1) * interval
+if now < allow_at then
+  if pending > 0 then redis.call('SET', KEYS[1], tat, 'PX', tat - now + 1) end
+  return {0, allow_at - now, tat, now}
+end
+tat = tat + interval
+redis.call('SET', KEYS[1], tat, 'PX', tat - now + 1)
+return {1, 0, tat, now}
+"""
+
+
+class _LocalEntry:
+    __slots__ = ("tat_ms", "server_now_ms", "synced_at", "pending", "denied_until")
+
+    def __init__(self, tat_ms: float, server_now_ms: float, synced_at: float, denied_until: float = 0.0):
+        self.tat_ms = tat_ms
+        self.server_now_ms = server_now_ms
+        self.synced_at = synced_at
+        self.pending = 0
+        self.denied_until = denied_until
 
 
 class RateLimitMiddleware(BaseMiddleware):
-    def __init__(self, min_interval_seconds: float = 1.0) -> None:
+    """
+    Distributed per-user rate limit (GCRA in Redis, one Lua call per check).
+
+    A bounded LRU front-cache keeps the last Redis decision per user/route:
+    denials are reused until their retry time, and routes with local_ttl_seconds
+    may admit events locally; such events are reported on the next Redis sync.
+    Fails open if Redis is unavailable.
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        budgets: Optional[Mapping[str, RouteBudget]] = None,
+        local_cache_size: int = 10_000,
+        prefix: str = "nrl",
+    ) -> None:
         super().__init__()
-        self.min_interval = float(min_interval_seconds)
-        self._last_seen: Dict[int, float] = {}
+        self._redis = redis_client
+        self._script = redis_client.register_script(GCRA_SCRIPT)
+        self.budgets: Dict[str, RouteBudget] = dict(DEFAULT_BUDGETS if budgets is None else budgets)
+        self._local: "OrderedDict[tuple[str, int], _LocalEntry]" = OrderedDict()
+        self._local_cache_size = int(local_cache_size)
+        self._prefix = prefix
+        self._logger = logging.getLogger("nanobanana.rate_limit")
+
+    @staticmethod
+    def route_for(event: TelegramObject) -> Optional[str]:
+        if isinstance(event, CallbackQuery):
+            if (event.data or "").startswith("confirm:"):
+                return "confirm"
+            return "callback"
+        if isinstance(event, Message):
+            return "message"
+        return None
+
+    def _remember(self, key: tuple[str, int], entry: _LocalEntry) -> None:
+        self._local[key] = entry
+        self._local.move_to_end(key)
+        while len(self._local) > self._local_cache_size:
+            self._local.popitem(last=False)
+
+    def _check_local(self, key: tuple[str, int], budget: RouteBudget, now: float) -> Optional[bool]:
+        """Returns a decision if the front-cache can answer, otherwise None."""
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        self._local.move_to_end(key)
+        if entry.denied_until > now:
+            return False
+        if budget.local_ttl_seconds <= 0 or now - entry.synced_at > budget.local_ttl_seconds:
+            return None
+        interval_ms = budget.interval_seconds * 1000
+        server_now = entry.server_now_ms + (now - entry.synced_at) * 1000
+        tat = max(entry.tat_ms, server_now)
+        if server_now < tat - (budget.burst - 1) * interval_ms:
+            # Not enough headroom locally — let Redis decide
+            return None
+        entry.tat_ms = tat + interval_ms
+        entry.pending += 1
+        return True
+
+    async def is_allowed(self, route: str, user_id: int) -> bool:
+        budget = self.budgets.get(route)
+        if budget is None:
+            return True
+        key = (route, int(user_id))
+        now = time.monotonic()
+        local = self._check_local(key, budget, now)
+        if local is not None:
+            return local
+
+        previous = self._local.get(key)
+        pending = previous.pending if previous is not None else 0
+        try:
+            allowed, retry_ms, tat_ms, server_now_ms = await self._script(
+                keys=[f"{self._prefix}:{route}:{int(user_id)}"],
+                args=[int(budget.interval_seconds * 1000), int(budget.burst), int(pending)],
+            )
+        except Exception:
+            self._logger.debug("Rate limit check failed, allowing event", exc_info=True)
+            return True
+
+        entry = _LocalEntry(float(tat_ms), float(server_now_ms), now)
+        if not int(allowed):
+            entry.denied_until = now + float(retry_ms) / 1000
+        self._remember(key, entry)
+        return bool(int(allowed))
 
     async def __call__(
         self,
@@ -18,11 +157,9 @@ class RateLimitMiddleware(BaseMiddleware):
         data: Dict[str, Any],
     ) -> Any:
         user = data.get("event_from_user")
-        if user is not None:
-            now = time.monotonic()
-            last = self._last_seen.get(user.id, 0.0)
-            if now - last < self.min_interval:
+        route = self.route_for(event)
+        if user is not None and route is not None:
+            if not await self.is_allowed(route, user.id):
                 # Silently drop or you could respond with a message
                 return
-            self._last_seen[user.id] = now
-        return await handler(event, data)
\ No newline at end of file
+        return await handler(event, data)
@@ -0,0 +1,62 @@
+from typing import Any, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from ..database import Database
+from ..utils.i18n import normalize_lang
+
+
+class UserContext:
+    """
+    Per-update view of the sender's users row (language, balance, ref).
+
+    The row is fetched lazily on first access and shared with every
+    Database.get_user/get_token_balance call made while handling the update.
+    """
+
+    def __init__(self, db: Database, tg_user: User) -> None:
+        self._db = db
+        self.tg_user = tg_user
+        self.user_id = int(tg_user.id)
+
+    async def row(self) -> Optional[Dict[str, Any]]:
+        return await self._db.get_user(self.user_id)
+
+    async def exists(self) -> bool:
+        return await self.row() is not None
+
+    async def lang(self) -> str:
+        row = await self.row() or {}
+        return normalize_lang(row.get("language_code") or self.tg_user.language_code)
+
+    async def balance(self) -> int:
+        row = await self.row() or {}
+        return int(row.get("balance") or 0)
+
+    async def ref(self) -> Optional[str]:
+        row = await self.row() or {}
+        return row.get("ref") or None
+
+
+class UserRowMiddleware(BaseMiddleware):
+    """
+    Opens Database.user_scope() for each update and injects `user_ctx`
+    (register as update outer middleware, after aiogram's own user context).
+    """
+
+    def __init__(self, db: Database) -> None:
+        super().__init__()
+        self.db = db
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Any],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        with self.db.user_scope():
+            user = data.get("event_from_user")
+            if user is not None:
+                data["user_ctx"] = UserContext(self.db, user)
+            return await handler(event, data)
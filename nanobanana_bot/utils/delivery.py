@@ -0,0 +1,119 @@
+"""
+Delivery - отправка результата генерации пользователю в Telegram.
+Файл провайдера стримится в загрузку Telegram один раз через общий пул HTTP,
+а полученный file_id сохраняется: повторная отправка не загружает байты заново.
+"""
+
+import logging
+import os
+from typing import Any, AsyncGenerator, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from aiogram import Bot
+from aiogram.types import InputFile
+
+from ..cache import Cache
+from ..database import Database
+from .http import HttpSessionManager, session_scope
+
+
+READ_CHUNK_SIZE = 64 * 1024
+
+_logger = logging.getLogger("nanobanana.delivery")
+
+
+def result_filename(url: str, default: str = "image") -> str:
+    """Last path segment of the URL (query tokens/signatures ignored)."""
+    try:
+        base = os.path.basename(urlparse(str(url)).path)
+    except Exception:
+        return default
+    return base or default
+
+
+class PooledURLInputFile(InputFile):
+    """Like aiogram's URLInputFile, but downloads through the shared aiohttp pool."""
+
+    def __init__(
+        self,
+        url: str,
+        http: Optional[HttpSessionManager] = None,
+        filename: Optional[str] = None,
+        chunk_size: int = READ_CHUNK_SIZE,
+        timeout: float = 60.0,
+    ):
+        super().__init__(filename=filename or result_filename(url), chunk_size=chunk_size)
+        self.url = url
+        self.http = http
+        self.timeout = float(timeout)
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        async with session_scope(self.http) as session:
+            async with session.get(self.url, timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    yield chunk
+
+
+class ResultDelivery:
+    """
+    Sends a generation result as a document (original quality, no Telegram recompression).
+
+    A known Telegram file_id is sent as is. Otherwise the provider URL is streamed once into
+    the upload and the document's file_id is stored on the generation (generations.tg_file_id
+    and the Redis generation context), so a later re-send costs no upload. If the document
+    upload fails, Telegram is asked to fetch the URL as a photo (the previous behaviour).
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        cache: Optional[Cache] = None,
+        http: Optional[HttpSessionManager] = None,
+        timeout: float = 60.0,
+    ):
+        self.db = db
+        self.cache = cache
+        self.http = http
+        self.timeout = float(timeout)
+
+    async def send(
+        self,
+        bot: Bot,
+        chat_id: int,
+        generation_id: Optional[int],
+        image_url: str,
+        caption: Optional[str] = None,
+        reply_markup: Any = None,
+        file_id: Optional[str] = None,
+    ) -> Optional[str]:
+        """Delivers the result; returns the document's file_id (None if it went out as a photo)."""
+        if file_id:
+            try:
+                await bot.send_document(chat_id=chat_id, document=file_id, caption=caption, reply_markup=reply_markup)
+                return file_id
+            except Exception as e:
+                _logger.warning("Stored file_id rejected for generation %s, uploading again: %s", generation_id, e)
+        try:
+            file = PooledURLInputFile(str(image_url), http=self.http, timeout=self.timeout)
+            message = await bot.send_document(chat_id=chat_id, document=file, caption=caption, reply_markup=reply_markup)
+        except Exception as e_doc:
+            _logger.warning("Failed to send as document, fallback to photo: %s", e_doc)
+            await bot.send_photo(chat_id=chat_id, photo=str(image_url), caption=caption, reply_markup=reply_markup)
+            return None
+        new_file_id = message.document.file_id if message.document else None
+        if new_file_id and generation_id is not None:
+            await self._remember(int(generation_id), new_file_id)
+        return new_file_id
+
+    async def _remember(self, generation_id: int, file_id: str) -> None:
+        try:
+            await self.db.set_generation_file_id(generation_id, file_id)
+        except Exception as e:
+            _logger.warning("Failed to store file_id for generation %s: %s", generation_id, e)
+        if self.cache is not None:
+            try:
+                await self.cache.set_generation_context(generation_id, {"tg_file_id": file_id})
+            except Exception:
+                _logger.debug("Failed to cache file_id for generation %s", generation_id, exc_info=True)
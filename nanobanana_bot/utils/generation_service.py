@@ -3,33 +3,25 @@ Generation Service - Сервис генерации с fallback логикой.
 Управляет переключением между провайдерами (Kie.ai и Piapi).
 """
 
+import asyncio
 import logging
+import time
+from collections import Counter
 from typing import Optional, List, Dict, Any, Literal
 
+import aiohttp
+
+from ..cache import Cache
 from .nanobanana import NanoBananaClient
 from .piapi import PiapiClient
+from .provider_errors import ProviderError, ProvidersExhausted, TaskAccepted, classify
+from .provider_health import ProviderHealth
+from .task_poller import TaskPoller
 
 
 ApiProvider = Literal["kie", "piapi"]
 
 
-# Ошибки, при которых нужно переключиться на резервный провайдер
-FALLBACK_ERROR_PATTERNS = [
-    "503", "502", "500", "524",  # Service unavailable
-    "401", "403", "access", "permission", "unauthorized",  # Auth errors (expired/invalid key)
-    "429", "too many requests", "rate limit",  # Rate limiting
-    "timeout", "econnrefused", "connection refused",  # Network errors
-    "temporarily unavailable",
-    "currently unavailable",  # KIE "Service is currently unavailable" (E003)
-    "internal error",
-    "internal server error",
-    "ai studio api http error",
-    "service unavailable",
-    "no channel found",  # KIE infrastructure error (no processing channel)
-    "high demand",  # KIE overload error
-]
-
-
 class GenerationService:
     """
     Service that handles NanoBanana Pro generation with fallback between providers.
@@ -43,10 +35,26 @@ class GenerationService:
         kie_client: NanoBananaClient,
         piapi_client: PiapiClient,
         db: Any,  # Database instance
+        health: Optional[ProviderHealth] = None,
+        cache: Optional[Cache] = None,
+        hedge_percentile: float = 0,
+        hedge_max_delay_seconds: float = 8.0,
+        poller: Optional[TaskPoller] = None,
     ):
         self.kie = kie_client
         self.piapi = piapi_client
         self.db = db
+        # Shared circuit breaker; None disables health-based routing
+        self.health = health
+        # Hedging (Pro only): if the primary has not accepted the task within this percentile
+        # of its recent latency, the backup is started too. 0 disables; needs health and cache.
+        self.cache = cache
+        self.hedge_percentile = hedge_percentile
+        self.hedge_max_delay_seconds = hedge_max_delay_seconds
+        # Status poller for accepted tasks whose callback may be lost
+        self.poller = poller
+        # (provider, cause) -> number of fallbacks since start, cause = ProviderError.cause
+        self.fallback_causes: Counter = Counter()
         self._logger = logging.getLogger("nanobanana.generation_service")
 
     async def get_primary_provider(self) -> ApiProvider:
@@ -73,22 +81,90 @@ class GenerationService:
         
         Does NOT trigger fallback for content policy errors (Gemini could not generate).
         """
-        msg = str(error).lower()
-        
-        # Content policy errors should NOT trigger fallback
-        if "gemini could not generate" in msg or "could not generate an image" in msg:
-            return False
-        if "sensitive" in msg or "e005" in msg:
+        if isinstance(error, ProviderError):
+            return error.retryable
+        if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError)):
+            return True
+        if isinstance(error, TaskAccepted):
             return False
-        if "nsfw" in msg:
-            return False
-        
-        # Check for service availability errors
-        for pattern in FALLBACK_ERROR_PATTERNS:
-            if pattern in msg:
-                return True
-        
-        return False
+        # Untyped error from outside the provider clients: classify by its text
+        return classify("unknown", str(error)).retryable
+
+    async def _track(self, provider: ApiProvider, call) -> Dict[str, Any]:
+        """Runs a provider call and reports its outcome and latency to the circuit breaker."""
+        started = time.monotonic()
+        try:
+            result = await call
+        except Exception as e:
+            if self.health is not None:
+                # Content/validation errors mean the provider answered — count them as healthy
+                await self.health.record(provider, not self.is_service_unavailable_error(e), time.monotonic() - started)
+            raise
+        if self.health is not None:
+            await self.health.record(provider, True, time.monotonic() - started)
+        return result
+
+    def track_task(self, provider: str, task_id: Optional[str], generation_id: Optional[int] = None) -> None:
+        """Hands an accepted async task to the poller, in case its callback never arrives."""
+        if self.poller is not None and task_id:
+            self.poller.track(provider, str(task_id), int(generation_id) if generation_id is not None else None)
+
+    def _watch(self, result: Dict[str, Any], meta: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if result.get("awaiting_callback"):
+            self.track_task(result["provider"], result.get("task_id"), (meta or {}).get("generationId"))
+        return result
+
+    async def _hedge_delay(self, provider: ApiProvider) -> float:
+        """How long to wait for the provider before starting the backup too."""
+        delay = None
+        if self.health is not None:
+            delay = await self.health.latency_percentile(provider, self.hedge_percentile)
+        if delay is None:
+            return self.hedge_max_delay_seconds
+        return min(max(delay, 0.5), self.hedge_max_delay_seconds)
+
+    async def _hedged(self, primary: ApiProvider, backup: ApiProvider, start, meta: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Runs the primary and, if it is slower than its usual latency, the backup as well.
+        The first accepted task wins; the other call is cancelled and, if its task was already
+        created, the callback handlers ignore it (see Cache.set_hedge_winner).
+
+        If the primary finishes before the hedge delay its result or error is returned as is,
+        so the regular fallback applies. Raises ProvidersExhausted when both hedged calls fail.
+        """
+        first = asyncio.create_task(self._track(primary, start(primary)))
+        done, _ = await asyncio.wait({first}, timeout=await self._hedge_delay(primary))
+        if done or (self.health is not None and not await self.health.allow(backup)):
+            return await first
+
+        self._logger.warning("Provider %s is slow to accept, hedging with %s", primary, backup)
+        second = asyncio.create_task(self._track(backup, start(backup)))
+        pending = {first, second}
+        errors: List[BaseException] = []
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+                for other in pending:
+                    other.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                result = task.result()
+                gen_id = (meta or {}).get("generationId")
+                if gen_id is not None:
+                    try:
+                        await self.cache.set_hedge_winner(int(gen_id), result["provider"])
+                    except Exception:
+                        self._logger.warning("Failed to record hedge winner for generation %s", gen_id)
+                self._logger.info("Hedged generation won by %s", result["provider"])
+                return result
+
+        # Content errors mean the request itself is rejected - report that one
+        for error in errors:
+            if not self.is_service_unavailable_error(error):
+                raise error
+        raise ProvidersExhausted(f"Both providers unavailable. {errors[-1]}")
 
     async def generate_pro(
         self,
@@ -110,6 +186,13 @@ class GenerationService:
         """
         primary = await self.get_primary_provider()
         backup: ApiProvider = "piapi" if primary == "kie" else "kie"
+
+        # Circuit open for the primary: go straight to a healthy backup instead of
+        # waiting for the primary to time out. If both are open, try the primary anyway.
+        if self.health is not None and not await self.health.allow(primary):
+            if await self.health.allow(backup):
+                self._logger.warning("Circuit open for %s, routing to %s", primary, backup)
+                primary, backup = backup, primary
         
         self._logger.info(
             "Starting NanoBanana Pro generation: primary=%s, backup=%s",
@@ -150,15 +233,13 @@ class GenerationService:
                             "awaiting_callback": False,
                             "image_url": result,
                         }
-                except RuntimeError as e:
-                    # Kie returns RuntimeError("awaiting callback") for async flow
-                    if "awaiting callback" in str(e).lower():
-                        return {
-                            "task_id": None,
-                            "provider": "kie",
-                            "awaiting_callback": True,
-                        }
-                    raise
+                except TaskAccepted as accepted:
+                    # Kie accepted an async task; the result comes via callback
+                    return {
+                        "task_id": accepted.task_id,
+                        "provider": "kie",
+                        "awaiting_callback": True,
+                    }
                 
                 return {
                     "task_id": None,
@@ -166,35 +247,42 @@ class GenerationService:
                     "awaiting_callback": True,
                 }
 
-        # Try primary provider
+        # Try primary provider (hedged with the backup when enabled)
         try:
-            result = await generate_with(primary)
-            self._logger.info("Generation started with primary provider: %s", primary)
-            return result
-            
+            if self.hedge_percentile > 0 and self.cache is not None:
+                result = await self._hedged(primary, backup, generate_with, meta)
+            else:
+                result = await self._track(primary, generate_with(primary))
+            self._logger.info("Generation started with provider: %s", result.get("provider"))
+            return self._watch(result, meta)
+
+        except ProvidersExhausted:
+            raise
         except Exception as error:
             # Check if we should fallback
             if not self.is_service_unavailable_error(error):
                 self._logger.error("Primary provider %s failed (not a service error): %s", primary, error)
                 raise
             
+            cause = getattr(error, "cause", "untyped")
+            self.fallback_causes[(primary, cause)] += 1
             self._logger.warning(
-                "Primary provider %s unavailable, trying fallback %s: %s",
-                primary, backup, error
+                "Primary provider %s unavailable (cause=%s status=%s code=%s), trying fallback %s: %s",
+                primary, cause, getattr(error, "status", None), getattr(error, "code", None), backup, error
             )
             
             # Try backup provider
             try:
-                result = await generate_with(backup)
+                result = await self._track(backup, generate_with(backup))
                 self._logger.info("Generation started with fallback provider: %s", backup)
-                return result
+                return self._watch(result, meta)
                 
             except Exception as backup_error:
                 self._logger.error(
                     "Both providers failed. Primary (%s): %s, Backup (%s): %s",
                     primary, error, backup, backup_error
                 )
-                raise RuntimeError(f"Both providers unavailable. {backup_error}")
+                raise ProvidersExhausted(f"Both providers unavailable. {backup_error}")
 
     async def generate_nb2(
         self,
@@ -218,7 +306,7 @@ class GenerationService:
         self._logger.info("Starting NanoBanana 2 generation: resolution=%s", resolution)
         
         try:
-            result = await self.kie.generate_image(
+            result = await self._track("kie", self.kie.generate_image(
                 prompt=prompt,
                 model="nano-banana-2",
                 image_urls=image_urls,
@@ -226,7 +314,7 @@ class GenerationService:
                 resolution=resolution,
                 google_search=google_search,
                 meta=meta,
-            )
+            ))
             # If we got an image URL directly, return it
             if result and not result.startswith("TIMEOUT"):
                 return {
@@ -235,14 +323,12 @@ class GenerationService:
                     "awaiting_callback": False,
                     "image_url": result,
                 }
-        except RuntimeError as e:
-            if "awaiting callback" in str(e).lower():
-                return {
-                    "task_id": None,
-                    "provider": "kie",
-                    "awaiting_callback": True,
-                }
-            raise
+        except TaskAccepted as accepted:
+            return self._watch({
+                "task_id": accepted.task_id,
+                "provider": "kie",
+                "awaiting_callback": True,
+            }, meta)
         
         return {
             "task_id": None,
@@ -0,0 +1,78 @@
+"""
+HTTP Sessions - общий пул aiohttp-соединений для внешних API.
+Один процессный ClientSession с keep-alive и DNS-кешем вместо новой сессии на каждый запрос.
+"""
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+
+class HttpSessionManager:
+    """
+    Owns a single pooled aiohttp.ClientSession for the whole process.
+
+    The session is created lazily on first use (inside the running event loop)
+    and must be closed once during app shutdown.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        keepalive_timeout: float = 30.0,
+        dns_cache_ttl: int = 300,
+    ):
+        self.limit = int(limit)
+        self.limit_per_host = int(limit_per_host)
+        self.keepalive_timeout = float(keepalive_timeout)
+        self.dns_cache_ttl = int(dns_cache_ttl)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+        self._logger = logging.getLogger("nanobanana.http")
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it on first call."""
+        session = self._session
+        if session is not None and not session.closed:
+            return session
+        async with self._lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=self.dns_cache_ttl,
+                    use_dns_cache=True,
+                )
+                self._session = aiohttp.ClientSession(connector=connector)
+                self._logger.info(
+                    "HTTP pool created: limit=%s per_host=%s keepalive=%ss dns_ttl=%ss",
+                    self.limit, self.limit_per_host, self.keepalive_timeout, self.dns_cache_ttl,
+                )
+            return self._session
+
+    async def close(self) -> None:
+        session = self._session
+        self._session = None
+        if session is not None and not session.closed:
+            await session.close()
+            self._logger.info("HTTP pool closed")
+
+
+@asynccontextmanager
+async def session_scope(manager: Optional[HttpSessionManager]) -> AsyncIterator[aiohttp.ClientSession]:
+    """
+    Yields the shared pooled session if a manager is configured,
+    otherwise a short-lived session that is closed on exit.
+
+    Request timeouts must be passed per request, not per session.
+    """
+    if manager is not None:
+        yield await manager.get_session()
+        return
+    async with aiohttp.ClientSession() as session:
+        yield session
@@ -98,6 +98,12 @@ STRINGS: Dict[str, Dict[str, str]] = {
         "profile.id": "ID: {id}",
         "profile.lang": "Язык: {lang_code}",
         "profile.balance": "💰 Баланс: <b>{balance}</b> ✨",
+        "profile.history_title": "🧾 Последние операции:",
+        "profile.history_item": "{sign}{amount} — {reason} ({date})",
+        "ledger.reason.generation": "генерация",
+        "ledger.reason.refund": "возврат",
+        "ledger.reason.topup_stars": "пополнение Stars",
+        "ledger.reason.topup_tribute": "пополнение",
         "profile.actions": (
             "Действия:\n"
             "• Пополнить баланс ✨ — откроет меню пополнения\n"
@@ -194,6 +200,7 @@ STRINGS: Dict[str, Dict[str, str]] = {
         "gen.draft.processing": "⏳ Генерация выполняется. Это сообщение обновляется в реальном времени.",
         "gen.draft.completed": "✅ Генерация завершена. Отправляю результат...",
         "gen.draft.failed": "❌ Генерация завершилась с ошибкой. Проверяю возврат токенов...",
+        "gen.expired": "⌛ Генерация #{generation_id} не получила результат от провайдера и отменена. Токены возвращены: +{tokens}",
         "gen.unknown_type": "Неизвестный тип генерации. Начните заново: /generate",
         "gen.repeat_not_found": "Повтор невозможен: нет предыдущей генерации.",
         "gen.repeat_unsupported": "Повтор работает только для текстовых генераций без изображений.",
@@ -281,6 +288,12 @@ STRINGS: Dict[str, Dict[str, str]] = {
         "profile.id": "ID: {id}",
         "profile.lang": "Language: {lang_code}",
         "profile.balance": "💰 Balance: <b>{balance}</b> ✨",
+        "profile.history_title": "🧾 Recent operations:",
+        "profile.history_item": "{sign}{amount} — {reason} ({date})",
+        "ledger.reason.generation": "generation",
+        "ledger.reason.refund": "refund",
+        "ledger.reason.topup_stars": "Stars top-up",
+        "ledger.reason.topup_tribute": "top-up",
         "profile.actions": (
             "Actions:\n"
             "• Top up ✨ — opens the top‑up menu\n"
@@ -377,6 +390,7 @@ STRINGS: Dict[str, Dict[str, str]] = {
         "gen.draft.processing": "⏳ Generation is in progress. This draft updates in real time.",
         "gen.draft.completed": "✅ Generation completed. Sending result...",
         "gen.draft.failed": "❌ Generation failed. Verifying token refund...",
+        "gen.expired": "⌛ Generation #{generation_id} got no result from the provider and was cancelled. Tokens refunded: +{tokens}",
         "gen.unknown_type": "Unknown generation type. Start over: /generate",
         "gen.repeat_not_found": "Cannot repeat: no previous generation found.",
         "gen.repeat_unsupported": "Repeat only supported for text-only generations.",
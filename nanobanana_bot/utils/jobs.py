@@ -0,0 +1,267 @@
+"""
+Jobs - надёжная очередь фоновых задач в Redis (повторы генераций, загрузка в R2).
+Задачи переживают рестарт/редеплой: взятая в работу задача арендуется на
+visibility timeout и возвращается в очередь, если воркер не подтвердил её.
+"""
+
+import asyncio
+import json
+import logging
+import random
+from typing import Any, Awaitable, Callable, Dict, Optional
+from uuid import uuid4
+
+import redis.asyncio as redis
+
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying cannot help; the job is exhausted immediately."""
+
+
+# KEYS: ready zset, job hash. ARGV: id, kind, payload, max_attempts, delay_ms.
+# Returns 0 if a job with this id already exists (enqueue is idempotent per id).
+ENQUEUE_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return 0 end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('HSET', KEYS[2], 'kind', ARGV[2], 'payload', ARGV[3], 'attempts', 0, 'max_attempts', ARGV[4])
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[5]), ARGV[1])
+return 1
+"""
+
+# KEYS: ready zset, leased zset. ARGV: limit, visibility_ms, job key prefix.
+# Returns expired leases to ready, then leases up to limit due jobs.
+# Job hash keys are built from ARGV (ids are only known inside the script); all queue keys
+# share the {prefix} hash tag, so they live in one slot and the script also runs on Redis Cluster.
+CLAIM_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 100)
+for _, id in ipairs(expired) do
+  redis.call('ZREM', KEYS[2], id)
+  redis.call('ZADD', KEYS[1], now, id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+for _, id in ipairs(ids) do
+  redis.call('ZREM', KEYS[1], id)
+  redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), id)
+  redis.call('HINCRBY', ARGV[3] .. id, 'attempts', 1)
+end
+return ids
+"""
+
+
+class JobQueue:
+    """
+    Redis-backed delayed job queue with leases, retries and a bounded worker.
+
+    enqueue() schedules a job (optionally delayed; a given job_id is enqueued once).
+    run() claims due jobs, at most `concurrency` at a time. A job that raises is
+    rescheduled with exponential backoff until max_attempts, then on_exhausted
+    of its kind is called and the job is moved to the dead list. The lease of a
+    running job is extended every visibility_timeout / 3; a job whose worker
+    stopped renewing it (crashed/redeployed) becomes due again after visibility_timeout.
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        prefix: str = "njobs",
+        concurrency: int = 4,
+        visibility_timeout: float = 300.0,
+        poll_interval: float = 1.0,
+        max_attempts: int = 5,
+        base_backoff: float = 5.0,
+        max_backoff: float = 600.0,
+    ):
+        self._redis = redis_client
+        self._enqueue = redis_client.register_script(ENQUEUE_SCRIPT)
+        self._claim = redis_client.register_script(CLAIM_SCRIPT)
+        self.prefix = prefix
+        self.concurrency = max(0, int(concurrency))
+        self.visibility_timeout = float(visibility_timeout)
+        self.poll_interval = float(poll_interval)
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_backoff = float(base_backoff)
+        self.max_backoff = float(max_backoff)
+        self._handlers: Dict[str, JobHandler] = {}
+        self._on_exhausted: Dict[str, JobHandler] = {}
+        # In-flight task -> job id
+        self._running: Dict[asyncio.Task, str] = {}
+        self._logger = logging.getLogger("nanobanana.jobs")
+
+    @property
+    def _tag(self) -> str:
+        # Hash tag: every key of the queue maps to the same cluster slot
+        return f"{{{self.prefix}}}"
+
+    @property
+    def _ready(self) -> str:
+        return f"{self._tag}:ready"
+
+    @property
+    def _leased(self) -> str:
+        return f"{self._tag}:leased"
+
+    @property
+    def _dead(self) -> str:
+        return f"{self._tag}:dead"
+
+    def _job_key(self, job_id: str) -> str:
+        return f"{self._tag}:job:{job_id}"
+
+    def register(self, kind: str, handler: JobHandler, on_exhausted: Optional[JobHandler] = None) -> None:
+        self._handlers[kind] = handler
+        if on_exhausted is not None:
+            self._on_exhausted[kind] = on_exhausted
+
+    async def enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        delay_seconds: float = 0,
+        job_id: Optional[str] = None,
+        max_attempts: Optional[int] = None,
+    ) -> bool:
+        """Schedules a job. Returns False if a job with the same job_id is already queued."""
+        job_id = job_id or uuid4().hex
+        created = await self._enqueue(
+            keys=[self._ready, self._job_key(job_id)],
+            args=[
+                job_id,
+                kind,
+                json.dumps(payload, ensure_ascii=False),
+                int(max_attempts or self.max_attempts),
+                int(max(0.0, delay_seconds) * 1000),
+            ],
+        )
+        return bool(int(created))
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * (2 ** max(0, attempts - 1)))
+        # Jitter so that jobs failed together do not retry together
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _finish(self, job_id: str) -> None:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._leased, job_id)
+            pipe.delete(self._job_key(job_id))
+            await pipe.execute()
+
+    async def _process(self, job_id: str) -> None:
+        job = await self._redis.hgetall(self._job_key(job_id))
+        if not job:
+            await self._redis.zrem(self._leased, job_id)
+            return
+        kind = job.get("kind", "")
+        attempts = int(job.get("attempts") or 1)
+        max_attempts = int(job.get("max_attempts") or self.max_attempts)
+        try:
+            payload = json.loads(job.get("payload") or "{}")
+        except ValueError:
+            payload = {}
+        handler = self._handlers.get(kind)
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            if handler is None:
+                # E.g. enqueued by a newer release during a rolling deploy; let another worker take it
+                raise RuntimeError(f"no handler for job kind {kind!r}")
+            await handler(payload)
+        except Exception as e:
+            permanent = isinstance(e, PermanentJobError)
+            if not permanent and attempts < max_attempts:
+                delay = self._backoff(attempts)
+                self._logger.warning(
+                    "Job %s (%s) failed, attempt %s/%s, retry in %.0fs: %s",
+                    job_id, kind, attempts, max_attempts, delay, e,
+                )
+                run_at = await self._now_ms() + delay * 1000
+                async with self._redis.pipeline(transaction=True) as pipe:
+                    pipe.zrem(self._leased, job_id)
+                    pipe.zadd(self._ready, {job_id: int(run_at)})
+                    await pipe.execute()
+                return
+            self._logger.error("Job %s (%s) exhausted after %s attempts: %s", job_id, kind, attempts, e)
+            exhausted = self._on_exhausted.get(kind)
+            if exhausted is not None:
+                try:
+                    await exhausted(payload)
+                except Exception:
+                    self._logger.exception("on_exhausted failed for job %s (%s)", job_id, kind)
+            try:
+                await self._redis.lpush(self._dead, json.dumps({"id": job_id, "kind": kind, "payload": payload, "error": str(e)}, ensure_ascii=False))
+                await self._redis.ltrim(self._dead, 0, 999)
+            except Exception:
+                pass
+            await self._finish(job_id)
+            return
+        finally:
+            heartbeat.cancel()
+        await self._finish(job_id)
+
+    async def _heartbeat(self, job_id: str) -> None:
+        """Extends the lease of a running job, so a long handler is not claimed again in parallel."""
+        interval = max(1.0, self.visibility_timeout / 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                deadline = await self._now_ms() + self.visibility_timeout * 1000
+                # XX: a lease that was already reclaimed is not recreated
+                await self._redis.zadd(self._leased, {job_id: int(deadline)}, xx=True)
+            except Exception:
+                self._logger.debug("Failed to extend lease of job %s", job_id, exc_info=True)
+
+    async def _now_ms(self) -> float:
+        # Server clock, so that scores from all replicas are comparable
+        seconds, micros = await self._redis.time()
+        return seconds * 1000 + micros / 1000
+
+    async def run(self) -> None:
+        """Worker loop; runs until cancelled. Started once per process."""
+        self._logger.info("Job worker started: concurrency=%s", self.concurrency)
+        try:
+            while True:
+                capacity = self.concurrency - len(self._running)
+                ids = []
+                if capacity > 0:
+                    try:
+                        ids = await self._claim(
+                            keys=[self._ready, self._leased],
+                            args=[capacity, int(self.visibility_timeout * 1000), f"{self._tag}:job:"],
+                        )
+                    except Exception:
+                        self._logger.warning("Failed to claim jobs", exc_info=True)
+                for job_id in ids:
+                    task = asyncio.create_task(self._process(job_id))
+                    self._running[task] = job_id
+                    task.add_done_callback(lambda t: self._running.pop(t, None))
+                if ids and len(ids) == capacity:
+                    # Saturated: wait for a slot instead of polling
+                    await asyncio.wait(list(self._running), return_when=asyncio.FIRST_COMPLETED)
+                elif not ids:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            interrupted = list(self._running.values())
+            for task in list(self._running):
+                task.cancel()
+            await asyncio.gather(*self._running, return_exceptions=True)
+            await self._release(interrupted)
+
+    async def _release(self, job_ids: list[str]) -> None:
+        """Puts jobs interrupted by shutdown back to ready without spending an attempt."""
+        if not job_ids:
+            return
+        try:
+            now = await self._now_ms()
+            async with self._redis.pipeline(transaction=True) as pipe:
+                for job_id in job_ids:
+                    pipe.zrem(self._leased, job_id)
+                    pipe.zadd(self._ready, {job_id: int(now)})
+                    pipe.hincrby(self._job_key(job_id), "attempts", -1)
+                await pipe.execute()
+        except Exception:
+            # Leases expire after visibility_timeout anyway
+            self._logger.warning("Failed to release %s interrupted jobs", len(job_ids))
@@ -0,0 +1,115 @@
+"""
+Ledger - пакетная запись движений токенов и периодические снимки балансов.
+Всплеск колбэков провайдера (массовые возвраты) превращается в несколько
+вызовов apply_ledger_batch вместо отдельной RPC на каждый возврат.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..database import Database
+
+
+_logger = logging.getLogger("nanobanana.ledger")
+
+
+class LedgerWriter:
+    """
+    Coalesces concurrent ledger entries into Database.apply_ledger_batch calls.
+
+    adjust() has the same contract as Database.adjust_balance(): it resolves to
+    the new balance or None when a debit is rejected. A batch is flushed when it
+    reaches max_batch entries or max_delay_seconds after its first entry.
+    """
+
+    def __init__(self, db: Database, max_batch: int = 50, max_delay_seconds: float = 0.05):
+        self.db = db
+        self.max_batch = max(1, int(max_batch))
+        self.max_delay_seconds = max(0.0, float(max_delay_seconds))
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.Task] = None
+
+    async def adjust(
+        self,
+        user_id: int,
+        delta: int,
+        reason: str,
+        idempotency_key: str,
+        generation_id: Optional[int] = None,
+    ) -> Optional[int]:
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        entry = {
+            "user_id": int(user_id),
+            "delta": int(delta),
+            "reason": reason,
+            "idempotency_key": idempotency_key,
+            "generation_id": generation_id,
+        }
+        self._pending.append((entry, fut))
+        if len(self._pending) >= self.max_batch:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await fut
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.max_delay_seconds)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            results = await self.db.apply_ledger_batch([entry for entry, _ in batch])
+        except Exception as e:
+            # Whole batch failed (network, RPC error): every entry is idempotent, apply them one by one
+            _logger.warning("Ledger batch of %s entries failed, applying one by one: %s", len(batch), e)
+            await asyncio.gather(*(self._apply_one(entry, fut) for entry, fut in batch))
+            return
+        for (_, fut), result in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                _logger.warning("Ledger entry failed: %s", result)
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+        if len(results) != len(batch):
+            _logger.error("Ledger batch returned %s results for %s entries", len(results), len(batch))
+            for _, fut in batch[len(results):]:
+                if not fut.done():
+                    fut.set_exception(RuntimeError("ledger batch returned no result for this entry"))
+        _logger.debug("Ledger batch applied: entries=%s", len(batch))
+
+    async def _apply_one(self, entry: Dict[str, Any], fut: asyncio.Future) -> None:
+        try:
+            balance = await self.db.adjust_balance(
+                entry["user_id"], entry["delta"], entry["reason"], entry["idempotency_key"],
+                generation_id=entry.get("generation_id"),
+            )
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        if not fut.done():
+            fut.set_result(balance)
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+async def run_balance_snapshots(db: Database, interval_seconds: int) -> None:
+    """Periodically refresh balance_snapshots (see snapshot_balances() in migrations)."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            refreshed = await db.snapshot_balances()
+            _logger.info("Balance snapshots refreshed: users=%s", refreshed)
+        except Exception as e:
+            _logger.warning("Balance snapshot failed: %s", e)
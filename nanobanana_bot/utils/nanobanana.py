@@ -1,7 +1,11 @@
 import aiohttp
+import asyncio
 import logging
 from typing import Optional, List, Dict, Any
 
+from .http import HttpSessionManager, session_scope
+from .provider_errors import ContentRejected, ProviderError, ProviderUnavailable, TaskAccepted, classify
+
 
 class NanoBananaClient:
     def __init__(
@@ -10,6 +14,7 @@ class NanoBananaClient:
         api_key: Optional[str] = None,
         timeout_seconds: int = 60,
         callback_url: Optional[str] = None,
+        http: Optional[HttpSessionManager] = None,
     ):
         # Sanitize base URL (remove trailing slashes/spaces/commas)
         self.base_url = base_url.rstrip(",/ ")
@@ -20,6 +25,7 @@ class NanoBananaClient:
             str(callback_url).strip().strip("`").rstrip(",/ ")
             if callback_url else None
         )
+        self.http = http
         self._logger = logging.getLogger("nanobanana.api")
 
     async def generate_image(
@@ -128,8 +134,8 @@ class NanoBananaClient:
         timeout = aiohttp.ClientTimeout(total=self.timeout_seconds)
         self._logger.info("Requesting NanoBanana generate: url=%s, payload_keys=%s", url, list(payload.keys()))
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(url, json=payload, headers=headers) as resp:
+            async with session_scope(self.http) as session:
+                async with session.post(url, json=payload, headers=headers, timeout=timeout) as resp:
                     status = resp.status
                     text = await resp.text()
                     self._logger.debug("NanoBanana response status=%s body=%s", status, text[:500])
@@ -139,19 +145,20 @@ class NanoBananaClient:
                         self._logger.warning("NanoBanana API 422 error (sensitive content): %s", text[:500])
                         # Проверяем на ошибку контент-модерации
                         if "sensitive" in text.lower() or "E005" in text:
-                            raise RuntimeError("SENSITIVE_CONTENT_ERROR")
-                        raise RuntimeError(f"Validation error: {text[:200]}")
-                    
-                    resp.raise_for_status()
+                            raise ContentRejected("SENSITIVE_CONTENT_ERROR", provider="kie", status=422, code="E005")
+                        raise classify("kie", f"Validation error: {text[:200]}", status=422)
+
+                    if status >= 400:
+                        raise classify("kie", f"KIE API HTTP {status}: {text[:200]}", status=status)
                     try:
                         data = await resp.json()
                     except Exception:
                         self._logger.error("Failed to parse JSON, response text snippet: %s", text[:500])
-                        raise
+                        raise ProviderUnavailable("KIE API returned invalid JSON", provider="kie", status=status)
                     # KIE may return {code,msg,data}; surface errors if code != 200
                     if isinstance(data, dict) and "code" in data and data.get("code") not in (200, 0, None):
                         self._logger.error("KIE API error: code=%s msg=%s", data.get("code"), data.get("msg"))
-                        raise RuntimeError(f"{data.get('msg')}")
+                        raise classify("kie", f"{data.get('msg')}", status=status, code=data.get("code"))
                     # Two possible patterns:
                     # 1) Synchronous: returns image_url
                     # 2) Async: returns taskId and will POST to callBackUrl later
@@ -169,56 +176,63 @@ class NanoBananaClient:
                         self._logger.info("NanoBanana task accepted, id=%s (await callback)", task_id)
                         # For async flow, we cannot return image_url immediately.
                         # Let the caller handle user messaging; raise a distinct error.
-                        raise RuntimeError("NanoBanana API accepted task; awaiting callback")
+                        raise TaskAccepted("kie", str(task_id))
 
                     # No image_url and no task id — likely an error payload with 'msg'
                     self._logger.error("NanoBanana API missing image_url and taskId in response: %s", data)
-                    raise RuntimeError("NanoBanana API did not return image_url")
+                    raise ProviderError("NanoBanana API did not return image_url", provider="kie", status=status)
+        except (TaskAccepted, ProviderError):
+            raise
         except aiohttp.ClientError as e:
             self._logger.exception("HTTP client error during NanoBanana request: %s", e)
-            raise
+            raise ProviderUnavailable(f"KIE connection error: {e}", provider="kie") from e
+        except asyncio.TimeoutError as e:
+            self._logger.warning("NanoBanana request timeout after %ss", self.timeout_seconds)
+            raise ProviderUnavailable("KIE request timeout", provider="kie") from e
         except Exception as e:
-            if "awaiting callback" in str(e):
-                raise e
             self._logger.exception("Unexpected error during NanoBanana request: %s", e)
             raise
 
     async def get_record_info(self, task_id: str) -> Dict[str, Any]:
         """
-        Queries KIE API for task status. Returns parsed JSON dict.
+        Queries KIE API for task status. Returns parsed JSON dict
+        ({code, msg, data: {taskId, state, resultJson, param, failMsg}} - same shape as the callback).
         """
         headers = {"Content-Type": "application/json"}
         if self.api_key:
             headers["Authorization"] = f"Bearer {self.api_key}"
 
-        # Endpoint for recordInfo
-        if "api.kie.ai" in self.base_url or "/api/v1" in self.base_url:
+        # Endpoint for recordInfo. Pro/NB2 tasks are always created on the official KIE API
+        # (see generate_image), so it is used unless base_url already points at /api/v1.
+        if "/api/v1" in self.base_url:
             url = f"{self.base_url.rstrip('/')}/jobs/recordInfo"
         else:
-            url = f"{self.base_url}/recordInfo"
+            url = "https://api.kie.ai/api/v1/jobs/recordInfo"
 
         timeout = aiohttp.ClientTimeout(total=self.timeout_seconds)
         params = {"taskId": task_id}
-        self._logger.info("Querying KIE recordInfo: url=%s taskId=%s", url, task_id)
+        self._logger.debug("Querying KIE recordInfo: url=%s taskId=%s", url, task_id)
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(url, headers=headers, params=params) as resp:
+            async with session_scope(self.http) as session:
+                async with session.get(url, headers=headers, params=params, timeout=timeout) as resp:
                     status = resp.status
                     text = await resp.text()
                     self._logger.debug("KIE recordInfo response status=%s body=%s", status, text[:500])
-                    resp.raise_for_status()
+                    if status >= 400:
+                        raise classify("kie", f"KIE recordInfo HTTP {status}: {text[:200]}", status=status)
                     try:
                         data = await resp.json()
                     except Exception:
                         self._logger.error("Failed to parse JSON, response text snippet: %s", text[:500])
-                        raise
+                        raise ProviderUnavailable("KIE recordInfo returned invalid JSON", provider="kie", status=status)
                     if isinstance(data, dict) and "code" in data and data.get("code") not in (200, 0, None):
                         self._logger.error("KIE recordInfo error: code=%s msg=%s", data.get("code"), data.get("msg"))
-                        raise RuntimeError(f"{data.get('msg')}")
+                        raise classify("kie", f"{data.get('msg')}", status=status, code=data.get("code"))
                     return data
-        except aiohttp.ClientError as e:
-            self._logger.exception("HTTP client error during KIE recordInfo: %s", e)
+        except ProviderError:
             raise
-        except Exception as e:
-            self._logger.exception("Unexpected error during KIE recordInfo: %s", e)
-            raise
\ No newline at end of file
+        except aiohttp.ClientError as e:
+            self._logger.warning("HTTP client error during KIE recordInfo: %s", e)
+            raise ProviderUnavailable(f"KIE connection error: {e}", provider="kie") from e
+        except asyncio.TimeoutError as e:
+            raise ProviderUnavailable("KIE recordInfo timeout", provider="kie") from e
@@ -4,9 +4,13 @@ Piapi Client - Резервный API провайдер для NanoBanana Pro.
 """
 
 import aiohttp
+import asyncio
 import logging
 from typing import Optional, List, Dict, Any
 
+from .http import HttpSessionManager, session_scope
+from .provider_errors import ProviderAuthError, ProviderError, ProviderUnavailable, classify
+
 
 PIAPI_BASE_URL = "https://api.piapi.ai"
 
@@ -19,6 +23,7 @@ class PiapiClient:
         api_key: Optional[str] = None,
         timeout_seconds: int = 60,
         callback_url: Optional[str] = None,
+        http: Optional[HttpSessionManager] = None,
     ):
         self.api_key = api_key
         self.timeout_seconds = timeout_seconds
@@ -27,6 +32,7 @@ class PiapiClient:
             str(callback_url).strip().strip("`").rstrip(",/ ")
             if callback_url else None
         )
+        self.http = http
         self._logger = logging.getLogger("nanobanana.piapi")
 
     async def create_task(
@@ -44,7 +50,7 @@ class PiapiClient:
         Returns: task_id string.
         """
         if not self.api_key:
-            raise RuntimeError("PIAPI_API_KEY is not configured")
+            raise ProviderAuthError("PIAPI_API_KEY is not configured", provider="piapi")
 
         headers = {
             "X-API-Key": self.api_key,
@@ -108,11 +114,12 @@ class PiapiClient:
         timeout = aiohttp.ClientTimeout(total=self.timeout_seconds)
         
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session_scope(self.http) as session:
                 async with session.post(
                     f"{PIAPI_BASE_URL}/api/v1/task",
                     json=body,
-                    headers=headers
+                    headers=headers,
+                    timeout=timeout,
                 ) as resp:
                     status = resp.status
                     text = await resp.text()
@@ -120,118 +127,99 @@ class PiapiClient:
 
                     if status != 200:
                         self._logger.error("Piapi task create failed: status=%s body=%s", status, text[:300])
-                        raise RuntimeError(f"Piapi API error: {status} - {text[:200]}")
+                        raise classify("piapi", f"Piapi API error: {status} - {text[:200]}", status=status)
 
                     try:
                         data = await resp.json()
                     except Exception:
                         self._logger.error("Failed to parse Piapi JSON response: %s", text[:500])
-                        raise RuntimeError("Invalid JSON from Piapi")
+                        raise ProviderUnavailable("Invalid JSON from Piapi", provider="piapi", status=status)
 
                     # Check response code
                     if data.get("code") != 200:
                         msg = data.get("message") or "Unknown error"
                         self._logger.error("Piapi error: code=%s msg=%s", data.get("code"), msg)
-                        raise RuntimeError(f"Piapi: {msg}")
+                        raise classify("piapi", f"Piapi: {msg}", status=status, code=data.get("code"))
 
                     task_id = data.get("data", {}).get("task_id")
                     if not task_id:
                         self._logger.error("Piapi response missing task_id: %s", data)
-                        raise RuntimeError("Piapi response missing task_id")
+                        raise ProviderError("Piapi response missing task_id", provider="piapi", status=status)
 
                     self._logger.info("Piapi task created: id=%s", task_id)
                     return task_id
 
+        except ProviderError:
+            raise
         except aiohttp.ClientError as e:
             self._logger.exception("HTTP client error during Piapi request: %s", e)
-            raise
+            raise ProviderUnavailable(f"Piapi connection error: {e}", provider="piapi") from e
+        except asyncio.TimeoutError as e:
+            self._logger.warning("Piapi request timeout after %ss", self.timeout_seconds)
+            raise ProviderUnavailable("Piapi request timeout", provider="piapi") from e
         except Exception as e:
             self._logger.exception("Unexpected error during Piapi request: %s", e)
             raise
 
-    async def check_task(self, task_id: str) -> Dict[str, Any]:
+    async def get_task(self, task_id: str) -> Dict[str, Any]:
         """
-        Check task status via Piapi API.
-        
-        Returns dict with keys: status, image_url (if completed), error (if failed).
+        Fetches a task via Piapi API. Returns the task object ({task_id, status, output, error, ...}),
+        i.e. the same object the webhook delivers under "data".
         """
         if not self.api_key:
-            raise RuntimeError("PIAPI_API_KEY is not configured")
+            raise ProviderAuthError("PIAPI_API_KEY is not configured", provider="piapi")
 
         headers = {"X-API-Key": self.api_key}
         timeout = aiohttp.ClientTimeout(total=self.timeout_seconds)
 
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session_scope(self.http) as session:
                 async with session.get(
                     f"{PIAPI_BASE_URL}/api/v1/task/{task_id}",
-                    headers=headers
+                    headers=headers,
+                    timeout=timeout,
                 ) as resp:
-                    data = await resp.json()
-
+                    status = resp.status
+                    text = await resp.text()
+                    if status != 200:
+                        raise classify("piapi", f"Piapi API error: {status} - {text[:200]}", status=status)
+                    try:
+                        data = await resp.json()
+                    except Exception:
+                        raise ProviderUnavailable("Invalid JSON from Piapi", provider="piapi", status=status)
                     if data.get("code") != 200:
-                        return {
-                            "status": "failed",
-                            "error": data.get("message", "Unknown error"),
-                        }
-
-                    task_data = data.get("data", {})
-                    status = task_data.get("status", "").lower()
-
-                    result: Dict[str, Any] = {"status": status}
-
-                    if status == "completed":
-                        output = task_data.get("output", {})
-                        image_url = output.get("image_url") or (output.get("image_urls") or [None])[0]
-                        result["image_url"] = image_url
-
-                    if status == "failed":
-                        error = task_data.get("error", {})
-                        result["error"] = error.get("message", "Generation failed")
-
-                    return result
-
+                        msg = data.get("message") or "Unknown error"
+                        raise classify("piapi", f"Piapi: {msg}", status=status, code=data.get("code"))
+                    return data.get("data") or {}
+        except ProviderError:
+            raise
         except aiohttp.ClientError as e:
-            self._logger.exception("HTTP error checking Piapi task: %s", e)
-            return {"status": "error", "error": str(e)}
-        except Exception as e:
-            self._logger.exception("Error checking Piapi task: %s", e)
-            return {"status": "error", "error": str(e)}
+            self._logger.warning("HTTP error checking Piapi task: %s", e)
+            raise ProviderUnavailable(f"Piapi connection error: {e}", provider="piapi") from e
+        except asyncio.TimeoutError as e:
+            raise ProviderUnavailable("Piapi request timeout", provider="piapi") from e
 
-    async def poll_task(self, task_id: str, timeout_ms: int = 600000) -> str:
+    async def check_task(self, task_id: str) -> Dict[str, Any]:
         """
-        Poll Piapi task until completion or timeout.
+        Check task status via Piapi API.
         
-        Returns: image_url on success, 'TIMEOUT' on timeout.
-        Raises: RuntimeError on failure.
+        Returns dict with keys: status, image_url (if completed), error (if failed).
         """
-        import asyncio
-        import time
-
-        start = time.time()
-        timeout_sec = timeout_ms / 1000
-        poll_interval = 30  # Piapi recommends 30 second intervals
-
-        self._logger.info("Polling Piapi task %s (timeout: %sms)", task_id, timeout_ms)
-
-        while time.time() - start < timeout_sec:
-            result = await self.check_task(task_id)
-            status = result.get("status", "")
+        try:
+            task_data = await self.get_task(task_id)
+        except ProviderError as e:
+            return {"status": "error", "error": str(e)}
 
-            if status == "completed":
-                image_url = result.get("image_url")
-                if image_url:
-                    self._logger.info("Piapi task %s completed", task_id)
-                    return image_url
-                else:
-                    raise RuntimeError("Piapi task completed but no image_url")
+        status = str(task_data.get("status", "")).lower()
+        result: Dict[str, Any] = {"status": status}
 
-            if status == "failed":
-                error_msg = result.get("error", "Generation failed")
-                self._logger.error("Piapi task %s failed: %s", task_id, error_msg)
-                raise RuntimeError(error_msg)
+        if status == "completed":
+            output = task_data.get("output", {})
+            image_url = output.get("image_url") or (output.get("image_urls") or [None])[0]
+            result["image_url"] = image_url
 
-            await asyncio.sleep(poll_interval)
+        if status == "failed":
+            error = task_data.get("error", {})
+            result["error"] = error.get("message", "Generation failed")
 
-        self._logger.warning("Piapi task %s timed out", task_id)
-        return "TIMEOUT"
+        return result
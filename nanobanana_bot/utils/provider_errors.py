@@ -0,0 +1,129 @@
+"""
+Provider Errors - типизированные ошибки провайдеров генерации (KIE, Piapi).
+Клиенты классифицируют ответ один раз в месте ошибки (HTTP статус, код провайдера),
+а GenerationService принимает решение о fallback по атрибуту retryable.
+"""
+
+from typing import Optional, Union
+
+
+# Подсказки в тексте ошибки для ответов без однозначного HTTP статуса / кода
+UNAVAILABLE_HINTS = (
+    "timeout", "econnrefused", "connection refused",
+    "temporarily unavailable",
+    "currently unavailable",  # KIE "Service is currently unavailable" (E003)
+    "internal error",
+    "internal server error",
+    "ai studio api http error",
+    "service unavailable",
+    "no channel found",  # KIE infrastructure error (no processing channel)
+    "high demand",  # KIE overload error
+)
+CONTENT_HINTS = ("sensitive", "e005", "nsfw", "gemini could not generate", "could not generate an image")
+
+
+class ProviderError(RuntimeError):
+    """
+    Error returned by a generation provider.
+
+    status is the HTTP status (if any), code the provider's own code (e.g. 500, "E005").
+    retryable means another provider may succeed, i.e. the generation should fall back.
+    """
+
+    cause = "error"
+    retryable = False
+
+    def __init__(
+        self,
+        message: str,
+        provider: str,
+        status: Optional[int] = None,
+        code: Union[int, str, None] = None,
+        retryable: Optional[bool] = None,
+    ):
+        super().__init__(message)
+        self.provider = provider
+        self.status = status
+        self.code = code
+        if retryable is not None:
+            self.retryable = retryable
+
+
+class ProviderUnavailable(ProviderError):
+    """5xx, timeouts, network errors, provider overload."""
+
+    cause = "unavailable"
+    retryable = True
+
+
+class ProviderRateLimited(ProviderError):
+    cause = "rate_limited"
+    retryable = True
+
+
+class ProviderAuthError(ProviderError):
+    """Expired/invalid API key - the other provider is still worth trying."""
+
+    cause = "auth"
+    retryable = True
+
+
+class ContentRejected(ProviderError):
+    """Moderation rejected the prompt or images (E005, NSFW); no other provider will help."""
+
+    cause = "content"
+
+
+class ProviderRequestError(ProviderError):
+    """Request rejected as invalid (4xx / validation)."""
+
+    cause = "invalid"
+
+
+class ProvidersExhausted(RuntimeError):
+    """Every provider tried for a generation failed (no further fallback)."""
+
+
+class TaskAccepted(RuntimeError):
+    """
+    Not a failure: the provider accepted an async task and will POST the result to the callback.
+    The message keeps the "awaiting callback" wording existing callers match on.
+    """
+
+    def __init__(self, provider: str, task_id: Optional[str] = None):
+        super().__init__(f"{'NanoBanana API' if provider == 'kie' else provider} accepted task; awaiting callback")
+        self.provider = provider
+        self.task_id = task_id
+
+
+def classify(
+    provider: str,
+    message: str,
+    status: Optional[int] = None,
+    code: Union[int, str, None] = None,
+) -> ProviderError:
+    """
+    Maps a provider error to its type. Content-policy hints in the message are checked first
+    (providers report rejections under various codes, including 5xx); then 429, 401/403 and 5xx
+    by status/code, then unavailability hints in the message, then any other 4xx.
+    """
+    lowered = message.lower()
+    numeric = status
+    if isinstance(code, int) or (isinstance(code, str) and code.isdigit()):
+        numeric = int(code)
+
+    if any(h in lowered for h in CONTENT_HINTS):
+        cls = ContentRejected
+    elif numeric == 429:
+        cls = ProviderRateLimited
+    elif numeric in (401, 403):
+        cls = ProviderAuthError
+    elif numeric is not None and numeric >= 500:
+        cls = ProviderUnavailable
+    elif any(h in lowered for h in UNAVAILABLE_HINTS):
+        cls = ProviderUnavailable
+    elif numeric is not None and 400 <= numeric < 500:
+        cls = ProviderRequestError
+    else:
+        cls = ProviderError
+    return cls(message, provider=provider, status=status, code=code)
@@ -0,0 +1,180 @@
+"""
+Provider Health - общий для всех реплик circuit breaker провайдеров генерации.
+Состояние (closed / open / half_open), скользящая доля ошибок и EWMA задержки
+хранятся в Redis, поэтому падение KIE, замеченное одной репликой, сразу видят все.
+"""
+
+import logging
+import math
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+import redis.asyncio as redis
+
+
+@dataclass(frozen=True)
+class BreakerPolicy:
+    # Rolling window = window_buckets * bucket_seconds
+    bucket_seconds: int = 10
+    window_buckets: int = 6
+    # Breaker opens when at least min_requests were seen and the error share reaches the threshold
+    min_requests: int = 5
+    error_rate_threshold: float = 0.5
+    # How long the provider is skipped before a single half-open probe is let through
+    open_seconds: int = 30
+    # Lease of the half-open probe; must outlast the provider request timeout, otherwise a
+    # second probe is let through while the first one is still in flight
+    probe_lease_seconds: int = 90
+    # Weight of the newest sample in the latency EWMA
+    latency_alpha: float = 0.3
+    # Recent successful call latencies kept for percentiles (hedging)
+    latency_samples: int = 50
+
+
+# KEYS[1] - provider state hash, KEYS[2] - probe lease; ARGV[1] - probe lease ms.
+# Returns 1 if a request may go to the provider (closed, or the half-open probe was granted).
+ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+if state == 'closed' then return 1 end
+local open_until = tonumber(redis.call('HGET', KEYS[1], 'open_until') or '0')
+if state == 'open' and now < open_until then return 0 end
+if redis.call('SET', KEYS[2], '1', 'NX', 'PX', tonumber(ARGV[1])) then
+  redis.call('HSET', KEYS[1], 'state', 'half_open')
+  return 1
+end
+return 0
+"""
+
+# KEYS[1] - provider state hash, KEYS[2] - probe lease, KEYS[3] - latency list; ARGV: bucket_ms, window_buckets, min_requests, threshold,
+# open_ms, alpha, ok (1/0), latency_ms, latency_samples. Returns the resulting state.
+# Bucket keys are built from KEYS[1] (the bucket number is only known inside the script); all
+# keys of a provider share its {provider} hash tag, so the script also runs on Redis Cluster.
+RECORD_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local bucket_ms = tonumber(ARGV[1])
+local nb = tonumber(ARGV[2])
+local min_req = tonumber(ARGV[3])
+local threshold = tonumber(ARGV[4])
+local open_ms = tonumber(ARGV[5])
+local alpha = tonumber(ARGV[6])
+local ok = tonumber(ARGV[7])
+local latency = tonumber(ARGV[8])
+
+local b = math.floor(now / bucket_ms)
+local bkey = KEYS[1] .. ':b:' .. b
+redis.call('HINCRBY', bkey, ok == 1 and 'ok' or 'err', 1)
+redis.call('PEXPIRE', bkey, bucket_ms * (nb + 1))
+
+local ewma = tonumber(redis.call('HGET', KEYS[1], 'ewma_ms') or '')
+if ewma then ewma = alpha * latency + (1 - alpha) * ewma else ewma = latency end
+redis.call('HSET', KEYS[1], 'ewma_ms', tostring(math.floor(ewma)))
+if ok == 1 then
+  redis.call('LPUSH', KEYS[3], latency)
+  redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[9]) - 1)
+end
+
+local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+if state == 'half_open' or state == 'open' then
+  if ok == 1 then
+    state = 'closed'
+    redis.call('DEL', KEYS[2])
+    for i = 0, nb - 1 do redis.call('DEL', KEYS[1] .. ':b:' .. (b - i)) end
+  elseif state == 'half_open' then
+    state = 'open'
+    redis.call('DEL', KEYS[2])
+    redis.call('HSET', KEYS[1], 'open_until', now + open_ms)
+  end
+elseif ok == 0 then
+  local total, errs = 0, 0
+  for i = 0, nb - 1 do
+    local v = redis.call('HMGET', KEYS[1] .. ':b:' .. (b - i), 'ok', 'err')
+    total = total + (tonumber(v[1]) or 0) + (tonumber(v[2]) or 0)
+    errs = errs + (tonumber(v[2]) or 0)
+  end
+  if total >= min_req and errs / total >= threshold then
+    state = 'open'
+    redis.call('HSET', KEYS[1], 'open_until', now + open_ms)
+  end
+end
+redis.call('HSET', KEYS[1], 'state', state)
+return state
+"""
+
+
+class ProviderHealth:
+    """
+    Per-provider circuit breaker shared through Redis (one Lua call per check/record).
+
+    allow() is asked before sending a request; record() reports the outcome and
+    latency. Fails open: if Redis is unavailable every provider is considered healthy.
+    """
+
+    def __init__(self, redis_client: redis.Redis, policy: Optional[BreakerPolicy] = None, prefix: str = "nph"):
+        self.policy = policy or BreakerPolicy()
+        self._redis = redis_client
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._record = redis_client.register_script(RECORD_SCRIPT)
+        self._prefix = prefix
+        self._logger = logging.getLogger("nanobanana.provider_health")
+
+    def _key(self, provider: str) -> str:
+        # Hash tag keeps all keys of a provider in one cluster slot
+        return f"{self._prefix}:{{{provider}}}"
+
+    async def allow(self, provider: str) -> bool:
+        try:
+            return bool(int(await self._acquire(
+                keys=[self._key(provider), f"{self._key(provider)}:probe"],
+                args=[int(self.policy.probe_lease_seconds * 1000)],
+            )))
+        except Exception:
+            self._logger.debug("Provider health check failed for %s, allowing", provider, exc_info=True)
+            return True
+
+    async def record(self, provider: str, ok: bool, latency_seconds: float) -> None:
+        p = self.policy
+        try:
+            state = await self._record(
+                keys=[self._key(provider), f"{self._key(provider)}:probe", f"{self._key(provider)}:lat"],
+                args=[
+                    int(p.bucket_seconds * 1000),
+                    int(p.window_buckets),
+                    int(p.min_requests),
+                    float(p.error_rate_threshold),
+                    int(p.open_seconds * 1000),
+                    float(p.latency_alpha),
+                    1 if ok else 0,
+                    int(latency_seconds * 1000),
+                    int(p.latency_samples),
+                ],
+            )
+            if state == "open" and not ok:
+                self._logger.warning("Circuit for provider %s is open", provider)
+        except Exception:
+            self._logger.debug("Failed to record provider outcome for %s", provider, exc_info=True)
+
+    async def latency_percentile(self, provider: str, percentile: float, min_samples: int = 10) -> Optional[float]:
+        """
+        Nearest-rank percentile (0-100) of recent successful call latencies, in seconds.
+        None while fewer than min_samples are known or Redis is unavailable.
+        """
+        try:
+            raw = await self._redis.lrange(f"{self._key(provider)}:lat", 0, -1)
+        except Exception:
+            return None
+        samples = sorted(int(v) for v in raw)
+        if len(samples) < max(1, min_samples):
+            return None
+        rank = max(1, math.ceil(percentile / 100 * len(samples)))
+        return samples[min(rank, len(samples)) - 1] / 1000
+
+    async def snapshot(self, provider: str) -> Dict[str, Any]:
+        """State, open_until and latency EWMA of a provider (for logs/diagnostics)."""
+        try:
+            return await self._redis.hgetall(self._key(provider))
+        except Exception:
+            return {}
+
@@ -1,15 +1,32 @@
 import os
+import asyncio
+import hashlib
+import aiohttp
 import aioboto3
 import logging
+from contextlib import AsyncExitStack, asynccontextmanager
 from botocore.config import Config
 from uuid import uuid4
 import mimetypes
 from urllib.parse import urlparse
 
+from .http import HttpSessionManager, session_scope
+
 _logger = logging.getLogger("r2_client")
 
+# S3/R2 multipart: every part except the last must be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+# Mirrored outputs are keyed by content hash, so the object under a key never changes
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class SourceGone(Exception):
+    """The source URL answered 404/410 (e.g. an expired provider link); retrying cannot help."""
+
+
 class R2Client:
-    def __init__(self):
+    def __init__(self, http: HttpSessionManager | None = None, part_size: int = 8 * 1024 * 1024):
         self.account_id = os.getenv("R2_ACCOUNT_ID")
         self.access_key_id = os.getenv("R2_ACCESS_KEY_ID")
         self.secret_access_key = os.getenv("R2_SECRET_ACCESS_KEY")
@@ -21,6 +38,55 @@ class R2Client:
 
         self.endpoint_url = f"https://{self.account_id}.r2.cloudflarestorage.com"
         self.session = aioboto3.Session()
+        self.http = http
+        # Upper bound of bytes buffered per streaming upload
+        self.part_size = max(MIN_PART_SIZE, int(part_size))
+        self.max_pool_connections = int(os.getenv("R2_MAX_POOL_CONNECTIONS", "20"))
+        self.retry_mode = os.getenv("R2_RETRY_MODE", "standard")
+        self.max_attempts = int(os.getenv("R2_MAX_ATTEMPTS", "3"))
+        self.upload_concurrency = int(os.getenv("R2_UPLOAD_CONCURRENCY", "4"))
+
+        # Long-lived S3 client (see start/close); None until started
+        self._client = None
+        self._exit_stack: AsyncExitStack | None = None
+        self._start_lock = asyncio.Lock()
+
+    def _client_context(self):
+        return self.session.client(
+            "s3",
+            endpoint_url=self.endpoint_url,
+            aws_access_key_id=self.access_key_id,
+            aws_secret_access_key=self.secret_access_key,
+            region_name="auto",  # R2 requires region to be 'auto' or specific, but 'auto' is common
+            config=Config(
+                signature_version="s3v4",
+                max_pool_connections=self.max_pool_connections,
+                retries={"mode": self.retry_mode, "total_max_attempts": self.max_attempts},
+            ),
+        )
+
+    async def start(self) -> None:
+        """Opens the shared S3 client (botocore client + connection pool) once for the app lifetime."""
+        async with self._start_lock:
+            if self._client is not None:
+                return
+            stack = AsyncExitStack()
+            self._client = await stack.enter_async_context(self._client_context())
+            self._exit_stack = stack
+
+    async def close(self) -> None:
+        stack, self._exit_stack, self._client = self._exit_stack, None, None
+        if stack is not None:
+            await stack.aclose()
+
+    @asynccontextmanager
+    async def _s3(self):
+        """Shared client once started; otherwise a short-lived one (scripts, tests)."""
+        if self._client is not None:
+            yield self._client
+            return
+        async with self._client_context() as s3:
+            yield s3
 
     async def upload_file_from_bytes(self, file_bytes: bytes, content_type: str = "image/png", file_extension: str = None) -> str | None:
         """
@@ -35,14 +101,7 @@ class R2Client:
         filename = f"{uuid4().hex}{ext}"
 
         try:
-            async with self.session.client(
-                "s3",
-                endpoint_url=self.endpoint_url,
-                aws_access_key_id=self.access_key_id,
-                aws_secret_access_key=self.secret_access_key,
-                region_name="auto",  # R2 requires region to be 'auto' or specific, but 'auto' is common
-                config=Config(signature_version="s3v4"),
-            ) as s3:
+            async with self._s3() as s3:
                 await s3.put_object(
                     Bucket=self.bucket_name,
                     Key=filename,
@@ -57,20 +116,28 @@ class R2Client:
 
     async def upload_file_from_url(self, url: str) -> str | None:
         """
-        Downloads a file from a URL and uploads it to R2.
-        """
-        import aiohttp
+        Streams a file from a URL into R2 without holding it fully in memory.
 
+        At most part_size bytes are buffered: files smaller than one part go through a
+        single put_object, larger ones through a multipart upload (aborted on failure).
+        Content type is taken from the response or sniffed from the first chunk.
+        """
+        if not self.bucket_name:
+            return None
         try:
-            async with aiohttp.ClientSession() as session:
+            async with session_scope(self.http) as session:
                 async with session.get(url) as resp:
                     if resp.status != 200:
                         _logger.error(f"Failed to download file from {url}: status {resp.status}")
                         return None
-                    content = await resp.read()
+
+                    chunks = resp.content.iter_chunked(READ_CHUNK_SIZE)
+                    buffer = bytearray()
+                    eof = await self._fill(buffer, chunks)
+
                     content_type = (resp.headers.get("Content-Type") or "").split(";", 1)[0].strip().lower()
                     if not content_type.startswith("image/"):
-                        detected = self._detect_image_content_type(content)
+                        detected = self._detect_image_content_type(bytes(buffer[:16]))
                         if detected:
                             _logger.info(
                                 "Overriding URL content-type %r -> %r for %s",
@@ -81,17 +148,181 @@ class R2Client:
                             content_type = detected
                     if not content_type:
                         content_type = "image/png"
-            
-            # Extract extension from URL path only (ignore query tokens/signatures).
-            parsed = urlparse(url)
-            file_extension = os.path.splitext(parsed.path)[1]
-            file_extension = self._normalize_extension(file_extension)
 
-            return await self.upload_file_from_bytes(content, content_type, file_extension=file_extension)
+                    # Extract extension from URL path only (ignore query tokens/signatures).
+                    parsed = urlparse(url)
+                    file_extension = self._normalize_extension(os.path.splitext(parsed.path)[1])
+
+                    if eof:
+                        return await self.upload_file_from_bytes(bytes(buffer), content_type, file_extension=file_extension)
+                    return await self._upload_multipart(buffer, chunks, content_type, file_extension)
         except Exception as e:
             _logger.error(f"Failed to process URL upload for {url}: {e}")
             return None
 
+    def is_public_url(self, url: str) -> bool:
+        """True for URLs already served from this bucket's public domain."""
+        return bool(self.public_url) and str(url).startswith(f"{self.public_url}/")
+
+    async def mirror_from_url(self, url: str, prefix: str = "outputs", timeout: float = 120.0) -> str | None:
+        """
+        Copies a generated output to R2 under an immutable content-hash key
+        ({prefix}/{sha256}{ext}) with long cache headers and returns the public URL.
+
+        Streams like upload_file_from_url: an output that fits in one part is hashed and
+        put directly; a larger one goes through a multipart upload to a temporary key and
+        is then copied server-side to its hash key. A key that already exists is not
+        uploaded again. Raises SourceGone for 404/410; other failures return None.
+        timeout bounds the whole download and must stay below the job lease.
+        """
+        if not self.bucket_name:
+            return None
+        try:
+            async with session_scope(self.http) as session:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    if resp.status in (404, 410):
+                        raise SourceGone(f"{url}: status {resp.status}")
+                    if resp.status != 200:
+                        _logger.error(f"Failed to download output from {url}: status {resp.status}")
+                        return None
+
+                    digest = hashlib.sha256()
+
+                    async def hashed():
+                        async for chunk in resp.content.iter_chunked(READ_CHUNK_SIZE):
+                            digest.update(chunk)
+                            yield chunk
+
+                    chunks = hashed()
+                    buffer = bytearray()
+                    eof = await self._fill(buffer, chunks)
+
+                    header_type = (resp.headers.get("Content-Type") or "").split(";", 1)[0].strip().lower()
+                    content_type = header_type if header_type.startswith("image/") else None
+                    content_type = content_type or self._detect_image_content_type(bytes(buffer[:16])) or "image/png"
+                    ext = (
+                        self._normalize_extension(os.path.splitext(urlparse(url).path)[1])
+                        or self._normalize_extension(mimetypes.guess_extension(content_type))
+                        or ".png"
+                    )
+
+                    if eof:
+                        key = f"{prefix}/{digest.hexdigest()}{ext}"
+                        async with self._s3() as s3:
+                            if not await self._exists(s3, key):
+                                await s3.put_object(
+                                    Bucket=self.bucket_name,
+                                    Key=key,
+                                    Body=bytes(buffer),
+                                    ContentType=content_type,
+                                    CacheControl=IMMUTABLE_CACHE_CONTROL,
+                                )
+                        return f"{self.public_url}/{key}"
+
+                    tmp_key = f"{prefix}/tmp/{uuid4().hex}{ext}"
+                    await self._upload_multipart(buffer, chunks, content_type, ext, key=tmp_key)
+
+            key = f"{prefix}/{digest.hexdigest()}{ext}"
+            async with self._s3() as s3:
+                try:
+                    if not await self._exists(s3, key):
+                        await s3.copy_object(
+                            Bucket=self.bucket_name,
+                            Key=key,
+                            CopySource={"Bucket": self.bucket_name, "Key": tmp_key},
+                            MetadataDirective="REPLACE",
+                            ContentType=content_type,
+                            CacheControl=IMMUTABLE_CACHE_CONTROL,
+                        )
+                finally:
+                    try:
+                        await s3.delete_object(Bucket=self.bucket_name, Key=tmp_key)
+                    except Exception:
+                        _logger.warning("Failed to delete temporary mirror object %s", tmp_key)
+            return f"{self.public_url}/{key}"
+        except SourceGone:
+            raise
+        except Exception as e:
+            _logger.error(f"Failed to mirror output {url}: {e}")
+            return None
+
+    async def _exists(self, s3, key: str) -> bool:
+        try:
+            await s3.head_object(Bucket=self.bucket_name, Key=key)
+            return True
+        except Exception:
+            return False
+
+    async def upload_many(self, urls: list[str]) -> list[str | None]:
+        """
+        Uploads several URLs concurrently (bounded by R2_UPLOAD_CONCURRENCY).
+        Returns R2 URLs in input order, None where an upload failed.
+        """
+        sem = asyncio.Semaphore(max(1, self.upload_concurrency))
+
+        async def one(url: str) -> str | None:
+            async with sem:
+                return await self.upload_file_from_url(url)
+
+        return list(await asyncio.gather(*(one(u) for u in urls)))
+
+    async def _fill(self, buffer: bytearray, chunks) -> bool:
+        """Reads chunks into buffer until it holds part_size bytes. Returns True at end of stream."""
+        while len(buffer) < self.part_size:
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return True
+            buffer.extend(chunk)
+        return False
+
+    async def _upload_multipart(
+        self, buffer: bytearray, chunks, content_type: str, file_extension: str | None, key: str | None = None
+    ) -> str | None:
+        guessed_by_type = mimetypes.guess_extension(content_type) or ".png"
+        ext = file_extension or self._normalize_extension(guessed_by_type) or ".png"
+        filename = key or f"{uuid4().hex}{ext}"
+
+        async with self._s3() as s3:
+            upload = await s3.create_multipart_upload(Bucket=self.bucket_name, Key=filename, ContentType=content_type)
+            upload_id = upload["UploadId"]
+            parts = []
+            try:
+                eof = False
+                while True:
+                    if not eof:
+                        eof = await self._fill(buffer, chunks)
+                    if not buffer:
+                        break
+                    # R2 requires all parts but the last to be the same size: send exactly
+                    # part_size bytes and keep the overshoot of the last chunk for the next part
+                    body = bytes(buffer[: self.part_size])
+                    del buffer[: self.part_size]
+                    part = await s3.upload_part(
+                        Bucket=self.bucket_name,
+                        Key=filename,
+                        UploadId=upload_id,
+                        PartNumber=len(parts) + 1,
+                        Body=body,
+                    )
+                    parts.append({"ETag": part["ETag"], "PartNumber": len(parts) + 1})
+                    del body
+                await s3.complete_multipart_upload(
+                    Bucket=self.bucket_name,
+                    Key=filename,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+            except Exception:
+                try:
+                    await s3.abort_multipart_upload(Bucket=self.bucket_name, Key=filename, UploadId=upload_id)
+                except Exception:
+                    _logger.warning("Failed to abort multipart upload %s for %s", upload_id, filename)
+                raise
+
+        _logger.info("Multipart upload completed: %s parts=%s", filename, len(parts))
+        return f"{self.public_url}/{filename}"
+
     @staticmethod
     def _detect_image_content_type(file_bytes: bytes) -> str | None:
         if file_bytes.startswith(b"\xff\xd8\xff"):
@@ -0,0 +1,135 @@
+"""
+Reaper - периодическая очистка "зависших" генераций (status = pending дольше порога).
+Страницы по id (keyset), статус у провайдера запрашивается параллельно с ограничением,
+а просроченные строки завершаются и возвращают токены одной RPC на страницу.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from ..database import Database
+from .nanobanana import NanoBananaClient
+from .piapi import PiapiClient
+from .provider_errors import ProviderError
+from .task_poller import ResultHandler, fetch_final_state
+
+
+# notify_expired(rows) with rows from Database.expire_generations
+ExpiredHandler = Callable[[List[Dict[str, Any]]], Awaitable[None]]
+
+EXPIRED_ERROR_MESSAGE = "Generation timed out: no result from provider"
+
+_logger = logging.getLogger("nanobanana.reaper")
+
+
+class GenerationReaper:
+    """
+    Reconciles generations left pending (lost callback, crash between accept and callback).
+
+    Rows pending longer than stale_after are checked with the provider: a final result is
+    handed to on_result (the regular callback path - delivery or failure + refund). Rows the
+    provider no longer knows, rows without a task id and rows pending longer than
+    expire_after are failed and refunded in bulk (Database.expire_generations).
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        kie: NanoBananaClient,
+        piapi: PiapiClient,
+        on_result: ResultHandler,
+        notify_expired: Optional[ExpiredHandler] = None,
+        stale_after_seconds: float = 1800,
+        expire_after_seconds: float = 3 * 3600,
+        page_size: int = 200,
+        concurrency: int = 8,
+    ):
+        self.db = db
+        self.kie = kie
+        self.piapi = piapi
+        self.on_result = on_result
+        self.notify_expired = notify_expired
+        self.stale_after = timedelta(seconds=stale_after_seconds)
+        self.expire_after = timedelta(seconds=max(stale_after_seconds, expire_after_seconds))
+        self.page_size = max(1, int(page_size))
+        self.concurrency = max(1, int(concurrency))
+
+    async def _reconcile(self, row: Dict[str, Any], now: datetime, sem: asyncio.Semaphore) -> str:
+        """Returns "delivered", "expire" or "pending"."""
+        gen_id = int(row["id"])
+        try:
+            created = datetime.fromisoformat(str(row.get("created_at")).replace("Z", "+00:00"))
+        except ValueError:
+            created = now - self.expire_after
+        overdue = now - created >= self.expire_after
+        task_id = row.get("provider_task_id")
+        if not task_id:
+            # Nothing to ask the provider about (accepted before task ids were stored, or never sent)
+            return "expire" if overdue else "pending"
+
+        provider = row.get("api_provider") or "kie"
+        async with sem:
+            try:
+                payload = await fetch_final_state(self.kie, self.piapi, provider, str(task_id))
+            except ProviderError as e:
+                # The provider does not know the task (4xx) - it will never call back
+                return "expire" if overdue or not e.retryable else "pending"
+            except Exception as e:
+                _logger.debug("Status check failed for generation %s: %s", gen_id, e)
+                return "expire" if overdue else "pending"
+        if payload is None:
+            return "expire" if overdue else "pending"
+        try:
+            await self.on_result(provider, str(task_id), gen_id, payload)
+        except Exception:
+            _logger.exception("Failed to finalize generation %s from provider status", gen_id)
+            return "pending"
+        return "delivered"
+
+    async def sweep(self) -> Dict[str, int]:
+        """One pass over all stale pending generations; returns counts per outcome."""
+        now = datetime.now(timezone.utc)
+        cutoff = now - self.stale_after
+        sem = asyncio.Semaphore(self.concurrency)
+        counts = {"delivered": 0, "expired": 0, "pending": 0}
+        after_id = 0
+        while True:
+            rows = await self.db.list_stale_generations(cutoff, after_id=after_id, limit=self.page_size)
+            if not rows:
+                break
+            after_id = int(rows[-1]["id"])
+            outcomes = await asyncio.gather(*(self._reconcile(row, now, sem) for row in rows))
+            to_expire = [int(row["id"]) for row, outcome in zip(rows, outcomes) if outcome == "expire"]
+            counts["delivered"] += outcomes.count("delivered")
+            counts["pending"] += outcomes.count("pending")
+            if to_expire:
+                expired = await self.db.expire_generations(to_expire, EXPIRED_ERROR_MESSAGE)
+                counts["expired"] += len(expired)
+                if expired and self.notify_expired is not None:
+                    try:
+                        await self.notify_expired(expired)
+                    except Exception:
+                        _logger.warning("Failed to notify users about expired generations", exc_info=True)
+            if len(rows) < self.page_size:
+                break
+        return counts
+
+
+async def run_generation_reaper(
+    reaper: GenerationReaper,
+    interval_seconds: int,
+    acquire: Optional[Callable[[], Awaitable[bool]]] = None,
+) -> None:
+    """Periodic sweeps. acquire() (e.g. a Redis claim) lets only one replica sweep per interval."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            if acquire is not None and not await acquire():
+                continue
+            counts = await reaper.sweep()
+            if any(counts.values()):
+                _logger.info("Stale generations: %s", counts)
+        except Exception as e:
+            _logger.warning("Generation reaper sweep failed: %s", e)
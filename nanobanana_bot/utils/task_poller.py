@@ -0,0 +1,219 @@
+"""
+Task Poller - сверка статуса задач KIE и Piapi, если callback не пришёл.
+Одна приоритетная очередь (heap) по времени следующей проверки вместо корутины
+на каждую задачу; частота запросов ограничена бюджетом на провайдера.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .nanobanana import NanoBananaClient
+from .piapi import PiapiClient
+from .provider_errors import ProviderRateLimited
+
+
+# on_result(provider, task_id, generation_id, payload); payload has the provider's callback shape
+ResultHandler = Callable[[str, str, Optional[int], Dict[str, Any]], Awaitable[None]]
+
+KIE_FINAL_STATES = ("success", "fail")
+PIAPI_FINAL_STATES = ("completed", "failed")
+
+
+async def fetch_final_state(
+    kie: NanoBananaClient, piapi: PiapiClient, provider: str, task_id: str
+) -> Optional[Dict[str, Any]]:
+    """Callback-shaped payload if the task reached a final state, else None. Raises ProviderError."""
+    if provider == "kie":
+        data = await kie.get_record_info(task_id)
+        state = str((data.get("data") or {}).get("state") or "").lower()
+        return data if state in KIE_FINAL_STATES else None
+    task = await piapi.get_task(task_id)
+    status = str(task.get("status") or "").lower()
+    return {"data": task} if status in PIAPI_FINAL_STATES else None
+
+
+@dataclass(order=True)
+class _Entry:
+    due: float
+    seq: int
+    provider: str = field(compare=False)
+    task_id: str = field(compare=False)
+    generation_id: Optional[int] = field(compare=False, default=None)
+    started: float = field(compare=False, default=0.0)
+    checks: int = field(compare=False, default=0)
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(0.01, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        """Takes a token and returns 0, or returns how long to wait for the next one."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self) -> None:
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+
+class TaskPoller:
+    """
+    Multiplexed status poller for provider tasks that are waiting for a callback.
+
+    track() adds a task; the first check is scheduled a little after the provider's
+    typical completion time (EWMA of observed completions), later checks back off up
+    to max_interval. Checks are paced by a per-provider token bucket (requests/second).
+    A final state is passed to on_result in the same shape as the provider's callback;
+    forget() drops a task whose callback did arrive. Tasks older than max_age are dropped.
+    """
+
+    def __init__(
+        self,
+        kie: NanoBananaClient,
+        piapi: PiapiClient,
+        on_result: ResultHandler,
+        rates: Optional[Dict[str, float]] = None,
+        expected_seconds: float = 60.0,
+        min_interval: float = 10.0,
+        max_interval: float = 120.0,
+        max_age: float = 1800.0,
+        concurrency: int = 8,
+    ):
+        self.kie = kie
+        self.piapi = piapi
+        self.on_result = on_result
+        rates = rates or {"kie": 2.0, "piapi": 1.0}
+        self._buckets = {p: _TokenBucket(r, burst=max(1.0, r * 2)) for p, r in rates.items()}
+        # Per-provider EWMA of task completion time, seconds
+        self._expected: Dict[str, float] = {p: float(expected_seconds) for p in rates}
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.max_age = float(max_age)
+        self._heap: List[_Entry] = []
+        self._active: Dict[Tuple[str, str], _Entry] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._sem = asyncio.Semaphore(max(1, int(concurrency)))
+        self._inflight: set[asyncio.Task] = set()
+        self._logger = logging.getLogger("nanobanana.task_poller")
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def _push(self, entry: _Entry) -> None:
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def _observe(self, provider: str, duration: float) -> None:
+        if provider in self._expected and duration > 0:
+            self._expected[provider] = 0.2 * duration + 0.8 * self._expected[provider]
+
+    def track(self, provider: str, task_id: str, generation_id: Optional[int] = None, age_seconds: float = 0.0) -> None:
+        """Start watching a task (age_seconds > 0 for tasks recovered after a restart)."""
+        if provider not in self._buckets or not task_id:
+            return
+        key = (provider, str(task_id))
+        if key in self._active:
+            return
+        now = time.monotonic()
+        started = now - max(0.0, age_seconds)
+        # Give the callback a fair chance first: 1.5x the usual completion time
+        due = max(now, started + max(self.min_interval, self._expected[provider] * 1.5))
+        entry = _Entry(due, next(self._seq), provider, str(task_id), generation_id, started)
+        self._active[key] = entry
+        self._push(entry)
+
+    def forget(self, provider: str, task_id: Any, completed: bool = True) -> None:
+        """The task's callback arrived: stop polling it (heap entries are skipped lazily)."""
+        entry = self._active.pop((provider, str(task_id)), None)
+        if entry is not None and completed:
+            self._observe(provider, time.monotonic() - entry.started)
+
+    def _next_interval(self, entry: _Entry) -> float:
+        base = max(self.min_interval, self._expected[entry.provider] * 0.25)
+        return min(self.max_interval, base * (2 ** min(entry.checks, 6)))
+
+    async def _check(self, entry: _Entry) -> None:
+        key = (entry.provider, entry.task_id)
+        async with self._sem:
+            try:
+                payload = await fetch_final_state(self.kie, self.piapi, entry.provider, entry.task_id)
+            except ProviderRateLimited:
+                self._buckets[entry.provider].drain()
+                payload = None
+            except Exception as e:
+                self._logger.debug("Status check failed for %s task %s: %s", entry.provider, entry.task_id, e)
+                payload = None
+        if self._active.get(key) is not entry:
+            # Callback arrived while we were checking
+            return
+        if payload is not None:
+            self._active.pop(key, None)
+            self._observe(entry.provider, time.monotonic() - entry.started)
+            self._logger.info("Task %s/%s finished without a callback, delivering polled result", entry.provider, entry.task_id)
+            try:
+                await self.on_result(entry.provider, entry.task_id, entry.generation_id, payload)
+            except Exception:
+                self._logger.exception("Failed to handle polled result for %s task %s", entry.provider, entry.task_id)
+            return
+        entry.checks += 1
+        now = time.monotonic()
+        if now - entry.started > self.max_age:
+            self._active.pop(key, None)
+            self._logger.warning("Giving up on %s task %s after %.0fs", entry.provider, entry.task_id, now - entry.started)
+            return
+        entry.due = now + self._next_interval(entry)
+        entry.seq = next(self._seq)
+        self._push(entry)
+
+    async def run(self) -> None:
+        """Single loop for all tracked tasks; runs until cancelled."""
+        try:
+            while True:
+                if not self._heap:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                entry = self._heap[0]
+                if self._active.get((entry.provider, entry.task_id)) is not entry:
+                    heapq.heappop(self._heap)
+                    continue
+                delay = entry.due - time.monotonic()
+                if delay <= 0:
+                    delay = self._buckets[entry.provider].wait_time()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        task = asyncio.create_task(self._check(entry))
+                        self._inflight.add(task)
+                        task.add_done_callback(self._inflight.discard)
+                        continue
+                    # Over budget: push this check back instead of blocking other providers
+                    heapq.heappop(self._heap)
+                    entry.due = time.monotonic() + delay
+                    entry.seq = next(self._seq)
+                    heapq.heappush(self._heap, entry)
+                    continue
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in list(self._inflight):
+                task.cancel()
+            await asyncio.gather(*self._inflight, return_exceptions=True)
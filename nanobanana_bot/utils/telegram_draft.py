@@ -1,4 +1,6 @@
+import asyncio
 import logging
+from typing import Dict, Optional, Tuple
 
 import httpx
 from aiogram import Bot
@@ -6,6 +8,107 @@ from aiogram import Bot
 
 _logger = logging.getLogger("nanobanana.telegram_draft")
 
+TELEGRAM_API_BASE = "https://api.telegram.org"
+
+DraftKey = Tuple[int, int]
+
+
+class DraftSender:
+    """
+    Long-lived sendMessageDraft client.
+
+    Keeps one HTTP/2-capable httpx.AsyncClient with a bounded pool instead of
+    opening a new connection for every draft update. With coalescing enabled,
+    while a draft for (chat_id, draft_id) is in flight only the newest queued
+    text is kept; superseded texts are dropped and their callers get False.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        timeout_seconds: float = 10.0,
+        http2: bool = True,
+        coalesce: bool = True,
+    ):
+        self.coalesce = bool(coalesce)
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            timeout=timeout_seconds,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+        )
+        self._inflight: set[DraftKey] = set()
+        self._queued: Dict[DraftKey, Tuple[str, asyncio.Future]] = {}
+
+    async def send(self, bot: Bot, chat_id: int, draft_id: int, text: str) -> bool:
+        if not self.coalesce:
+            return await self._post(bot, chat_id, draft_id, text)
+
+        key = (chat_id, draft_id)
+        if key in self._inflight:
+            # Заменяем ранее поставленный в очередь текст: он уже устарел
+            fut = asyncio.get_running_loop().create_future()
+            previous = self._queued.get(key)
+            self._queued[key] = (text, fut)
+            if previous is not None and not previous[1].done():
+                previous[1].set_result(False)
+            return await fut
+
+        self._inflight.add(key)
+        try:
+            ok = await self._post(bot, chat_id, draft_id, text)
+            # Отправляем только самый свежий текст, накопившийся за время запроса
+            while key in self._queued:
+                next_text, next_fut = self._queued.pop(key)
+                next_ok = await self._post(bot, chat_id, draft_id, next_text)
+                if not next_fut.done():
+                    next_fut.set_result(next_ok)
+            return ok
+        finally:
+            self._inflight.discard(key)
+            leftover = self._queued.pop(key, None)
+            if leftover is not None and not leftover[1].done():
+                leftover[1].set_result(False)
+
+    async def _post(self, bot: Bot, chat_id: int, draft_id: int, text: str) -> bool:
+        payload = {
+            "chat_id": chat_id,
+            "draft_id": draft_id,
+            "text": text,
+        }
+        url = f"{TELEGRAM_API_BASE}/bot{bot.token}/sendMessageDraft"
+        try:
+            response = await self._client.post(url, json=payload)
+            if response.status_code >= 400:
+                _logger.debug(
+                    "sendMessageDraft failed: status=%s body=%s",
+                    response.status_code,
+                    response.text[:400],
+                )
+                return False
+            data = response.json()
+            ok = bool(data.get("ok"))
+            if not ok:
+                _logger.debug("sendMessageDraft not ok: %s", data)
+            return ok
+        except Exception:
+            _logger.debug("sendMessageDraft request failed", exc_info=True)
+            return False
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+_sender: Optional[DraftSender] = None
+
+
+def setup(sender: Optional[DraftSender]) -> None:
+    global _sender
+    _sender = sender
+
 
 async def send_message_draft(bot: Bot, chat_id: int, draft_id: int, text: str) -> bool:
     """Send a real-time draft message (Bot API 9.5)."""
@@ -22,28 +125,12 @@ async def send_message_draft(bot: Bot, chat_id: int, draft_id: int, text: str) -
     if chat_id_int <= 0 or draft_id_int == 0:
         return False
 
-    payload = {
-        "chat_id": chat_id_int,
-        "draft_id": draft_id_int,
-        "text": text,
-    }
-    url = f"https://api.telegram.org/bot{bot.token}/sendMessageDraft"
+    if _sender is not None:
+        return await _sender.send(bot, chat_id_int, draft_id_int, text)
 
+    # Без настроенного отправителя — разовый клиент (например, в скриптах)
+    sender = DraftSender(coalesce=False, http2=False)
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(url, json=payload)
-        if response.status_code >= 400:
-            _logger.debug(
-                "sendMessageDraft failed: status=%s body=%s",
-                response.status_code,
-                response.text[:400],
-            )
-            return False
-        data = response.json()
-        ok = bool(data.get("ok"))
-        if not ok:
-            _logger.debug("sendMessageDraft not ok: %s", data)
-        return ok
-    except Exception:
-        _logger.debug("sendMessageDraft request failed", exc_info=True)
-        return False
+        return await sender.send(bot, chat_id_int, draft_id_int, text)
+    finally:
+        await sender.close()
@@ -0,0 +1,117 @@
+"""
+Update Queue - асинхронный приём апдейтов Telegram.
+Вебхук кладёт апдейт в очередь своего пользователя и сразу отвечает; апдейты одного
+пользователя идут строго по порядку, а медленный обработчик не задерживает других.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+
+def update_user_id(update: Update) -> Optional[int]:
+    """User id of the update sender for the update types the bot subscribes to."""
+    for event in (update.message, update.callback_query, update.pre_checkout_query):
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+    return None
+
+
+class UpdateQueue:
+    """
+    Dispatcher front-end: one FIFO lane per user, at most `workers` updates in handlers at once.
+
+    All updates of a user go to the same lane and are processed sequentially in arrival
+    order (no FSM races such as lost photos in waiting_photos). A lane exists only while it
+    has work, so a handler blocked on a provider call holds back its own user only.
+    maxsize bounds the number of queued updates across all lanes.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int = 64, maxsize: int = 1000):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.workers = max(1, int(workers))
+        self.maxsize = max(1, int(maxsize))
+        self._lanes: Dict[int, Deque[Update]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._logger = logging.getLogger("nanobanana.update_queue")
+
+    def start(self) -> None:
+        if self._sem is not None:
+            return
+        self._sem = asyncio.Semaphore(self.workers)
+        self._logger.info("Update queue started: workers=%s maxsize=%s", self.workers, self.maxsize)
+
+    @staticmethod
+    def lane_key(update: Update) -> int:
+        user_id = update_user_id(update)
+        # Апдейты без пользователя не требуют порядка — у каждого своя очередь
+        return user_id if user_id is not None else -int(update.update_id) - 1
+
+    def submit(self, update: Update) -> bool:
+        """Enqueue without waiting. Returns False if the queue is full."""
+        if self._sem is None:
+            self.start()
+        if self._pending >= self.maxsize:
+            self._logger.warning("Update queue is full (%s), rejecting update_id=%s", self._pending, update.update_id)
+            return False
+        key = self.lane_key(update)
+        self._pending += 1
+        self._idle.clear()
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane.append(update)
+            return True
+        self._lanes[key] = deque([update])
+        task = asyncio.create_task(self._drain(key), name=f"update-lane-{key}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    def qsize(self) -> int:
+        return self._pending
+
+    async def _drain(self, key: int) -> None:
+        lane = self._lanes[key]
+        try:
+            while lane:
+                update = lane[0]
+                try:
+                    async with self._sem:
+                        await self.dispatcher.feed_update(self.bot, update)
+                except Exception as e:
+                    self._logger.exception("Unhandled error while processing update %s: %s", update.update_id, e)
+                finally:
+                    lane.popleft()
+                    self._pending -= 1
+                    if self._pending == 0:
+                        self._idle.set()
+        finally:
+            # No await between the last emptiness check and here: a new update either
+            # landed in this lane before the check or will create a new lane
+            if self._lanes.get(key) is lane:
+                del self._lanes[key]
+            if lane:
+                self._pending -= len(lane)
+                if self._pending <= 0:
+                    self._pending = 0
+                    self._idle.set()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Drain what is already queued (up to timeout), then cancel the lanes."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self._logger.warning("Update queue drain timed out, %s updates dropped", self.qsize())
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
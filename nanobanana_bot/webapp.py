@@ -3,25 +3,41 @@ import asyncio
 import hmac
 import hashlib
 import json
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Mapping, Optional
+
 from fastapi import FastAPI, Request, Header, HTTPException
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.types import Update, BotCommand, BufferedInputFile, URLInputFile, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CopyTextButton
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update, BotCommand, BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CopyTextButton
 
 from .config import load_settings
-from .database import Database
+from .database import Database, generation_ledger_key
 from .cache import Cache
+from .fsm_storage import RedisFSMStorage
 from .utils.nanobanana import NanoBananaClient
 from .utils.piapi import PiapiClient
 from .utils.generation_service import GenerationService
+from .utils.jobs import JobQueue, PermanentJobError
+from .utils.provider_errors import ProviderError, TaskAccepted
+from .utils.provider_health import BreakerPolicy, ProviderHealth
+from .utils.task_poller import PIAPI_FINAL_STATES, TaskPoller
+from .utils.reaper import GenerationReaper, run_generation_reaper
 from .utils.i18n import t, normalize_lang
 from .utils.r2 import R2Client
-from .utils.telegram_draft import send_message_draft
+from .utils.http import HttpSessionManager
+from .utils.delivery import ResultDelivery
+from .utils.update_queue import UpdateQueue
+from .utils.ledger import LedgerWriter, run_balance_snapshots
+from .utils.telegram_draft import DraftSender, send_message_draft
+from .utils import telegram_draft
 from .middlewares.logging import SimpleLoggingMiddleware
 from .middlewares.rate_limit import RateLimitMiddleware
+from .middlewares.fsm_scope import FSMScopeMiddleware
+from .middlewares.user_context import UserRowMiddleware
 from .handlers import start as start_handler
 from .handlers import generate as generate_handler
 from .handlers import profile as profile_handler
@@ -42,34 +58,102 @@ logger = logging.getLogger("nanobanana.app")
 settings = load_settings()
 
 bot = Bot(token=settings.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
 
 # Shared services
 db = Database(settings.supabase_url, settings.supabase_key)
 cache = Cache(settings.redis_url)
+# app_config changes are broadcast to all replicas so they drop their cached value
+APP_CONFIG_CHANNEL = "napp_config"
+db.app_config_ttl_seconds = settings.app_config_cache_ttl_seconds
+db.set_app_config_notifier(lambda key: cache.publish(APP_CONFIG_CHANNEL, key))
+
+# FSM state in Redis so several workers/replicas can serve the same users
+fsm_storage = RedisFSMStorage(
+    cache,
+    state_ttls={
+        "GenerateStates": 6 * 3600,
+        "AvatarStates": 3600,
+    },
+    default_ttl=settings.fsm_state_ttl_seconds,
+)
+dp = Dispatcher(storage=fsm_storage)
+update_queue = (
+    UpdateQueue(dp, bot, workers=settings.update_workers, maxsize=settings.update_queue_size)
+    if settings.update_ingest_mode == "queue"
+    else None
+)
+http_sessions = HttpSessionManager(
+    limit=settings.http_pool_limit,
+    limit_per_host=settings.http_pool_limit_per_host,
+)
 client = NanoBananaClient(
     base_url=settings.nanobanana_api_base,
     api_key=settings.nanobanana_api_key,
     timeout_seconds=settings.request_timeout_seconds,
     callback_url=(settings.webhook_url.rstrip("/") + "/nb-callback") if settings.webhook_url else None,
+    http=http_sessions,
 )
 piapi_client = PiapiClient(
     api_key=settings.piapi_api_key,
     timeout_seconds=settings.request_timeout_seconds,
     callback_url=(settings.webhook_url.rstrip("/") + "/piapi-callback") if settings.webhook_url else None,
+    http=http_sessions,
+)
+# Reconciles accepted provider tasks whose callback never arrives (one loop for all tasks)
+task_poller = TaskPoller(
+    client,
+    piapi_client,
+    on_result=lambda provider, task_id, gen_id, payload: _on_polled_result(provider, task_id, gen_id, payload),
+    rates={"kie": settings.task_poll_kie_rps, "piapi": settings.task_poll_piapi_rps},
+    max_age=settings.task_poll_max_age_seconds,
+)
+generation_reaper = GenerationReaper(
+    db,
+    client,
+    piapi_client,
+    on_result=lambda provider, task_id, gen_id, payload: _on_polled_result(provider, task_id, gen_id, payload),
+    notify_expired=lambda rows: _notify_expired_generations(rows),
+    stale_after_seconds=settings.task_poll_max_age_seconds,
+    expire_after_seconds=settings.reaper_expire_after_seconds,
 )
 generation_service = GenerationService(
     kie_client=client,
     piapi_client=piapi_client,
     db=db,
+    # The half-open probe lease outlasts one provider request
+    health=ProviderHealth(cache.client, BreakerPolicy(probe_lease_seconds=settings.request_timeout_seconds + 30)),
+    cache=cache,
+    hedge_percentile=settings.pro_hedge_percentile,
+    hedge_max_delay_seconds=settings.pro_hedge_max_delay_ms / 1000,
+    poller=task_poller,
+)
+r2_client = R2Client(http=http_sessions)
+result_delivery = ResultDelivery(db, cache, http=http_sessions)
+draft_sender = DraftSender()
+telegram_draft.setup(draft_sender)
+ledger = LedgerWriter(
+    db,
+    max_batch=settings.ledger_batch_size,
+    max_delay_seconds=settings.ledger_batch_delay_ms / 1000,
+)
+# Durable background jobs (generation retries, R2 re-uploads); the worker starts in on_startup
+RETRY_GENERATION_JOB = "retry_generation"
+jobs = JobQueue(
+    cache.client,
+    concurrency=settings.job_worker_concurrency,
+    visibility_timeout=settings.job_visibility_timeout_seconds,
 )
-r2_client = R2Client()
+# Периодические фоновые задачи (снимки балансов и т.п.), отменяются при остановке
+background_tasks: list[asyncio.Task] = []
 
 # Middlewares
+dp.update.outer_middleware(FSMScopeMiddleware(fsm_storage))
+dp.update.outer_middleware(UserRowMiddleware(db))
+rate_limiter = RateLimitMiddleware(cache.client)
 dp.message.middleware(SimpleLoggingMiddleware(logging.getLogger("nanobanana.middleware")))
-dp.message.middleware(RateLimitMiddleware(1.0))
+dp.message.middleware(rate_limiter)
 dp.callback_query.middleware(SimpleLoggingMiddleware(logging.getLogger("nanobanana.middleware")))
-dp.callback_query.middleware(RateLimitMiddleware(1.0))
+dp.callback_query.middleware(rate_limiter)
 
 
 def generation_id_copy_keyboard(lang: str | None, generation_id: int | str) -> InlineKeyboardMarkup:
@@ -86,7 +170,7 @@ def generation_id_copy_keyboard(lang: str | None, generation_id: int | str) -> I
 
 # Handlers setup
 start_handler.setup(db)
-generate_handler.setup(client, db, cache, r2_client, generation_service)
+generate_handler.setup(client, db, cache, r2_client, generation_service, jobs=jobs, delivery=result_delivery)
 profile_handler.setup(db)
 topup_handler.setup(db, settings)
 prices_handler.setup(db)
@@ -149,6 +233,43 @@ async def on_startup() -> None:
     # Initialize async Supabase client
     await db.init()
 
+    if update_queue is not None:
+        update_queue.start()
+    if r2_client.bucket_name:
+        try:
+            await r2_client.start()
+        except Exception:
+            logger.warning("Failed to open R2 client, uploads will use per-call clients", exc_info=True)
+    background_tasks.append(
+        asyncio.create_task(
+            cache.listen(
+                APP_CONFIG_CHANNEL,
+                db.invalidate_app_config,
+                # Changes may have been missed while unsubscribed
+                on_subscribe=db.invalidate_app_config,
+            )
+        )
+    )
+    if jobs.concurrency > 0:
+        background_tasks.append(asyncio.create_task(jobs.run()))
+    background_tasks.append(asyncio.create_task(task_poller.run()))
+    if settings.reaper_interval_seconds > 0:
+        background_tasks.append(
+            asyncio.create_task(
+                run_generation_reaper(
+                    generation_reaper,
+                    settings.reaper_interval_seconds,
+                    # One replica per interval
+                    acquire=lambda: cache.claim_once("nreaper:sweep", max(1, settings.reaper_interval_seconds - 5)),
+                )
+            )
+        )
+    await _recover_pending_tasks()
+    if settings.balance_snapshot_interval_seconds > 0:
+        background_tasks.append(
+            asyncio.create_task(run_balance_snapshots(db, settings.balance_snapshot_interval_seconds))
+        )
+
     # Ensure webhook URL is provided for webhook mode
     if not settings.webhook_url:
         raise RuntimeError("WEBHOOK_URL is required for webhook mode (Railway)")
@@ -289,7 +410,29 @@ async def on_startup() -> None:
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
     # Gracefully close external resources
+    if update_queue is not None:
+        await update_queue.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    try:
+        await ledger.close()
+    except Exception:
+        logger.debug("Failed to flush ledger", exc_info=True)
     await bot.session.close()
+    try:
+        await http_sessions.close()
+    except Exception:
+        logger.debug("Failed to close HTTP pool", exc_info=True)
+    try:
+        await draft_sender.close()
+    except Exception:
+        logger.debug("Failed to close draft sender", exc_info=True)
+    try:
+        await r2_client.close()
+    except Exception:
+        logger.debug("Failed to close R2 client", exc_info=True)
     try:
         await cache.close()
     except Exception:
@@ -313,6 +456,11 @@ async def telegram_webhook(
     data = await request.json()
     logger.debug("Incoming update JSON: %s", data)
     update = Update.model_validate(data)
+    if update_queue is not None:
+        # Ack immediately; workers process the update. On overflow let Telegram redeliver later.
+        if not update_queue.submit(update):
+            raise HTTPException(status_code=503, detail="Update queue is full")
+        return {"ok": True}
     try:
         await dp.feed_update(bot, update)
     except Exception as e:
@@ -321,13 +469,286 @@ async def telegram_webhook(
     return {"ok": True}
 
 
+async def _claim_callback(provider: str, task_id: Any, status: Any) -> Optional[str]:
+    """
+    Claims (provider, task_id, status) in Redis. Returns the claim key, or None if this
+    delivery is a duplicate. Without a task id or when Redis is down nothing is deduplicated.
+    """
+    if not task_id:
+        return ""
+    key = f"ncb:{provider}:{task_id}:{str(status or '').lower()}"
+    try:
+        if not await cache.claim_once(key, settings.callback_dedup_ttl_seconds):
+            return None
+    except Exception:
+        logger.debug("Callback dedup unavailable, processing %s", key, exc_info=True)
+        return ""
+    return key
+
+
+async def _is_hedge_loser(provider: str, query: Mapping[str, str]) -> bool:
+    """True if the generation was hedged and another provider's task won it."""
+    if settings.pro_hedge_percentile <= 0:
+        return False
+    gen_id = query.get("generationId")
+    if not gen_id:
+        return False
+    try:
+        winner = await cache.get_hedge_winner(int(gen_id))
+    except Exception:
+        return False
+    return bool(winner) and winner != provider
+
+
+async def _release_callback(key: str) -> None:
+    if not key:
+        return
+    try:
+        await cache.release_claim(key)
+    except Exception:
+        logger.debug("Failed to release callback claim %s", key, exc_info=True)
+
+
+async def _retry_generation_job(payload: dict) -> None:
+    """Job: re-submits a generation that KIE failed with an internal error (see nanobanana_callback)."""
+    generation_id = int(payload["generation_id"])
+    gen = await db.get_generation(generation_id)
+    if not gen:
+        raise PermanentJobError(f"generation {generation_id} not found")
+
+    prompt_with_meta = gen.get("prompt", "")
+    prompt = prompt_with_meta.split(" [type=")[0].strip()
+    db_model = gen.get("model")
+    model = "nano-banana-pro" if db_model == "nanobanana-pro" else "google/nano-banana"
+
+    ratio_val = "auto"
+    m = re.search(r"ratio=([^;\]]+)", prompt_with_meta)
+    if m:
+        ratio_val = m.group(1).strip()
+
+    ratio_map = {
+        "1:1": "1:1",
+        "3:4": "3:4",
+        "4:3": "4:3",
+        "9:16": "9:16",
+        "16:9": "16:9",
+    }
+    image_size = ratio_map.get(ratio_val)
+    image_urls = gen.get("input_images", [])
+
+    new_meta = {
+        "generationId": generation_id,
+        "userId": payload["user_id"],
+        "tokens": payload["tokens"],
+        "retry_count": payload["retry_count"],
+    }
+    try:
+        if model == "nano-banana-pro":
+            result = await generation_service.generate_pro(
+                prompt=prompt,
+                image_urls=image_urls or None,
+                aspect_ratio=image_size,
+                resolution="2K",
+                meta=new_meta
+            )
+            if not result.get("awaiting_callback") and result.get("image_url"):
+                await _complete_retried_generation(generation_id, int(payload["user_id"]), result["image_url"])
+                return
+            try:
+                await db.update_generation_task(generation_id, result.get("provider", "kie"), result.get("task_id"))
+            except Exception:
+                logger.debug("Failed to store provider task for generation %s", generation_id, exc_info=True)
+        else:
+            image_url = await client.generate_image(
+                prompt=prompt,
+                model=model,
+                image_urls=image_urls or None,
+                image_size=image_size,
+                output_format="png",
+                meta=new_meta
+            )
+            if image_url:
+                await _complete_retried_generation(generation_id, int(payload["user_id"]), image_url)
+    except TaskAccepted as e:
+        # Standard KIE path: store the new task and poll it like the first attempt
+        if e.task_id:
+            try:
+                await db.update_generation_task(generation_id, e.provider, e.task_id)
+            except Exception:
+                logger.debug("Failed to store provider task for generation %s", generation_id, exc_info=True)
+            generation_service.track_task(e.provider, e.task_id, generation_id)
+        return
+    except ProviderError as e:
+        if not e.retryable:
+            raise PermanentJobError(str(e)) from e
+        raise
+
+
+async def _complete_retried_generation(generation_id: int, user_id: int, image_url: str) -> None:
+    """The retry returned the image synchronously: complete and deliver it as a callback would."""
+    if not await db.mark_generation_completed(generation_id, image_url):
+        logger.info("Retried generation %s is no longer pending; result not delivered", generation_id)
+        return
+    await generate_handler.schedule_output_mirror(generation_id, image_url)
+    gen_ctx = await _generation_context(generation_id, user_id)
+    lang = gen_ctx["lang"]
+    try:
+        await send_message_draft(bot, user_id, generation_id, t(lang, "gen.draft.completed"))
+        await _deliver_result(user_id, generation_id, image_url, lang, gen_ctx.get("file_id"))
+    except Exception as e:
+        logger.warning("Failed to send retried generation %s to user %s: %s", generation_id, user_id, e)
+
+
+async def _retry_generation_exhausted(payload: dict) -> None:
+    """The retry never got accepted: fail the generation and refund, as the failure callback would."""
+    generation_id = int(payload["generation_id"])
+    user_id = int(payload["user_id"])
+    tokens = int(payload.get("tokens") or 0)
+    fail_msg = str(payload.get("fail_msg") or "Ошибка генерации")
+    try:
+        if not await db.mark_generation_failed(generation_id, fail_msg):
+            logger.info("Generation %s is no longer pending, skipping refund", generation_id)
+            return
+    except Exception as e:
+        logger.warning("Failed to mark generation failed id=%s: %s", generation_id, e)
+    if tokens > 0:
+        await ledger.adjust(
+            user_id,
+            tokens,
+            "refund",
+            generation_ledger_key(generation_id, "refund"),
+            generation_id=generation_id,
+        )
+    lang = (await _generation_context(generation_id, user_id))["lang"]
+    sanitized = fail_msg.replace("KIE API error:", "").replace("KIE API", "").strip()
+    refund_note = f"Токены возвращены: +{tokens}" if lang == "ru" else f"Tokens refunded: +{tokens}"
+    try:
+        await send_message_draft(bot, user_id, generation_id, t(lang, "gen.draft.failed"))
+        await bot.send_message(chat_id=user_id, text=f"Ошибка генерации: {sanitized}\n\n{refund_note}")
+    except Exception as e:
+        logger.warning("Failed to notify user %s of failure: %s", user_id, e)
+
+
+jobs.register(RETRY_GENERATION_JOB, _retry_generation_job, on_exhausted=_retry_generation_exhausted)
+
+
+async def _generation_failed(generation_id: Any) -> bool:
+    """True if the generation was already finalized as failed (e.g. expired and refunded by the reaper)."""
+    gen = await db.get_generation(int(generation_id))
+    return bool(gen) and gen.get("status") == "failed"
+
+
+async def _generation_context(generation_id: Any, user_id: Any = None) -> dict:
+    """
+    user_id, lang, tokens and the result's Telegram file_id for delivering a generation: one HGETALL of the context stored at
+    confirm time; Supabase is read only for what the context (or the callback) does not have.
+    """
+    ctx: dict = {}
+    gen_key = None
+    try:
+        gen_key = int(generation_id) if generation_id is not None else None
+    except (TypeError, ValueError):
+        pass
+    if gen_key is not None:
+        try:
+            ctx = await cache.get_generation_context(gen_key)
+        except Exception:
+            logger.debug("Failed to read generation context id=%s", gen_key, exc_info=True)
+    if user_id is None and ctx.get("user_id"):
+        user_id = int(ctx["user_id"])
+    if user_id is None and gen_key is not None:
+        try:
+            user_id = await db.get_generation_user_id(gen_key)
+        except Exception as e:
+            logger.warning("Failed to fetch user_id for generation id=%s: %s", generation_id, e)
+    lang = ctx.get("lang")
+    if not lang and user_id is not None:
+        try:
+            lang = await db.get_user_language(int(user_id))
+        except Exception:
+            lang = "ru"
+    return {
+        "user_id": user_id,
+        "lang": normalize_lang(lang),
+        "tokens": int(ctx["tokens"]) if ctx.get("tokens") else None,
+        "file_id": ctx.get("tg_file_id"),
+    }
+
+
+async def _deliver_result(user_id: int, generation_id: Any, image_url: str, lang: str, file_id: Optional[str] = None) -> None:
+    """Result document (streamed once, file_id remembered) plus the copy-id message."""
+    reply_markup = ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text=t(lang, "kb.repeat_generation"))],
+            [KeyboardButton(text=t(lang, "kb.generate")), KeyboardButton(text=t(lang, "kb.nanobanana_pro"))],
+            [KeyboardButton(text=t(lang, "kb.profile")), KeyboardButton(text=t(lang, "avatars.btn_label")), KeyboardButton(text=t(lang, "kb.topup"))],
+        ],
+        resize_keyboard=True,
+    )
+    result_caption = (
+        t(lang, "gen.result_caption_with_id", generation_id=generation_id)
+        if generation_id is not None
+        else t(lang, "gen.result_caption")
+    )
+    await result_delivery.send(
+        bot,
+        user_id,
+        int(generation_id) if generation_id is not None else None,
+        image_url,
+        caption=result_caption,
+        reply_markup=reply_markup,
+        file_id=file_id,
+    )
+    if generation_id is not None:
+        try:
+            await bot.send_message(
+                chat_id=user_id,
+                text=t(lang, "gen.generation_id", generation_id=generation_id),
+                reply_markup=generation_id_copy_keyboard(lang, generation_id),
+            )
+        except Exception as e_copy:
+            logger.warning("Failed to send copy-id button to user %s: %s", user_id, e_copy)
+
+
 @app.post("/nb-callback")
 async def nanobanana_callback(request: Request) -> dict:
     """
     Callback endpoint for NanoBanana API to deliver generated images.
     Expected JSON may include keys like: imageUrl/image_url, generationId, userId, taskId.
+    Redeliveries of the same (taskId, state) are acknowledged without processing.
     """
     data = await request.json()
+    return await _handle_kie_result(request.query_params, data)
+
+
+async def _handle_kie_result(query: Mapping[str, str], data: dict) -> dict:
+    """Shared by the callback endpoint and the task poller (recordInfo has the callback's shape)."""
+    data_obj = data.get("data") or {}
+    task_id = data.get("taskId") or data_obj.get("taskId")
+    if await _is_hedge_loser("kie", query):
+        logger.info("Callback of a hedged KIE task that lost ignored: generationId=%s", query.get("generationId"))
+        return {"ok": True, "ignored": True}
+    claim = await _claim_callback(
+        "kie",
+        task_id,
+        data_obj.get("state") or data.get("state") or data.get("code"),
+    )
+    if claim is None:
+        logger.info("Duplicate NanoBanana callback ignored: taskId=%s", task_id)
+        return {"ok": True, "duplicate": True}
+    try:
+        result = await _process_nanobanana_callback(query, data)
+    except Exception:
+        await _release_callback(claim)
+        raise
+    if not result.get("ok"):
+        await _release_callback(claim)
+    elif task_id:
+        task_poller.forget("kie", task_id)
+    return result
+
+
+async def _process_nanobanana_callback(query: Mapping[str, str], data: dict) -> dict:
     data_obj = data.get("data") or {}
     logger.info(
         "NanoBanana callback received: %s",
@@ -352,7 +773,7 @@ async def nanobanana_callback(request: Request) -> dict:
 
     # Идентификаторы могут быть добавлены в query параметрах callBackUrl
     try:
-        qp = request.query_params
+        qp = query
         qp_gen = qp.get("generationId")
         qp_user = qp.get("userId")
         if generation_id is None and qp_gen is not None:
@@ -433,59 +854,20 @@ async def nanobanana_callback(request: Request) -> dict:
             if is_internal_error and err_code in (429, 501, 500, "429", "501", "500"):
                 if retry_count < 1 and generation_id is not None and user_id is not None:
                     logger.info("Auto-retrying generation_id=%s for user=%s due to internal error (retry %s)", generation_id, user_id, retry_count + 1)
-                    
-                    async def do_retry():
-                        import asyncio
-                        await asyncio.sleep(5)
-                        try:
-                            gen = await db.get_generation(int(generation_id))
-                            if not gen:
-                                return
-                            
-                            prompt_with_meta = gen.get("prompt", "")
-                            prompt = prompt_with_meta.split(" [type=")[0].strip()
-                            db_model = gen.get("model")
-                            model = "nano-banana-pro" if db_model == "nanobanana-pro" else "google/nano-banana"
-                            
-                            ratio_val = "auto"
-                            import re
-                            m = re.search(r"ratio=([^;\]]+)", prompt_with_meta)
-                            if m:
-                                ratio_val = m.group(1).strip()
-                            
-                            ratio_map = {
-                                "1:1": "1:1",
-                                "3:4": "3:4",
-                                "4:3": "4:3",
-                                "9:16": "9:16",
-                                "16:9": "16:9",
-                            }
-                            image_size = ratio_map.get(ratio_val)
-                            image_urls = gen.get("input_images", [])
-                            
-                            new_meta = {"generationId": generation_id, "userId": user_id, "tokens": tokens_required, "retry_count": retry_count + 1}
-                            if model == "nano-banana-pro":
-                                await generation_service.generate_pro(
-                                    prompt=prompt,
-                                    image_urls=image_urls or None,
-                                    aspect_ratio=image_size,
-                                    resolution="2K",
-                                    meta=new_meta
-                                )
-                            else:
-                                await client.generate_image(
-                                    prompt=prompt,
-                                    model=model,
-                                    image_urls=image_urls or None,
-                                    image_size=image_size,
-                                    output_format="png",
-                                    meta=new_meta
-                                )
-                        except Exception as e:
-                            logger.exception("Failed to auto-retry generation: %s", e)
-                            
-                    import asyncio
-                    asyncio.create_task(do_retry())
+                    # Durable: survives a redeploy, retried with backoff if the provider is still down
+                    await jobs.enqueue(
+                        RETRY_GENERATION_JOB,
+                        {
+                            "generation_id": int(generation_id),
+                            "user_id": int(user_id),
+                            "tokens": int(tokens_required),
+                            "retry_count": retry_count + 1,
+                            "fail_msg": str(fail_msg),
+                        },
+                        delay_seconds=5,
+                        job_id=f"retry:{int(generation_id)}:{retry_count + 1}",
+                        max_attempts=3,
+                    )
                     return {"ok": True}
         except Exception as e:
             logger.warning("Error in auto-retry logic: %s", e)
@@ -493,34 +875,34 @@ async def nanobanana_callback(request: Request) -> dict:
         # Обновим статус генерации в базе, если есть id
         if generation_id is not None:
             try:
-                await db.mark_generation_failed(int(generation_id), str(fail_msg))
+                if not await db.mark_generation_failed(int(generation_id), str(fail_msg)):
+                    logger.info("Generation %s is no longer pending, ignoring failure callback", generation_id)
+                    return {"ok": True, "ignored": True}
             except Exception as e:
                 logger.warning("Failed to mark generation failed id=%s: %s", generation_id, e)
 
-        # Попробуем получить user_id из записи генерации, если он отсутствует
-        if user_id is None and generation_id is not None:
-            try:
-                user_id = await db.get_generation_user_id(int(generation_id))
-            except Exception as e:
-                logger.warning("Failed to fetch user_id for failed generation id=%s: %s", generation_id, e)
+        # user_id и язык: из контекста генерации в Redis, Supabase только при промахе
+        gen_ctx = await _generation_context(generation_id, user_id)
+        user_id = gen_ctx["user_id"]
 
         # Вернём списанные токены пользователю при неудачной генерации
-        if user_id is not None:
+        if user_id is not None and generation_id is not None:
             try:
-                current_balance = await db.get_token_balance(int(user_id))
-                new_balance = int(current_balance) + int(tokens_required)
-                await db.set_token_balance(int(user_id), new_balance)
-                logger.info("Refunded %s tokens: user=%s balance %s->%s", tokens_required, user_id, current_balance, new_balance)
+                new_balance = await ledger.adjust(
+                    int(user_id),
+                    int(tokens_required),
+                    "refund",
+                    generation_ledger_key(int(generation_id), "refund"),
+                    generation_id=int(generation_id),
+                )
+                logger.info("Refunded %s tokens: user=%s gen_id=%s balance=%s", tokens_required, user_id, generation_id, new_balance)
             except Exception as e:
                 logger.warning("Failed to refund tokens to user %s: %s", user_id, e)
 
         # Уведомим пользователя о неудаче
         if user_id is not None:
             try:
-                try:
-                    lang = normalize_lang(await db.get_user_language(int(user_id)))
-                except Exception:
-                    lang = "ru"
+                lang = gen_ctx["lang"]
                 if generation_id is not None:
                     await send_message_draft(
                         bot,
@@ -578,25 +960,22 @@ async def nanobanana_callback(request: Request) -> dict:
         # If we have generation_id, update Supabase and fetch user_id when needed
         if generation_id is not None:
             try:
-                await db.mark_generation_completed(int(generation_id), image_url)
+                if await db.mark_generation_completed(int(generation_id), image_url):
+                    await generate_handler.schedule_output_mirror(int(generation_id), image_url)
+                elif await _generation_failed(generation_id):
+                    logger.warning("Late KIE result for generation %s that was already failed and refunded; not delivered", generation_id)
+                    return {"ok": True, "ignored": True}
             except Exception as e:
                 logger.warning("Failed to mark generation completed id=%s: %s", generation_id, e)
 
-            # If user_id absent, try to fetch from generation record
-            if user_id is None:
-                try:
-                    user_id = await db.get_generation_user_id(int(generation_id))
-                except Exception as e:
-                    logger.warning("Failed to fetch generation user_id id=%s: %s", generation_id, e)
+        # user_id и язык подписи: из контекста генерации в Redis, Supabase только при промахе
+        gen_ctx = await _generation_context(generation_id, user_id)
+        user_id = gen_ctx["user_id"]
 
         # If we have user_id, send image to the user chat as a document to preserve quality
         if user_id is not None:
             try:
-                # Определим язык пользователя для подписи
-                try:
-                    lang = normalize_lang(await db.get_user_language(int(user_id)))
-                except Exception:
-                    lang = "ru"
+                lang = gen_ctx["lang"]
                 if generation_id is not None:
                     await send_message_draft(
                         bot,
@@ -604,47 +983,7 @@ async def nanobanana_callback(request: Request) -> dict:
                         generation_id,
                         t(lang, "gen.draft.completed"),
                     )
-                # Отправим изображение как документ (URLInputFile) без изменения расширения
-                from urllib.parse import urlparse
-                filename = "image"
-                try:
-                    path = urlparse(str(image_url)).path
-                    if path:
-                        base = path.rsplit("/", 1)[-1]
-                        if base:
-                            filename = base
-                except Exception:
-                    pass
-
-                try:
-                    reply_markup = ReplyKeyboardMarkup(
-                        keyboard=[
-                            [KeyboardButton(text=t(lang, "kb.repeat_generation"))],
-                            [KeyboardButton(text=t(lang, "kb.generate")), KeyboardButton(text=t(lang, "kb.nanobanana_pro"))],
-                            [KeyboardButton(text=t(lang, "kb.profile")), KeyboardButton(text=t(lang, "avatars.btn_label")), KeyboardButton(text=t(lang, "kb.topup"))],
-                        ],
-                        resize_keyboard=True,
-                    )
-                    result_caption = (
-                        t(lang, "gen.result_caption_with_id", generation_id=generation_id)
-                        if generation_id is not None
-                        else t(lang, "gen.result_caption")
-                    )
-
-                    file = URLInputFile(url=str(image_url), filename=filename)
-                    await bot.send_document(chat_id=int(user_id), document=file, caption=result_caption, reply_markup=reply_markup)
-                except Exception as e_doc:
-                    logger.warning("Failed to send as document, fallback to photo: %s", e_doc)
-                    await bot.send_photo(chat_id=int(user_id), photo=image_url, caption=result_caption, reply_markup=reply_markup)
-                if generation_id is not None:
-                    try:
-                        await bot.send_message(
-                            chat_id=int(user_id),
-                            text=t(lang, "gen.generation_id", generation_id=generation_id),
-                            reply_markup=generation_id_copy_keyboard(lang, generation_id),
-                        )
-                    except Exception as e_copy:
-                        logger.warning("Failed to send copy-id button to user %s: %s", user_id, e_copy)
+                await _deliver_result(int(user_id), generation_id, image_url, lang, gen_ctx.get("file_id"))
             except Exception as e:
                 logger.warning("Failed to send photo to user %s: %s", user_id, e)
         else:
@@ -661,6 +1000,7 @@ async def piapi_callback(request: Request) -> dict:
     """
     Callback endpoint for Piapi API to deliver generated images.
     Piapi sends task object directly: {task_id, status, output: {image_urls: [...]}, ...}
+    Redeliveries of the same (task_id, status) are acknowledged without processing.
     """
     # Get raw body for debugging
     raw_body = await request.body()
@@ -672,7 +1012,79 @@ async def piapi_callback(request: Request) -> dict:
     except Exception as parse_err:
         logger.error("Piapi callback JSON parse error: %s", parse_err)
         return {"ok": False, "error": "invalid json"}
-    
+
+    return await _handle_piapi_result(request.query_params, data)
+
+
+async def _handle_piapi_result(query: Mapping[str, str], data: dict) -> dict:
+    """Shared by the callback endpoint and the task poller."""
+    task_data = data.get("data", data)
+    task_id = task_data.get("task_id")
+    status = str(task_data.get("status") or "").lower()
+    if await _is_hedge_loser("piapi", query):
+        logger.info("Callback of a hedged Piapi task that lost ignored: generationId=%s", query.get("generationId"))
+        return {"ok": True, "ignored": True}
+    claim = await _claim_callback("piapi", task_id, status)
+    if claim is None:
+        logger.info("Duplicate Piapi callback ignored: task_id=%s", task_id)
+        return {"ok": True, "duplicate": True}
+    try:
+        result = await _process_piapi_callback(query, data)
+    except Exception:
+        await _release_callback(claim)
+        raise
+    if not result.get("ok"):
+        await _release_callback(claim)
+    elif task_id and status in PIAPI_FINAL_STATES:
+        task_poller.forget("piapi", task_id)
+    return result
+
+
+async def _on_polled_result(provider: str, task_id: str, generation_id: Optional[int], payload: dict) -> None:
+    """TaskPoller found a finished task whose callback did not arrive: process it as that callback."""
+    query = {"generationId": str(generation_id)} if generation_id is not None else {}
+    if provider == "kie":
+        await _handle_kie_result(query, payload)
+    else:
+        await _handle_piapi_result(query, payload)
+
+
+async def _notify_expired_generations(rows: list[dict]) -> None:
+    """Reaper failed and refunded these generations; tell the users."""
+    for row in rows:
+        user_id = row.get("user_id")
+        if user_id is None:
+            continue
+        lang = (await _generation_context(row.get("generation_id"), int(user_id)))["lang"]
+        try:
+            await bot.send_message(
+                chat_id=int(user_id),
+                text=t(lang, "gen.expired", generation_id=row.get("generation_id"), tokens=int(row.get("refunded") or 0)),
+            )
+        except Exception as e:
+            logger.warning("Failed to notify user %s about expired generation: %s", user_id, e)
+
+
+async def _recover_pending_tasks() -> None:
+    """After a restart: resume polling of generations still waiting for a provider callback."""
+    now = datetime.now(timezone.utc)
+    try:
+        rows = await db.list_pending_provider_tasks(now - timedelta(seconds=settings.task_poll_max_age_seconds))
+    except Exception:
+        logger.warning("Failed to load pending provider tasks", exc_info=True)
+        return
+    for row in rows:
+        try:
+            created = datetime.fromisoformat(str(row.get("created_at")).replace("Z", "+00:00"))
+            age = max(0.0, (now - created).total_seconds())
+        except Exception:
+            age = 0.0
+        task_poller.track(row.get("api_provider") or "kie", row.get("provider_task_id"), int(row["id"]), age_seconds=age)
+    if rows:
+        logger.info("Resumed polling of %s pending provider tasks", len(rows))
+
+
+async def _process_piapi_callback(query: Mapping[str, str], data: dict) -> dict:
     logger.info("Piapi callback parsed: task_id=%s, status=%s, keys=%s", data.get("task_id"), data.get("status"), list(data.keys()))
 
     # Piapi wraps task object in {"timestamp": ..., "data": {...}}
@@ -686,7 +1098,7 @@ async def piapi_callback(request: Request) -> dict:
     user_id = None
     tokens_required = 3
     try:
-        qp = request.query_params
+        qp = query
         qp_gen = qp.get("generationId")
         qp_user = qp.get("userId")
         if qp_gen:
@@ -722,26 +1134,23 @@ async def piapi_callback(request: Request) -> dict:
         # Mark generation as completed
         if generation_id:
             try:
-                await db.mark_generation_completed(int(generation_id), image_url)
-                await db.update_generation_provider(int(generation_id), "piapi")
+                if await db.mark_generation_completed(int(generation_id), image_url):
+                    await db.update_generation_provider(int(generation_id), "piapi")
+                    await generate_handler.schedule_output_mirror(int(generation_id), image_url)
+                elif await _generation_failed(generation_id):
+                    logger.warning("Late Piapi result for generation %s that was already failed and refunded; not delivered", generation_id)
+                    return {"ok": True, "ignored": True}
             except Exception as e:
                 logger.warning("Failed to mark generation completed: %s", e)
         
-        # Fetch user_id from generation if not provided
-        if user_id is None and generation_id:
-            try:
-                user_id = await db.get_generation_user_id(int(generation_id))
-            except Exception as e:
-                logger.warning("Failed to fetch user_id: %s", e)
+        # user_id and language from the Redis generation context; Supabase only on a miss
+        gen_ctx = await _generation_context(generation_id, user_id)
+        user_id = gen_ctx["user_id"]
         
         # Send image to user
         if user_id:
             try:
-                # Get user language
-                try:
-                    lang = normalize_lang(await db.get_user_language(int(user_id)))
-                except Exception:
-                    lang = "ru"
+                lang = gen_ctx["lang"]
                 if generation_id is not None:
                     await send_message_draft(
                         bot,
@@ -750,47 +1159,7 @@ async def piapi_callback(request: Request) -> dict:
                         t(lang, "gen.draft.completed"),
                     )
                 
-                reply_markup = ReplyKeyboardMarkup(
-                    keyboard=[
-                        [KeyboardButton(text=t(lang, "kb.repeat_generation"))],
-                        [KeyboardButton(text=t(lang, "kb.generate")), KeyboardButton(text=t(lang, "kb.nanobanana_pro"))],
-                        [KeyboardButton(text=t(lang, "kb.profile")), KeyboardButton(text=t(lang, "avatars.btn_label")), KeyboardButton(text=t(lang, "kb.topup"))],
-                    ],
-                    resize_keyboard=True,
-                )
-                
-                # Extract filename from URL
-                from urllib.parse import urlparse
-                filename = "image.png"
-                try:
-                    path = urlparse(str(image_url)).path
-                    if path:
-                        base = path.rsplit("/", 1)[-1]
-                        if base:
-                            filename = base
-                except Exception:
-                    pass
-                result_caption = (
-                    t(lang, "gen.result_caption_with_id", generation_id=generation_id)
-                    if generation_id is not None
-                    else t(lang, "gen.result_caption")
-                )
-                
-                try:
-                    file = URLInputFile(url=str(image_url), filename=filename)
-                    await bot.send_document(chat_id=int(user_id), document=file, caption=result_caption, reply_markup=reply_markup)
-                except Exception as e_doc:
-                    logger.warning("Piapi: Failed to send as document: %s", e_doc)
-                    await bot.send_photo(chat_id=int(user_id), photo=image_url, caption=result_caption, reply_markup=reply_markup)
-                if generation_id is not None:
-                    try:
-                        await bot.send_message(
-                            chat_id=int(user_id),
-                            text=t(lang, "gen.generation_id", generation_id=generation_id),
-                            reply_markup=generation_id_copy_keyboard(lang, generation_id),
-                        )
-                    except Exception as e_copy:
-                        logger.warning("Piapi: Failed to send copy-id button to user %s: %s", user_id, e_copy)
+                await _deliver_result(int(user_id), generation_id, image_url, lang, gen_ctx.get("file_id"))
             except Exception as e:
                 logger.warning("Failed to send photo to user %s: %s", user_id, e)
         
@@ -804,32 +1173,34 @@ async def piapi_callback(request: Request) -> dict:
         # Mark generation failed
         if generation_id:
             try:
-                await db.mark_generation_failed(int(generation_id), str(fail_msg))
+                if not await db.mark_generation_failed(int(generation_id), str(fail_msg)):
+                    logger.info("Generation %s is no longer pending, ignoring Piapi failure", generation_id)
+                    return {"ok": True, "ignored": True}
             except Exception as e:
                 logger.warning("Failed to mark generation failed: %s", e)
         
-        # Fetch user_id if needed
-        if user_id is None and generation_id:
-            try:
-                user_id = await db.get_generation_user_id(int(generation_id))
-            except Exception:
-                pass
+        # user_id, language and the debited amount from the Redis generation context
+        gen_ctx = await _generation_context(generation_id, user_id)
+        user_id = gen_ctx["user_id"]
+        tokens_required = gen_ctx["tokens"] or tokens_required
         
         # Refund tokens and notify user
         if user_id:
             try:
-                current = await db.get_token_balance(int(user_id))
-                new_balance = current + tokens_required
-                await db.set_token_balance(int(user_id), new_balance)
-                logger.info("Refunded %s tokens: user=%s", tokens_required, user_id)
+                if generation_id:
+                    new_balance = await ledger.adjust(
+                        int(user_id),
+                        int(tokens_required),
+                        "refund",
+                        generation_ledger_key(int(generation_id), "refund"),
+                        generation_id=int(generation_id),
+                    )
+                    logger.info("Refunded %s tokens: user=%s gen_id=%s balance=%s", tokens_required, user_id, generation_id, new_balance)
             except Exception as e:
                 logger.warning("Failed to refund tokens: %s", e)
             
             try:
-                try:
-                    lang = normalize_lang(await db.get_user_language(int(user_id)))
-                except Exception:
-                    lang = "ru"
+                lang = gen_ctx["lang"]
                 if generation_id is not None:
                     await send_message_draft(
                         bot,
@@ -940,10 +1311,17 @@ async def tribute_webhook(request: Request, trbt_signature: str | None = Header(
             logger.warning("Unknown Tribute product_id=%s, no tokens credited", product_id)
         return {"ok": True}
 
+    # Повторная доставка того же вебхука не должна начислить токены дважды
+    purchase_id = (
+        payload.get("purchase_id")
+        or payload.get("purchaseId")
+        or payload.get("order_id")
+        or hashlib.sha256(raw).hexdigest()
+    )
     try:
-        current = await db.get_token_balance(tg_user_id)
-        new_balance = current + int(tokens)
-        await db.set_token_balance(tg_user_id, new_balance)
+        new_balance = await ledger.adjust(
+            tg_user_id, int(tokens), "topup_tribute", f"tribute:{purchase_id}"
+        )
 
         try:
             lang = normalize_lang(await db.get_user_language(tg_user_id))
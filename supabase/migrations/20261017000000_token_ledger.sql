@@ -0,0 +1,69 @@
+-- Журнал движения токенов и атомарное изменение баланса одной RPC.
+-- Применение: supabase db push (или выполнить в SQL Editor).
+
+create table if not exists public.token_ledger (
+    id bigserial primary key,
+    user_id bigint not null,
+    delta integer not null,
+    balance_after integer not null,
+    reason text not null,
+    idempotency_key text not null unique,
+    generation_id bigint,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists token_ledger_user_id_idx on public.token_ledger (user_id, id desc);
+
+-- Atomically applies p_delta to users.balance and records a ledger row.
+-- * The users row is locked (FOR UPDATE), so concurrent movements for one user serialize.
+-- * A repeated p_idempotency_key is a no-op that reports the current balance (applied = false).
+-- * A debit that would make the balance negative is rejected (ok = false), nothing is written.
+-- Returns {"ok": bool, "applied": bool, "balance": int}.
+create or replace function public.adjust_balance(
+    p_user_id bigint,
+    p_delta integer,
+    p_reason text,
+    p_idempotency_key text,
+    p_generation_id bigint default null
+) returns jsonb
+language plpgsql
+as $$
+declare
+    v_balance integer;
+begin
+    select coalesce(balance, 0) into v_balance
+    from public.users
+    where user_id = p_user_id
+    for update;
+
+    if not found then
+        if p_delta < 0 then
+            return jsonb_build_object('ok', false, 'applied', false, 'balance', 0);
+        end if;
+        insert into public.users (user_id, balance) values (p_user_id, 0)
+        on conflict (user_id) do nothing;
+        select coalesce(balance, 0) into v_balance
+        from public.users
+        where user_id = p_user_id
+        for update;
+    end if;
+
+    if exists (select 1 from public.token_ledger where idempotency_key = p_idempotency_key) then
+        return jsonb_build_object('ok', true, 'applied', false, 'balance', v_balance);
+    end if;
+
+    if v_balance + p_delta < 0 then
+        return jsonb_build_object('ok', false, 'applied', false, 'balance', v_balance);
+    end if;
+
+    update public.users
+    set balance = v_balance + p_delta
+    where user_id = p_user_id
+    returning balance into v_balance;
+
+    insert into public.token_ledger (user_id, delta, balance_after, reason, idempotency_key, generation_id)
+    values (p_user_id, p_delta, v_balance, p_reason, p_idempotency_key, p_generation_id);
+
+    return jsonb_build_object('ok', true, 'applied', true, 'balance', v_balance);
+end;
+$$;
@@ -0,0 +1,91 @@
+-- Пакетная запись в token_ledger и периодические снимки балансов для сверки.
+
+-- Applies several ledger entries in one round trip.
+-- p_entries: [{"user_id", "delta", "reason", "idempotency_key", "generation_id"?}, ...]
+-- Entries are applied in (user_id, input order) so concurrent batches lock users rows
+-- in the same order. Returns results in input order: [{"ok", "applied", "balance"}, ...].
+create or replace function public.apply_ledger_batch(p_entries jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_entry record;
+    v_results jsonb := '{}'::jsonb;
+begin
+    for v_entry in
+        select e.value as item, e.ordinality as pos
+        from jsonb_array_elements(p_entries) with ordinality as e(value, ordinality)
+        order by (e.value ->> 'user_id')::bigint, e.ordinality
+    loop
+        v_results := v_results || jsonb_build_object(
+            v_entry.pos::text,
+            public.adjust_balance(
+                (v_entry.item ->> 'user_id')::bigint,
+                (v_entry.item ->> 'delta')::integer,
+                v_entry.item ->> 'reason',
+                v_entry.item ->> 'idempotency_key',
+                nullif(v_entry.item ->> 'generation_id', '')::bigint
+            )
+        );
+    end loop;
+    return coalesce(
+        (select jsonb_agg(r.value order by r.key::integer) from jsonb_each(v_results) as r),
+        '[]'::jsonb
+    );
+end;
+$$;
+
+-- Materialized balance per user as of a ledger position.
+-- balance = users.balance at the moment token_ledger reached last_ledger_id for this user.
+create table if not exists public.balance_snapshots (
+    user_id bigint primary key,
+    balance integer not null,
+    last_ledger_id bigint not null,
+    taken_at timestamptz not null default now()
+);
+
+-- Refreshes snapshots of users that have ledger entries newer than their snapshot.
+-- One statement = one MVCC snapshot, so users.balance and max(token_ledger.id) are consistent
+-- (adjust_balance writes both in one transaction). Idempotent; safe to run from several replicas.
+create or replace function public.snapshot_balances()
+returns integer
+language sql
+as $$
+    with latest as (
+        select l.user_id, max(l.id) as last_id
+        from public.token_ledger l
+        left join public.balance_snapshots s on s.user_id = l.user_id
+        where s.user_id is null or l.id > s.last_ledger_id
+        group by l.user_id
+    ),
+    upserted as (
+        insert into public.balance_snapshots (user_id, balance, last_ledger_id, taken_at)
+        select u.user_id, coalesce(u.balance, 0), latest.last_id, now()
+        from latest
+        join public.users u on u.user_id = latest.user_id
+        on conflict (user_id) do update
+            set balance = excluded.balance,
+                last_ledger_id = excluded.last_ledger_id,
+                taken_at = excluded.taken_at
+        returning 1
+    )
+    select count(*)::integer from upserted;
+$$;
+
+-- Reconciliation: snapshot + ledger tail must equal the live balance.
+-- Non-zero drift means the balance was changed outside adjust_balance().
+create or replace view public.token_balance_audit as
+select
+    u.user_id,
+    coalesce(u.balance, 0) as balance,
+    s.balance as snapshot_balance,
+    s.last_ledger_id,
+    coalesce(t.tail, 0) as ledger_tail,
+    coalesce(u.balance, 0) - (s.balance + coalesce(t.tail, 0)) as drift
+from public.balance_snapshots s
+join public.users u on u.user_id = s.user_id
+left join lateral (
+    select sum(l.delta) as tail
+    from public.token_ledger l
+    where l.user_id = s.user_id and l.id > s.last_ledger_id
+) t on true;
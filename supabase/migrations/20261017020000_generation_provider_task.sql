@@ -0,0 +1,10 @@
+-- Идентификатор задачи у провайдера (KIE taskId / Piapi task_id) для сверки статуса,
+-- если callback не пришёл (см. utils/task_poller.py).
+-- Применение: supabase db push (или выполнить в SQL Editor).
+
+alter table public.generations add column if not exists provider_task_id text;
+
+-- Pending generations that have a provider task: loaded by the poller on startup
+create index if not exists generations_pending_task_idx
+    on public.generations (id)
+    where status = 'pending' and provider_task_id is not null;
@@ -0,0 +1,53 @@
+-- Завершение "зависших" генераций пачкой: статус failed + возврат списанных токенов
+-- одной RPC на страницу (см. utils/reaper.py).
+-- Применение: supabase db push (или выполнить в SQL Editor).
+
+create index if not exists generations_pending_idx
+    on public.generations (id)
+    where status = 'pending';
+
+-- Marks the given generations failed if they are still pending and refunds exactly what their
+-- debit (token_ledger key gen:{id}:debit) took. Refunds go through adjust_balance with key
+-- gen:{id}:refund, so a refund already made by a late callback is not repeated.
+-- Rows locked by a concurrent callback are skipped (picked up by the next sweep).
+-- Returns [{"generation_id", "user_id", "refunded", "balance"}] for the rows it finalized.
+create or replace function public.expire_generations(p_ids bigint[], p_error text)
+returns jsonb
+language plpgsql
+as $$
+declare
+    r record;
+    v_debit integer;
+    v_res jsonb;
+    v_out jsonb := '[]'::jsonb;
+begin
+    for r in
+        select id, user_id
+        from public.generations
+        where id = any(p_ids) and status = 'pending'
+        order by id
+        for update skip locked
+    loop
+        update public.generations
+        set status = 'failed', error_message = p_error, completed_at = now()
+        where id = r.id;
+
+        select -delta into v_debit
+        from public.token_ledger
+        where idempotency_key = 'gen:' || r.id || ':debit';
+
+        v_res := null;
+        if coalesce(v_debit, 0) > 0 then
+            v_res := public.adjust_balance(r.user_id, v_debit, 'refund', 'gen:' || r.id || ':refund', r.id);
+        end if;
+
+        v_out := v_out || jsonb_build_object(
+            'generation_id', r.id,
+            'user_id', r.user_id,
+            'refunded', case when coalesce((v_res->>'applied')::boolean, false) then v_debit else 0 end,
+            'balance', v_res->'balance'
+        );
+    end loop;
+    return v_out;
+end;
+$$;
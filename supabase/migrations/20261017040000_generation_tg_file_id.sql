@@ -0,0 +1,5 @@
+-- Telegram file_id отправленного результата генерации (документ): повторная отправка
+-- по file_id не загружает файл заново (см. utils/delivery.py).
+-- Применение: supabase db push (или выполнить в SQL Editor).
+
+alter table public.generations add column if not exists tg_file_id text;
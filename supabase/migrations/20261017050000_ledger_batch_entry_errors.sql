@@ -0,0 +1,38 @@
+-- apply_ledger_batch: ошибка одной записи (несуществующий пользователь, битый payload)
+-- больше не откатывает весь пакет — запись получает {"ok": false, "error": ...}.
+-- Применение: supabase db push (или выполнить в SQL Editor).
+
+create or replace function public.apply_ledger_batch(p_entries jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_entry record;
+    v_result jsonb;
+    v_results jsonb := '{}'::jsonb;
+begin
+    for v_entry in
+        select e.value as item, e.ordinality as pos
+        from jsonb_array_elements(p_entries) with ordinality as e(value, ordinality)
+        order by (e.value ->> 'user_id')::bigint, e.ordinality
+    loop
+        -- Each entry in its own subtransaction: a failure rolls back only that entry
+        begin
+            v_result := public.adjust_balance(
+                (v_entry.item ->> 'user_id')::bigint,
+                (v_entry.item ->> 'delta')::integer,
+                v_entry.item ->> 'reason',
+                v_entry.item ->> 'idempotency_key',
+                nullif(v_entry.item ->> 'generation_id', '')::bigint
+            );
+        exception when others then
+            v_result := jsonb_build_object('ok', false, 'applied', false, 'error', sqlerrm);
+        end;
+        v_results := v_results || jsonb_build_object(v_entry.pos::text, v_result);
+    end loop;
+    return coalesce(
+        (select jsonb_agg(r.value order by r.key::integer) from jsonb_each(v_results) as r),
+        '[]'::jsonb
+    );
+end;
+$$;